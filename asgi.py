@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+from mizu import app
+from mizu import stats
+from mizu.asgi import ASGIBridge
+
+# Serve with an ASGI server, e.g. `uvicorn asgi:application --port 8080`
+application = ASGIBridge(app, app.config['ASGI_THREADS'])
+
+stats.register('asgi', application.stats)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+""" Load test Mizu against local stand-ins for SSO, LDAP, and the drink machines
+
+Starts a fake SSO provider and fake drink machines (bench/stubs.py) on local ports, then serves Mizu with an in-memory
+directory and a freshly seeded database (bench/stub_app.py) under gunicorn or uvicorn. Each ``--concurrency`` level is
+warmed up, then driven for ``--duration`` seconds with a weighted mix of requests from many users:
+
+    drinks  GET /drinks
+    items   GET /items
+    users   GET /users
+    drop    POST /drinks/drop, from a random slot of a random machine
+
+Results - throughput, and latency percentiles per request type - are printed (or written to ``--output``) as JSON,
+along with everything needed to compare them with another run.
+
+    $ python bench/load.py --concurrency 8 --concurrency 64 --machine-latency 0.2 --output results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timezone
+
+import requests
+
+from serving import ROOT, free_port, percentile, server_command, wait_until_up
+from stubs import FakeMachines, FakeOIDCProvider
+
+MACHINES = ('bigdrink', 'littledrink', 'snack')
+
+SCENARIOS = {
+    'drinks': ('GET', '/drinks'),
+    'items': ('GET', '/items'),
+    'users': ('GET', '/users'),
+    'drop': ('POST', '/drinks/drop'),
+}
+
+
+def parse_mix(text):
+    """ Parse ``name=weight,...`` into a list of scenario names, each repeated by its weight """
+    mix = []
+    for entry in text.split(','):
+        name, _, weight = entry.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError('Unknown request type \'{}\', expected one of {}'.format(
+                name, ', '.join(SCENARIOS)
+            ))
+        mix.extend([name] * int(weight or 1))
+    if not mix:
+        raise argparse.ArgumentTypeError('The mix must include at least one request type')
+    return mix
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput': round(len(latencies) / elapsed, 2),
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))
+        },
+    }
+
+
+def drive(base_url, mix, tokens, slots, concurrency, duration):
+    """ Send requests from ``mix`` from ``concurrency`` threads for ``duration`` seconds, each as a random user """
+    results = {name: ([], {}, [0]) for name in set(mix)}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        session = requests.Session()
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            name = rng.choice(mix)
+            method, path = SCENARIOS[name]
+            headers = {'Authorization': 'Bearer {}'.format(rng.choice(tokens))}
+            body = None
+            if name == 'drop':
+                body = {'machine': rng.choice(MACHINES), 'slot': rng.randint(1, slots)}
+
+            latencies, statuses, errors = results[name]
+            start = time.monotonic()
+            try:
+                response = session.request(method, base_url + path, headers=headers, json=body, timeout=60)
+                elapsed = time.monotonic() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            except requests.exceptions.RequestException:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    by_type = {name: summarize(latencies, statuses, errors[0], elapsed)
+               for name, (latencies, statuses, errors) in sorted(results.items())}
+
+    latencies = [latency for latencies, _, _ in results.values() for latency in latencies]
+    statuses = {}
+    for _, type_statuses, _ in results.values():
+        for status, count in type_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    errors = sum(errors[0] for _, _, errors in results.values())
+
+    return dict(summarize(latencies, statuses, errors, elapsed), concurrency=concurrency, requests_by_type=by_type)
+
+
+def server_environ(args, oidc, machines, database):
+    return dict(
+        os.environ,
+        MIZU_DATABASE_URI=args.database_uri or 'sqlite:///{}'.format(database),
+        MIZU_OIDC_ISSUER=oidc.url,
+        MIZU_OIDC_VERIFY_MODE=args.verify_mode,
+        MIZU_MACHINE_URL=machines.url + '/{}',
+        MIZU_MACHINE_API_TOKEN='bench',
+        MIZU_ASGI_THREADS=str(args.threads),
+        MIZU_LOG_LEVEL=args.log_level,
+        MIZU_BENCH_USERS=str(args.users),
+        MIZU_BENCH_SLOTS=str(args.slots),
+        MIZU_BENCH_LDAP_LATENCY=str(args.ldap_latency),
+    )
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        return revision.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    started_at = datetime.now(timezone.utc).isoformat()
+    oidc = FakeOIDCProvider(args.sso_latency).start()
+    machines = FakeMachines(args.slots, args.machine_latency, args.machine_jitter, args.machine_failure_rate).start()
+    tokens = [oidc.token('bench{:04}'.format(number), lifetime=24 * 3600) for number in range(args.users)]
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        command = server_command(args.server, port, args.threads, 'bench.stub_app:app', 'bench.stub_app:application')
+        environ = server_environ(args, oidc, machines, os.path.join(workdir, 'bench.db'))
+        output = sys.stderr if args.server_output else subprocess.DEVNULL
+        process = subprocess.Popen(command, cwd=ROOT, env=environ, stdout=output, stderr=output)
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            wait_until_up(base_url + '/drinks', process)
+
+            runs = []
+            for concurrency in args.concurrency:
+                drive(base_url, args.mix, tokens, args.slots, concurrency, args.warmup)
+                runs.append(drive(base_url, args.mix, tokens, args.slots, concurrency, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+            oidc.stop()
+            machines.stop()
+
+    return {
+        'started_at': started_at,
+        'revision': git_revision(),
+        'server': args.server,
+        'threads': args.threads,
+        'duration': args.duration,
+        'mix': {name: args.mix.count(name) for name in SCENARIOS if name in args.mix},
+        'stubs': {
+            'users': args.users,
+            'slots': args.slots,
+            'verify_mode': args.verify_mode,
+            'sso_latency': args.sso_latency,
+            'ldap_latency': args.ldap_latency,
+            'machine_latency': args.machine_latency,
+            'machine_jitter': args.machine_jitter,
+            'machine_failure_rate': args.machine_failure_rate,
+            'sso_requests': oidc.requests,
+            'machine_requests': machines.requests,
+            'machine_drops': machines.drops,
+            'machine_failures': machines.failures,
+        },
+        'runs': runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='asgi', help='serve with gunicorn or uvicorn')
+    parser.add_argument('--threads', type=int, default=32, help='handler threads for the server')
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='concurrent clients, may be repeated to measure several levels (default: 32)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure each level for')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to warm up each level for')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('drinks=4,items=4,users=1,drop=1'),
+                        help='relative weights of each request type (default: drinks=4,items=4,users=1,drop=1)')
+    parser.add_argument('--users', type=int, default=100, help='members in the directory, each making requests')
+    parser.add_argument('--slots', type=int, default=10, help='slots in each machine')
+    parser.add_argument('--verify-mode', choices=('jwks', 'userinfo'), default='jwks',
+                        help='how Mizu verifies bearer tokens (MIZU_OIDC_VERIFY_MODE)')
+    parser.add_argument('--sso-latency', type=float, default=0.0, help='seconds the SSO provider takes to respond')
+    parser.add_argument('--ldap-latency', type=float, default=0.0, help='seconds every LDAP operation takes')
+    parser.add_argument('--machine-latency', type=float, default=0.05,
+                        help='seconds the machines take to respond, on average. Above MIZU_MACHINE_READ_TIMEOUT, '
+                             'calls time out')
+    parser.add_argument('--machine-jitter', type=float, default=0.0,
+                        help='the most seconds a machine response is faster or slower than --machine-latency')
+    parser.add_argument('--machine-failure-rate', type=float, default=0.0,
+                        help='the fraction of machine requests that fail with a 503')
+    parser.add_argument('--database-uri', help='a database to seed and use instead of a temporary SQLite file')
+    parser.add_argument('--log-level', default='WARNING', help='the server\'s log level (MIZU_LOG_LEVEL)')
+    parser.add_argument('--server-output', action='store_true', help='pass the server\'s logs through to stderr')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='where to write the results (default: stdout)')
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or [32]
+
+    json.dump(run(args), args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+""" Compare concurrent-client throughput of the WSGI app (wsgi.py under gunicorn) and the ASGI app (asgi.py under
+uvicorn)
+
+Both servers are started from the repository root with the current environment, so point ``MIZU_DATABASE_URI`` and the
+other ``MIZU_*`` settings at the deployment to measure. Each is given the same number of handler threads, warmed up,
+and then driven by ``--concurrency`` clients for ``--duration`` seconds. Results are printed as JSON.
+
+    $ python bench/serving.py --token "$TOKEN" --path /drinks --path /items --concurrency 64
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, threads, wsgi_app='wsgi:app', asgi_app='asgi:application'):
+    if mode == 'wsgi':
+        return [sys.executable, '-m', 'gunicorn', wsgi_app, '--workers', '1', '--threads', str(threads),
+                '--bind', '127.0.0.1:{}'.format(port)]
+    return [sys.executable, '-m', 'uvicorn', asgi_app, '--host', '127.0.0.1', '--port', str(port),
+            '--no-access-log']
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited with status {}'.format(process.returncode))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start within {} seconds'.format(timeout))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def drive(base_url, paths, headers, concurrency, duration):
+    """ Request ``paths`` round-robin from ``concurrency`` threads for ``duration`` seconds """
+    latencies = []
+    statuses = {}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        session = requests.Session()
+        index = offset
+        while time.monotonic() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            start = time.monotonic()
+            try:
+                response = session.get(base_url + path, headers=headers, timeout=60)
+                elapsed = time.monotonic() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            except requests.exceptions.RequestException:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput': round(len(latencies) / elapsed, 2),
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+        },
+    }
+
+
+def bench(mode, args):
+    port = free_port()
+    environ = dict(os.environ, MIZU_ASGI_THREADS=str(args.threads))
+    process = subprocess.Popen(server_command(mode, port, args.threads), cwd=ROOT, env=environ,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        wait_until_up(base_url + args.path[0], process)
+
+        headers = {'Authorization': 'Bearer {}'.format(args.token)} if args.token else {}
+        drive(base_url, args.path, headers, args.concurrency, args.warmup)
+        return drive(base_url, args.path, headers, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--token', default=os.environ.get('MIZU_BENCH_TOKEN'),
+                        help='a bearer token to authenticate with (default: $MIZU_BENCH_TOKEN)')
+    parser.add_argument('--path', action='append', help='a path to GET, may be repeated (default: /drinks)')
+    parser.add_argument('--mode', action='append', choices=('wsgi', 'asgi'), help='a server to run (default: both)')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients')
+    parser.add_argument('--threads', type=int, default=32, help='handler threads for each server')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to warm up for')
+    args = parser.parse_args()
+    args.path = args.path or ['/drinks']
+
+    results = {mode: bench(mode, args) for mode in args.mode or ('wsgi', 'asgi')}
+    json.dump({
+        'paths': args.path,
+        'concurrency': args.concurrency,
+        'threads': args.threads,
+        'results': results,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
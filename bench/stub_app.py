@@ -0,0 +1,187 @@
+""" Mizu, backed by an in-memory stand-in for LDAP and a seeded database, for ``bench/load.py`` to serve with gunicorn
+(``bench.stub_app:app``) or uvicorn (``bench.stub_app:application``)
+
+Configured from the environment like Mizu itself, plus:
+
+    MIZU_BENCH_USERS         members in the directory, named bench0000, bench0001, ...
+    MIZU_BENCH_SLOTS         slots in each machine
+    MIZU_BENCH_LDAP_LATENCY  seconds every LDAP operation is delayed by
+"""
+
+import re
+import threading
+import time
+
+from itertools import count
+from os import environ as env
+
+import ldap
+
+from mizu import app
+from mizu import db
+from mizu import ldap as ldap_pool
+from mizu.models import Item, Machine, Slot
+
+from asgi import application
+
+USERS = int(env.get('MIZU_BENCH_USERS', 100))
+SLOTS = int(env.get('MIZU_BENCH_SLOTS', 10))
+LDAP_LATENCY = float(env.get('MIZU_BENCH_LDAP_LATENCY', 0))
+
+USERS_BASE = 'cn=users,cn=accounts,dc=csh,dc=rit,dc=edu'
+MACHINES = ('bigdrink', 'littledrink', 'snack')
+
+# Enough credits and stock that no run runs out
+BALANCE = 10 ** 9
+STOCK = 10 ** 9
+
+_TERM = re.compile(r'\((\w+)(>=|=)([^()]*)\)')
+
+
+class InMemoryDirectory:
+    """ Member entries, searched and modified the way Mizu uses LDAP
+
+    Only the filters Mizu sends are understood - every ``(attribute=value)`` and ``(attribute>=value)`` term is ANDed,
+    with ``objectClass`` matching every member.
+    """
+
+    def __init__(self, users, latency):
+        self.latency = latency
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._results = {}
+        self._msgids = count(1)
+
+        for number in range(users):
+            uid = 'bench{:04}'.format(number)
+            self._entries[self.dn(uid)] = {
+                'uid': [uid.encode('utf-8')],
+                'cn': ['Bench User {}'.format(number).encode('utf-8')],
+                'drinkBalance': [str(BALANCE).encode('utf-8')],
+                'ibutton': ['{:016x}'.format(number).encode('utf-8')],
+                'modifyTimestamp': [_timestamp()],
+            }
+
+    @staticmethod
+    def dn(uid):
+        return 'uid={},{}'.format(uid, USERS_BASE)
+
+    def search(self, search_filter, attributes):
+        self._wait()
+        terms = _TERM.findall(search_filter)
+        with self._lock:
+            return [
+                (dn, {name: list(values) for name, values in attrs.items() if name in attributes})
+                for dn, attrs in self._entries.items()
+                if all(_matches(attrs, *term) for term in terms)
+            ]
+
+    def search_async(self, search_filter, attributes):
+        msgid = next(self._msgids)
+        self._results[msgid] = self.search(search_filter, attributes)
+        return msgid
+
+    def result(self, msgid):
+        return ldap.RES_SEARCH_RESULT, self._results.pop(msgid), msgid, []
+
+    def modify(self, dn, modlist):
+        self._wait()
+        with self._lock:
+            entry = self._entries.get(dn)
+            if entry is None:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+
+            attrs = {name: list(values) for name, values in entry.items()}
+            for operation, name, values in modlist:
+                current = attrs.setdefault(name, [])
+                for value in values:
+                    if operation == ldap.MOD_DELETE:
+                        if value not in current:
+                            raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                        current.remove(value)
+                    elif operation == ldap.MOD_ADD:
+                        if value in current:
+                            raise ldap.TYPE_OR_VALUE_EXISTS({'desc': 'Type or value exists'})
+                        current.append(value)
+
+            attrs['modifyTimestamp'] = [_timestamp()]
+            self._entries[dn] = attrs
+
+    def connect(self):
+        """ A connection, standing in for a bound ``CSHLDAP`` """
+        return _Connection(self)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _Connection:
+    """ Both the ``CSHLDAP`` instance and the python-ldap connection returned by its ``get_con`` """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_con(self):
+        return self
+
+    def search_s(self, base, scope, search_filter, attributes):
+        return self.directory.search(search_filter, attributes)
+
+    def search_ext(self, base, scope, search_filter, attributes, serverctrls=None):
+        return self.directory.search_async(search_filter, attributes)
+
+    def result3(self, msgid):
+        return self.directory.result(msgid)
+
+    def modify_s(self, dn, modlist):
+        self.directory.modify(dn, modlist)
+
+    def whoami_s(self):
+        return 'dn:krbprincipalname=bench'
+
+
+def seed():
+    """ Create the tables, and the machines, items, and slots if there are none """
+    with app.app_context():
+        db.create_all()
+        if db.session.query(Machine.id).first() is not None:
+            return
+
+        items = [Item('Bench Item {}'.format(number), 1 + number % 5) for number in range(SLOTS)]
+        db.session.add_all(items)
+        for name in MACHINES:
+            db.session.add(Machine(name, name.title()))
+        db.session.flush()
+
+        for machine in db.session.query(Machine).all():
+            for number, item in enumerate(items, 1):
+                slot = Slot(machine.id, number)
+                slot.item = item.id
+                slot.active = True
+                slot.count = STOCK if machine.name == 'snack' else None
+                db.session.add(slot)
+        db.session.commit()
+
+
+###############################################################################
+# Private / Helper functions
+
+def _matches(attrs, name, operator, value):
+    if name == 'objectClass':
+        return True
+
+    values = attrs.get(name, [])
+    value = value.encode('utf-8')
+    if operator == '>=':
+        return any(stored >= value for stored in values)
+    return value in values
+
+
+def _timestamp():
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime()).encode('utf-8')
+
+
+directory = InMemoryDirectory(USERS, LDAP_LATENCY)
+ldap_pool.factory = directory.connect
+seed()
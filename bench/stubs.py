@@ -0,0 +1,167 @@
+""" Local stand-ins for the services Mizu calls over HTTP - the SSO provider and the drink machines - for
+``bench/load.py``
+
+Each runs an HTTP server on a thread of the benchmarking process, on a free local port.
+"""
+
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEY_ID = 'bench'
+
+
+class StubServer:
+    """ Serves ``handle(method, path, headers, body) -> (status, body)`` on a local port from a background thread """
+
+    def __init__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, response = stub.handle(method, self.path, self.headers, body)
+
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+
+class FakeOIDCProvider(StubServer):
+    """ An SSO provider that signs tokens for any user, serving discovery, its signing keys, and ``userinfo``
+
+    Args:
+        latency (float): seconds every response is delayed by
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self._key.public_key()))
+        public.update(kid=KEY_ID, alg='RS256', use='sig')
+        self._jwks = {'keys': [public]}
+
+    def token(self, username, groups=('drink',), lifetime=3600, client_id='drink'):
+        """ A signed access token for ``username``, issued to ``client_id`` """
+        claims = {
+            'iss': self.url,
+            'exp': int(time.time() + lifetime),
+            'typ': 'Bearer',
+            'azp': client_id,
+            'preferred_username': username,
+            'groups': list(groups),
+        }
+        return jwt.encode(claims, self._key, algorithm='RS256', headers={'kid': KEY_ID})
+
+    def handle(self, method, path, headers, body):
+        self.count()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == '/.well-known/openid-configuration':
+            return 200, {'issuer': self.url, 'jwks_uri': self.url + '/protocol/openid-connect/certs'}
+        if path == '/protocol/openid-connect/certs':
+            return 200, self._jwks
+        if path == '/protocol/openid-connect/userinfo':
+            scheme, _, token = headers.get('Authorization', '').partition(' ')
+            try:
+                claims = jwt.decode(token, self._key.public_key(), algorithms=['RS256'], issuer=self.url)
+            except jwt.InvalidTokenError as e:
+                return 401, {'error': 'invalid_token', 'error_description': str(e)}
+            return 200, claims
+        return 404, {'error': 'Not found'}
+
+
+class FakeMachines(StubServer):
+    """ Every drink machine, at ``<url>/<machine name>/health`` and ``<url>/<machine name>/drop``
+
+    Point ``MIZU_MACHINE_URL`` at ``<url>/{}``.
+
+    Args:
+        slots (int): the number of slots each machine reports, none of them empty
+        latency (float): seconds every response is delayed by, on average
+        jitter (float): the most seconds a response is delayed by above or below ``latency``
+        failure_rate (float): the fraction of requests answered with a 503
+    """
+
+    def __init__(self, slots, latency=0.0, jitter=0.0, failure_rate=0.0):
+        super().__init__()
+        self.slots = slots
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.drops = 0
+        self.failures = 0
+
+    def handle(self, method, path, headers, body):
+        self.count()
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        _, machine, endpoint = path.split('/', 2) if path.count('/') >= 2 else ('', '', '')
+
+        if random.random() < self.failure_rate:
+            with self._lock:
+                self.failures += 1
+            return 503, {'error': 'Simulated failure of {}'.format(machine)}
+
+        if method == 'GET' and endpoint == 'health':
+            return 200, {'slots': ['Slot {} ({:016x})'.format(number, number) for number in range(1, self.slots + 1)]}
+        if method == 'POST' and endpoint == 'drop':
+            with self._lock:
+                self.drops += 1
+            return 200, {'message': 'Dropped slot {}'.format(body['slot'])}
+        return 404, {'error': 'Not found'}
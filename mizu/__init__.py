@@ -1,9 +1,12 @@
 import os
 import sys
 import json
+import time
+import uuid
 import logging
 
 from flask import Flask
+from flask import g
 from flask import jsonify
 from flask import request
 from flask import session
@@ -15,6 +18,7 @@ from flask_migrate import Migrate
 from csh_ldap import CSHLDAP
 
 from mizu import config
+from mizu import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -30,21 +34,21 @@ if os.path.exists(os.path.join(os.getcwd(), 'config.py')):
 
 app.secret_key = app.config['SECRET_KEY']
 
-if app.config['DEBUG']:
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
+from mizu.log import LogPipeline
 
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
-else:
-    logger.setLevel(logging.INFO)
+log_pipeline = LogPipeline(sys.stdout, app.config['LOG_FORMAT'], app.config['LOG_QUEUE_SIZE'])
+log_pipeline.install(logger, app.config['LOG_LEVEL'], app.config['LOG_LEVELS'])
+
+from mizu.http_client import HTTPClient
+
+http_client = HTTPClient(app.config['HTTP_POOL_CONNECTIONS'],
+                         app.config['HTTP_POOL_MAXSIZE'])
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+metrics.instrument_sqlalchemy()
+
 mock_db = None
 if os.path.exists(os.path.join(os.getcwd(), 'mock.json')):
     with open('mock.json', 'r') as f:
@@ -55,9 +59,84 @@ from mizu.models import Item
 from mizu.models import Slot
 from mizu.models import Temp
 from mizu.models import Log
+from mizu.models import CatalogVersion
+from mizu.models import TempRollup
+from mizu.models import RestockManifest
+from mizu.models import IdempotencyKey
+
+from mizu.drop_log import DropLogWriter
+
+drop_log = DropLogWriter(app.config['DROP_LOG_BATCH_SIZE'],
+                         app.config['DROP_LOG_FLUSH_INTERVAL'],
+                         app.config['DROP_LOG_QUEUE_SIZE'],
+                         app.config['DROP_LOG_SHUTDOWN_TIMEOUT'])
+
+from mizu.idempotency import IdempotencyStore
+
+drop_keys = IdempotencyStore(app.config['IDEMPOTENCY_CACHE_SIZE'],
+                             app.config['IDEMPOTENCY_TTL'],
+                             app.config['IDEMPOTENCY_PENDING_TIMEOUT'])
+
+from mizu.ldap_pool import LDAPPool
+
+ldap = LDAPPool(lambda: CSHLDAP(app.config['LDAP_BIND_DN'], app.config['LDAP_BIND_PW']),
+                app.config['LDAP_POOL_SIZE'],
+                app.config['LDAP_POOL_IDLE_CHECK'],
+                app.config['LDAP_POOL_TIMEOUT'])
+
+from mizu.directory import UserDirectory
+
+user_directory = UserDirectory(ldap,
+                               app.config['DIRECTORY_INTERVAL'],
+                               app.config['DIRECTORY_FULL_INTERVAL'],
+                               app.config['DIRECTORY_PAGE_SIZE'])
+
+from mizu.telemetry import TempRollupJob
+
+temp_rollup = TempRollupJob(app.config['TEMP_ROLLUP_INTERVAL'],
+                            app.config['TEMP_ROLLUP_LAG'],
+                            app.config['TEMP_RAW_RETENTION'],
+                            app.config['TEMP_MINUTE_RETENTION'])
+
+from mizu.events import EventBus
+from mizu.events import status_change_events
+
+event_bus = EventBus(app.config['EVENTS_HISTORY_SIZE'],
+                     app.config['EVENTS_QUEUE_SIZE'],
+                     app.config['EVENTS_MAX_SUBSCRIBERS'])
 
-ldap = CSHLDAP(app.config['LDAP_BIND_DN'],
-               app.config['LDAP_BIND_PW'])
+def _publish_status_change(machine_name, previous, entry):
+    """ Stream the changes the background status refresher sees to ``/events`` subscribers """
+    for event_type, data in status_change_events(machine_name, previous, entry):
+        event_bus.publish(event_type, data)
+
+from mizu.machines import MachinePoller
+from mizu.machines import StatusCache
+from mizu.machines import get_machine_status
+
+def _machine_names():
+    """ The names of every machine in the system, for the background status refresher """
+    with app.app_context():
+        return [name for name, in db.session.query(Machine.name).all()]
+
+machine_poller = MachinePoller(app.config['MACHINE_POLL_WORKERS'],
+                               app.config['MACHINE_POLL_BUDGET'])
+machine_status = StatusCache(machine_poller,
+                             get_machine_status,
+                             _machine_names,
+                             app.config['MACHINE_STATUS_INTERVAL'],
+                             on_change=_publish_status_change)
+
+from mizu.tracing import Tracer
+
+tracer = Tracer(app.config['TRACE_KEEP'],
+                app.config['TRACE_SLOW_THRESHOLD'],
+                app.config['TRACE_WINDOW'],
+                app.config['TRACE_MAX_SPANS'])
+
+metrics.MACHINE_ONLINE.collect = lambda: {
+    (name, ): 1 if entry['is_online'] else 0 for name, entry in machine_status.stats().items()
+}
 
 from mizu.auth import check_token
 
@@ -65,13 +144,36 @@ from mizu.drinks import drinks_bp
 from mizu.items import items_bp
 from mizu.users import users_bp
 from mizu.slots import slots_bp
+from mizu.status import status_bp
+from mizu.stream import stream_bp
+from mizu.logs import logs_bp
+from mizu.temps import temps_bp
 
 from mizu.data_adapters import SqlAlchemyAdapter, MockAdapter
 
+from mizu import stats
+
+stats.register('machine_status', machine_status.stats)
+stats.register('http_pools', http_client.stats)
+stats.register('ldap_pool', ldap.stats)
+stats.register('user_directory', user_directory.stats)
+stats.register('events', event_bus.stats)
+stats.register('drop_log', drop_log.stats)
+stats.register('temp_rollup', temp_rollup.stats)
+stats.register('drop_keys', drop_keys.stats)
+stats.register('traces', tracer.stats)
+stats.register('logging', log_pipeline.stats)
+
 app.register_blueprint(drinks_bp)
 app.register_blueprint(items_bp)
 app.register_blueprint(users_bp)
 app.register_blueprint(slots_bp)
+app.register_blueprint(status_bp)
+app.register_blueprint(stream_bp)
+app.register_blueprint(logs_bp)
+app.register_blueprint(temps_bp)
+
+from mizu import commands
 
 @app.route('/')
 def hello_world():
@@ -97,10 +199,35 @@ def handle_500(e):
 
     return jsonify(error), 500
 
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.request_id = _request_id()
+    tracer.start(g.request_id, request.method, request.path)
+
+@app.after_request
+def finish_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, response.status_code)
+    tracer.finish(response.status_code)
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
+def _request_id():
+    """ The ID of the current request - the caller's ``X-Request-ID`` if it is reasonable, or a new one """
+    request_id = request.headers.get('X-Request-ID', '')
+    if 0 < len(request_id) <= 64 and all(c.isalnum() or c in '-_.' for c in request_id):
+        return request_id
+    return uuid.uuid4().hex
+
 @app.after_request
 def allow_cors(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    response.headers['Access-Control-Allow-Headers'] = \
+        'Content-Type, Authorization, If-None-Match, Idempotency-Key, X-Request-ID'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag, Idempotent-Replayed, X-Request-ID'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE'
     return response
 
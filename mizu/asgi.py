@@ -0,0 +1,214 @@
+""" Mizu - asgi.py
+
+Serving Mizu from an ASGI server such as uvicorn, so that many concurrent requests - most of which are waiting on SSO,
+LDAP, or a drink machine - are cheap to hold open
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+logger = logging.getLogger(__name__)
+
+# Request bodies larger than this are buffered to disk
+MAX_MEMORY_BODY = 64 * 1024
+
+
+class ASGIBridge:
+    """ Serves a WSGI app to an ASGI server, running each request's handler on a pool of ``threads`` threads
+
+    The ASGI server's event loop accepts connections, reads request bodies, and writes responses, so slow clients and
+    idle keep-alive connections cost no threads. Handlers still make blocking calls (SQLAlchemy, LDAP, requests) and
+    run on the pool, so up to ``threads`` of them can wait on the network at once; more are queued rather than
+    rejected. Streamed responses (``/events``) are sent as they are produced, and stopped at their next chunk once the
+    client goes away. The WSGI environ's ``mizu.disconnected`` is a ``threading.Event`` set when that happens, for
+    streams that are idle between chunks to check.
+
+    Args:
+        wsgi_app (callable): the WSGI application to serve
+        threads (int): the most requests handled at once
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.active = 0
+        self.handled = 0
+        self.disconnects = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            # Only plain HTTP is served - turn away websockets
+            await send({'type': 'websocket.close'})
+            return
+
+        body = SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body', False):
+                    break
+            body.seek(0)
+
+            loop = asyncio.get_running_loop()
+            disconnected = threading.Event()
+            watcher = loop.create_task(self._watch_disconnect(receive, disconnected))
+            try:
+                await loop.run_in_executor(self._get_executor(), self._handle, scope, body, send, loop, disconnected)
+            finally:
+                watcher.cancel()
+        finally:
+            body.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threads': self.threads,
+                'active': self.active,
+                'handled': self.handled,
+                'disconnects': self.disconnects,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='mizu-asgi')
+            return self._executor
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._get_executor()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                with self._lock:
+                    executor, self._executor = self._executor, None
+                if executor is not None:
+                    executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _watch_disconnect(receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    def _handle(self, scope, body, send, loop, disconnected):
+        """ Run the WSGI app for one request on a pool thread, passing what it returns back to the event loop """
+        with self._lock:
+            self.active += 1
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('started', False):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        def start():
+            if not response.get('started', False):
+                emit({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                response['started'] = True
+
+        try:
+            environ = self._environ(scope, body)
+            environ['mizu.disconnected'] = disconnected
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        start()
+                        emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+                if disconnected.is_set():
+                    with self._lock:
+                        self.disconnects += 1
+                    return
+
+                start()
+                emit({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            logger.exception('Failed to serve %s %s', scope['method'], scope['path'])
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.handled += 1
+
+    @staticmethod
+    def _environ(scope, body):
+        """ Build the WSGI environ (PEP 3333) for an ASGI HTTP request """
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]) if server[1] is not None else '80',
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name == 'content-type':
+                key = 'CONTENT_TYPE'
+            elif name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+
+        return environ
@@ -1,18 +1,39 @@
+import logging
+import time
+
 from functools import wraps
 from flask import request, jsonify
 
-import requests
-
-from mizu import logger
 from mizu import app
+from mizu import stats
+from mizu import http_client
+from mizu import metrics
+from mizu import tracing
+from mizu.oidc import TokenVerifier, TokenError
+
+logger = logging.getLogger(__name__)
+
+token_verifier = TokenVerifier(app.config, http_client)
+stats.register('token_cache', token_verifier.stats)
+
+def check_token(admin_only=False, return_user_obj=False, trusted_only=False, allow_mock=False):
+    """ Require a trusted client's X-Auth-Token or a member's SSO bearer token
 
-def check_token(admin_only=False, return_user_obj=False):
+    Args:
+        admin_only (bool): only let drink admins (and trusted clients) through
+        return_user_obj (bool): pass the verified claims to the route as ``user``
+        trusted_only (bool): only let trusted clients through
+        allow_mock (bool): let any member through an ``admin_only`` route when ``?mock=true`` is passed. Only for routes
+            wrapped in ``get_adapter``, where ``mock`` switches them to the ``MockAdapter`` and nothing real is read or
+            changed
+    """
 
     def decorator(func):
         @wraps(func)
+        @tracing.traced('check_token')
         def wrapped_function(*args, **kwargs):
 
-            logger.debug('Begin handling request for {}'.format(request.host))
+            logger.debug('Begin handling request for %s', request.host)
             unauthorized = {
                 "error": "Could not authenticate user",
                 "errorCode": 401
@@ -33,30 +54,32 @@ def check_token(admin_only=False, return_user_obj=False):
                     return func(*args, **kwargs)
                 else:
                     return jsonify(key_unauthorized), 401
+            elif trusted_only:
+                logger.debug('Trusted client unauthorized with no X-Auth-Token')
+                return jsonify(key_unauthorized), 401
 
-            # Otherwise, validate JWT against SSO
+            # Otherwise, verify the JWT issued by SSO
             token = request.headers.get('Authorization', None)
             if token is None:
                 logger.debug('User unauthorized with no Bearer token')
                 return jsonify(unauthorized), 401
 
-            headers = {
-                "Authorization": token
-            }
-
-            endpoint = 'https://sso.csh.rit.edu/auth/realms/csh/protocol/openid-connect/userinfo'
-
-            verify_response = requests.get(endpoint, headers=headers)
+            scheme, _, bearer = token.partition(' ')
+            if scheme.lower() != 'bearer' or not bearer:
+                logger.debug('User unauthorized with a malformed Authorization header')
+                return jsonify(unauthorized), 401
 
+            start = time.perf_counter()
             try:
-                verify_response.raise_for_status()
-            except requests.exceptions.HTTPError:
-                logger.debug('Unable to verify Bearer token against provider')
+                with tracing.span('sso_verify'):
+                    verify_body = token_verifier.verify(bearer)
+            except TokenError as e:
+                metrics.SSO_VERIFY_SECONDS.observe(time.perf_counter() - start, 'rejected')
+                logger.debug('Unable to verify Bearer token: %s', e)
                 return jsonify(unauthorized), 401
-            
-            verify_body = verify_response.json()
+            metrics.SSO_VERIFY_SECONDS.observe(time.perf_counter() - start, 'verified')
 
-            mock = request.args.get('mock', False)
+            mock = allow_mock and request.args.get('mock', False)
             if isinstance(mock, str):
                 mock = mock.lower().startswith('t')
 
@@ -64,7 +87,7 @@ def check_token(admin_only=False, return_user_obj=False):
                 if not 'drink' in verify_body['groups']:
                     return jsonify(permissions), 401
 
-            logger.debug('Successfully authenticated user {}'.format(verify_body['preferred_username']))
+            logger.debug('Successfully authenticated user %s', verify_body['preferred_username'])
             if return_user_obj:
                 return func(*args, user=verify_body, **kwargs)
 
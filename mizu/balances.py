@@ -0,0 +1,170 @@
+""" Mizu - balances.py
+
+Reading and writing member drink balances in LDAP, in as few directory round trips as possible
+
+Members are read with a single search for exactly the attributes needed, rather than through ``CSHMember`` (which makes
+a round trip per attribute). Balances are written with a single compare-and-swap style modify - the old value is
+deleted and the new value added in one operation - so a concurrent change makes the write fail cleanly with
+``BalanceConflict`` instead of being silently overwritten.
+"""
+
+import logging
+import ldap
+import ldap.filter
+
+from mizu import ldap as _ldap
+from mizu import metrics
+from mizu import tracing
+from mizu import user_directory
+
+logger = logging.getLogger(__name__)
+
+USERS_BASE = 'cn=users,cn=accounts,dc=csh,dc=rit,dc=edu'
+
+# How many times a balance write is re-attempted against a freshly read balance after losing a race
+MAX_SWAP_ATTEMPTS = 3
+
+
+class BalanceConflict(Exception):
+    """ Raised when a member's balance changed between being read and being written """
+    pass
+
+
+def get_member(uid):
+    """ Get the uid, cn, and drinkBalance of the member with the provided uid, in one search
+
+    Returns:
+        dict: ``{'uid', 'cn', 'drinkBalance'}``, with the balance as an ``int``
+
+    Raises:
+        KeyError: if no member has the provided uid
+    """
+    return _ldap.call(_read_member, uid)
+
+
+def get_member_by_ibutton(ibutton):
+    """ Get the uid, cn, and drinkBalance of the member with the provided iButton, in one search
+
+    Raises:
+        KeyError: if no member has the provided iButton
+    """
+    return _ldap.call(_read_member, ibutton, attribute='ibutton')
+
+
+def get_balance(uid):
+    """ Get the drinkBalance of the member with the provided uid
+
+    Raises:
+        KeyError: if no member has the provided uid
+    """
+    return get_member(uid)['drinkBalance']
+
+
+def set_balance(uid, balance):
+    """ Set a member's balance, regardless of its current value
+
+    Returns:
+        tuple: the ``(old, new)`` balances
+
+    Raises:
+        KeyError: if no member has the provided uid
+        BalanceConflict: if the balance kept changing underneath us
+    """
+    balance = int(balance)
+
+    for attempt in range(MAX_SWAP_ATTEMPTS):
+        old_balance = get_balance(uid)
+        try:
+            _swap_balance(uid, old_balance, balance)
+        except BalanceConflict:
+            logger.debug('Balance for %s changed while being set, retrying', uid)
+            continue
+
+        user_directory.update_balance(uid, balance)
+        return old_balance, balance
+
+    raise BalanceConflict('The balance for {} changed {} times while being set'.format(uid, MAX_SWAP_ATTEMPTS))
+
+
+def debit(uid, amount, expected_balance):
+    """ Take ``amount`` credits from a member whose balance was last read as ``expected_balance``
+
+    If the balance has changed since it was read, it is read again and the debit re-applied to the new value.
+
+    Returns:
+        int: the new balance
+
+    Raises:
+        KeyError: if no member has the provided uid
+        BalanceConflict: if the balance kept changing underneath us
+    """
+    old_balance = expected_balance
+    for attempt in range(MAX_SWAP_ATTEMPTS):
+        new_balance = old_balance - amount
+        try:
+            _swap_balance(uid, old_balance, new_balance)
+        except BalanceConflict:
+            logger.debug('Balance for %s changed before it could be debited, retrying', uid)
+            old_balance = get_balance(uid)
+            continue
+
+        user_directory.update_balance(uid, new_balance)
+        return new_balance
+
+    raise BalanceConflict('The balance for {} changed {} times while being debited'.format(uid, MAX_SWAP_ATTEMPTS))
+
+
+###############################################################################
+# LDAP operations
+
+def _dn(uid):
+    return 'uid={},{}'.format(uid, USERS_BASE)
+
+
+@tracing.traced('ldap.read_member')
+@metrics.LDAP_SECONDS.time('read_member')
+def _read_member(lib, value, attribute='uid'):
+    results = lib.get_con().search_s(USERS_BASE,
+                                     ldap.SCOPE_SUBTREE,
+                                     '({}={})'.format(attribute, ldap.filter.escape_filter_chars(value)),
+                                     ['uid', 'cn', 'drinkBalance'])
+    if not results:
+        raise KeyError('The requested {} does not belong to any user'.format(attribute))
+
+    attrs = results[0][1]
+    return {
+        'uid': attrs['uid'][0].decode('utf-8'),
+        'cn': attrs['cn'][0].decode('utf-8'),
+        'drinkBalance': int(attrs.get('drinkBalance', [b'0'])[0].decode('utf-8')),
+    }
+
+
+@tracing.traced('ldap.swap_balance')
+def _swap_balance(uid, old_balance, new_balance):
+    """ Replace ``old_balance`` with ``new_balance``, failing if the stored balance is no longer ``old_balance``
+
+    Unlike reads this is deliberately not retried on a lost connection - the first attempt may have been applied, and
+    retrying it would look like a conflict and charge the member twice.
+    """
+    modlist = [
+        (ldap.MOD_DELETE, 'drinkBalance', [str(old_balance).encode('utf-8')]),
+        (ldap.MOD_ADD, 'drinkBalance', [str(new_balance).encode('utf-8')]),
+    ]
+
+    with _ldap.connection() as lib, metrics.LDAP_SECONDS.time('swap_balance'):
+        con = lib.get_con()
+        try:
+            con.modify_s(_dn(uid), modlist)
+            return
+        except ldap.NO_SUCH_ATTRIBUTE:
+            if old_balance != 0:
+                raise BalanceConflict('The balance for {} is no longer {}'.format(uid, old_balance))
+        except ldap.NO_SUCH_OBJECT:
+            raise KeyError('The requested uid does not belong to any user')
+
+        # Members who have never had a balance read as 0, but have no value to delete. If a balance was stored since,
+        # adding another to the single valued drinkBalance is a constraint violation rather than an existing value
+        try:
+            con.modify_s(_dn(uid), modlist[1:])
+        except (ldap.TYPE_OR_VALUE_EXISTS, ldap.CONSTRAINT_VIOLATION):
+            raise BalanceConflict('The balance for {} is no longer {}'.format(uid, old_balance))
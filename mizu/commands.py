@@ -0,0 +1,42 @@
+""" Mizu - commands.py
+
+Flask CLI commands, run with ``flask <command>`` alongside Flask-Migrate's ``flask db``
+"""
+
+import json
+
+import click
+
+from mizu import app
+from mizu.restock import apply_manifest, parse_csv, ManifestError
+
+
+@app.cli.command('restock')
+@click.argument('manifest', type=click.File('r'))
+@click.option('--id', 'manifest_id', help='The manifest ID, for CSV manifests')
+@click.option('--machine', help='The machine name, for CSV manifests')
+def restock(manifest, manifest_id, machine):
+    """ Apply a restock manifest from a JSON or CSV file
+
+    JSON manifests carry their own ID and machine, CSV manifests need --id and --machine.
+    """
+    text = manifest.read()
+    try:
+        if manifest.name.lower().endswith('.csv'):
+            entries = parse_csv(text)
+        else:
+            body = json.loads(text)
+            if not isinstance(body, dict):
+                raise ManifestError('A JSON manifest must be an object')
+            manifest_id = manifest_id or body.get('id')
+            machine = machine or body.get('machine')
+            entries = body.get('slots')
+
+        applied, count = apply_manifest(manifest_id, machine, entries)
+    except (ManifestError, json.JSONDecodeError) as e:
+        raise click.ClickException(str(e))
+
+    if applied:
+        click.echo('Restocked {} slots in {} from manifest {}'.format(count, machine, manifest_id))
+    else:
+        click.echo('Manifest {} was already applied to {} slots, nothing was changed'.format(manifest_id, count))
@@ -0,0 +1,50 @@
+""" Mizu - conditional.py
+
+Conditional GET support - ETags and ``If-None-Match`` handling for routes whose responses can be versioned
+"""
+
+import hashlib
+
+from functools import wraps
+
+from flask import request, make_response
+
+
+def make_etag(*parts):
+    """ Build an (unquoted) ETag from the values a response was rendered from """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def conditional(etag_func, cache_control, weak=False):
+    """ Answer ``If-None-Match`` requests with a 304 before the route does any work
+
+    ``etag_func`` is called with the same arguments as the route, and must return the ETag the route's response would
+    have without rendering it - ``None`` turns conditional handling off for that request. This should sit below
+    ``check_token``, so unauthenticated clients can't probe for changes. ``If-None-Match`` is matched with the weak
+    comparison RFC 7232 requires, so clients get a 304 whether they send the tag back weak or strong.
+
+    Args:
+        etag_func (callable): computes the ETag for a request
+        cache_control (str): the ``Cache-Control`` header to send with successful and 304 responses
+        weak (bool): send the ETag as weak, for responses whose tag leaves out details that don't change their meaning
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            etag = etag_func(*args, **kwargs)
+            if etag is None:
+                return func(*args, **kwargs)
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=weak)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapped_function
+    return decorator
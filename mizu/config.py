@@ -9,15 +9,118 @@ IP = env.get('MIZU_IP', '0.0.0.0')
 PORT = env.get('MIZU_PORT', 8080)
 SECRET_KEY = env.get('MIZU_SECRET_KEY', default=''.join(secrets.token_hex(16)))
 
+# Logs are written as LOG_FORMAT ('text' or 'json') lines to stdout by a background thread, which drops records once
+# LOG_QUEUE_SIZE are waiting. LOG_LEVELS sets the level of individual modules, e.g.
+# 'mizu.drinks=DEBUG,mizu.oidc=WARNING'
+LOG_FORMAT = env.get('MIZU_LOG_FORMAT', 'text')
+LOG_LEVEL = env.get('MIZU_LOG_LEVEL', 'DEBUG' if DEBUG else 'INFO').upper()
+LOG_LEVELS = dict(entry.split('=', 1) for entry in env.get('MIZU_LOG_LEVELS', '').split(',') if '=' in entry)
+LOG_QUEUE_SIZE = int(env.get('MIZU_LOG_QUEUE_SIZE', 10000))
+
+# Outbound HTTP - connections are kept alive and pooled per host, at most HTTP_POOL_MAXSIZE idle connections per host
+HTTP_POOL_CONNECTIONS = int(env.get('MIZU_HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = int(env.get('MIZU_HTTP_POOL_MAXSIZE', 10))
+# /metrics requires 'Authorization: Bearer <METRICS_TOKEN>' when METRICS_TOKEN is set, for Prometheus to scrape with
+METRICS_TOKEN = env.get('MIZU_METRICS_TOKEN', None)
+# Every request is traced. Requests taking TRACE_SLOW_THRESHOLD seconds or longer are logged with their trace, and the
+# TRACE_KEEP slowest of the last TRACE_WINDOW seconds are kept for /status/traces. A trace records at most
+# TRACE_MAX_SPANS spans
+TRACE_SLOW_THRESHOLD = float(env.get('MIZU_TRACE_SLOW_THRESHOLD', 1))
+TRACE_KEEP = int(env.get('MIZU_TRACE_KEEP', 20))
+TRACE_WINDOW = float(env.get('MIZU_TRACE_WINDOW', 3600))
+TRACE_MAX_SPANS = int(env.get('MIZU_TRACE_MAX_SPANS', 200))
+# Under an ASGI server (asgi.py), at most ASGI_THREADS requests are handled at once, and the rest wait in a queue
+ASGI_THREADS = int(env.get('MIZU_ASGI_THREADS', 32))
+
 SQLALCHEMY_DATABASE_URI = env.get('MIZU_DATABASE_URI', 'sqlite:///{}'.format(os.path.join(os.getcwd(), 'data.db')))
+# Each worker serves the catalog from memory, checking at most every CATALOG_CHECK_INTERVAL seconds whether another
+# worker has changed it
+CATALOG_CHECK_INTERVAL = float(env.get('MIZU_CATALOG_CHECK_INTERVAL', 1))
+# Drops are logged in batches of up to DROP_LOG_BATCH_SIZE, at most DROP_LOG_FLUSH_INTERVAL seconds after they happen.
+# Up to DROP_LOG_QUEUE_SIZE records wait to be written, and as many again are held for retrying while the database is
+# down - past that, drops are not logged
+DROP_LOG_BATCH_SIZE = int(env.get('MIZU_DROP_LOG_BATCH_SIZE', 50))
+DROP_LOG_FLUSH_INTERVAL = float(env.get('MIZU_DROP_LOG_FLUSH_INTERVAL', 1))
+DROP_LOG_QUEUE_SIZE = int(env.get('MIZU_DROP_LOG_QUEUE_SIZE', 1000))
+DROP_LOG_SHUTDOWN_TIMEOUT = float(env.get('MIZU_DROP_LOG_SHUTDOWN_TIMEOUT', 10))
+# Machines upload temperatures in batches of up to TEMP_MAX_BATCH samples, roughly one every TEMP_SAMPLE_INTERVAL
+# seconds. Every TEMP_ROLLUP_INTERVAL seconds they are rolled up into minute and hour averages, re-aggregating the last
+# TEMP_ROLLUP_LAG seconds to pick up late uploads. Raw samples are kept for TEMP_RAW_RETENTION days, minute averages for
+# TEMP_MINUTE_RETENTION days, and charts are served at the finest resolution that fits in TEMP_MAX_POINTS points
+TEMP_MAX_BATCH = int(env.get('MIZU_TEMP_MAX_BATCH', 1000))
+TEMP_SAMPLE_INTERVAL = float(env.get('MIZU_TEMP_SAMPLE_INTERVAL', 30))
+TEMP_ROLLUP_INTERVAL = float(env.get('MIZU_TEMP_ROLLUP_INTERVAL', 60))
+TEMP_ROLLUP_LAG = float(env.get('MIZU_TEMP_ROLLUP_LAG', 600))
+TEMP_RAW_RETENTION = float(env.get('MIZU_TEMP_RAW_RETENTION', 7))
+TEMP_MINUTE_RETENTION = float(env.get('MIZU_TEMP_MINUTE_RETENTION', 90))
+TEMP_MAX_POINTS = int(env.get('MIZU_TEMP_MAX_POINTS', 1500))
+# Cache-Control sent alongside the ETags on /items and /drinks. Machine status changes underneath /drinks, so clients
+# should always revalidate it
+ITEMS_CACHE_CONTROL = env.get('MIZU_ITEMS_CACHE_CONTROL', 'private, max-age=30')
+DRINKS_CACHE_CONTROL = env.get('MIZU_DRINKS_CACHE_CONTROL', 'private, no-cache')
 
 OIDC_ISSUER = env.get('MIZU_OIDC_ISSUER', 'https://sso.csh.rit.edu/auth/realms/csh')
 OIDC_CLIENT_ID = env.get('MIZU_OIDC_CLIENT_ID', 'drink')
 OIDC_CLIENT_SECRET = env.get('MIZU_OIDC_CLIENT_SECRET', '')
+# 'jwks' verifies bearer tokens locally against the issuer's signing keys, 'userinfo' asks the provider on every request
+OIDC_VERIFY_MODE = env.get('MIZU_OIDC_VERIFY_MODE', 'jwks').lower()
+# Bearer tokens must be access tokens issued to (``azp``) or for (``aud``) OIDC_AUDIENCE. Set it to '' to accept access
+# tokens issued to any client of the realm
+OIDC_AUDIENCE = env.get('MIZU_OIDC_AUDIENCE', OIDC_CLIENT_ID)
+OIDC_LEEWAY = int(env.get('MIZU_OIDC_LEEWAY', 30))
+OIDC_JWKS_TTL = int(env.get('MIZU_OIDC_JWKS_TTL', 3600))
+OIDC_TOKEN_CACHE_SIZE = int(env.get('MIZU_OIDC_TOKEN_CACHE_SIZE', 1024))
+OIDC_CONNECT_TIMEOUT = float(env.get('MIZU_OIDC_CONNECT_TIMEOUT', 2))
+OIDC_READ_TIMEOUT = float(env.get('MIZU_OIDC_READ_TIMEOUT', 5))
 
 LDAP_BIND_DN = env.get('MIZU_BIND_DN',
 'krbprincipalname=drink/drink.csh.rit.edu@CSH.RIT.EDU,cn=services,cn=accounts,dc=csh,dc=rit,dc=edu')
 LDAP_BIND_PW = env.get('MIZU_BIND_PW', '')
+# Connections are bound lazily, up to LDAP_POOL_SIZE per worker. Those idle for LDAP_POOL_IDLE_CHECK seconds are checked
+# before reuse, and a request waits at most LDAP_POOL_TIMEOUT seconds for a free connection
+LDAP_POOL_SIZE = int(env.get('MIZU_LDAP_POOL_SIZE', 4))
+LDAP_POOL_IDLE_CHECK = float(env.get('MIZU_LDAP_POOL_IDLE_CHECK', 60))
+LDAP_POOL_TIMEOUT = float(env.get('MIZU_LDAP_POOL_TIMEOUT', 5))
+# The in-memory user directory (and its iButton index) picks up modified members every DIRECTORY_INTERVAL seconds, and
+# reloads everyone every DIRECTORY_FULL_INTERVAL seconds to notice removals
+DIRECTORY_INTERVAL = float(env.get('MIZU_DIRECTORY_INTERVAL', 30))
+DIRECTORY_FULL_INTERVAL = float(env.get('MIZU_DIRECTORY_FULL_INTERVAL', 3600))
+DIRECTORY_PAGE_SIZE = int(env.get('MIZU_DIRECTORY_PAGE_SIZE', 500))
 
 MACHINE_API_TOKEN = env.get('MIZU_MACHINE_API_TOKEN', '')
+# Where machines are reached, with {} replaced by the machine's name
+MACHINE_URL = env.get('MIZU_MACHINE_URL', 'https://{}.csh.rit.edu')
+
+# Machine polling - calls to machines run on a shared pool, and a listing waits at most MACHINE_POLL_BUDGET seconds
+MACHINE_CONNECT_TIMEOUT = float(env.get('MIZU_MACHINE_CONNECT_TIMEOUT', 2))
+MACHINE_READ_TIMEOUT = float(env.get('MIZU_MACHINE_READ_TIMEOUT', 5))
+MACHINE_POLL_WORKERS = int(env.get('MIZU_MACHINE_POLL_WORKERS', 8))
+MACHINE_POLL_BUDGET = float(env.get('MIZU_MACHINE_POLL_BUDGET', 5))
+
+# Machine status is cached and refreshed in the background every MACHINE_STATUS_INTERVAL seconds. A drop polls the
+# machine again first if its cached status is older than MACHINE_STATUS_DROP_MAX_AGE seconds
+MACHINE_STATUS_INTERVAL = float(env.get('MIZU_MACHINE_STATUS_INTERVAL', 10))
+MACHINE_STATUS_DROP_MAX_AGE = float(env.get('MIZU_MACHINE_STATUS_DROP_MAX_AGE', 2))
+
+# A machine's circuit opens after MACHINE_BREAKER_FAILURES consecutive failures, and is probed again after a backoff
+# starting at MACHINE_BREAKER_BACKOFF seconds, doubling on every failed probe up to MACHINE_BREAKER_MAX_BACKOFF
+MACHINE_BREAKER_FAILURES = int(env.get('MIZU_MACHINE_BREAKER_FAILURES', 3))
+MACHINE_BREAKER_BACKOFF = float(env.get('MIZU_MACHINE_BREAKER_BACKOFF', 5))
+MACHINE_BREAKER_MAX_BACKOFF = float(env.get('MIZU_MACHINE_BREAKER_MAX_BACKOFF', 300))
+
+# /events keeps the last EVENTS_HISTORY_SIZE events for clients resuming with Last-Event-ID. A client more than
+# EVENTS_QUEUE_SIZE events behind is disconnected, and streams are closed after EVENTS_MAX_DURATION seconds so clients
+# reconnect and resume
+EVENTS_HISTORY_SIZE = int(env.get('MIZU_EVENTS_HISTORY_SIZE', 1000))
+EVENTS_QUEUE_SIZE = int(env.get('MIZU_EVENTS_QUEUE_SIZE', 100))
+EVENTS_MAX_SUBSCRIBERS = int(env.get('MIZU_EVENTS_MAX_SUBSCRIBERS', 24))
+EVENTS_KEEPALIVE = float(env.get('MIZU_EVENTS_KEEPALIVE', 15))
+EVENTS_MAX_DURATION = float(env.get('MIZU_EVENTS_MAX_DURATION', 300))
+EVENTS_RETRY = int(env.get('MIZU_EVENTS_RETRY', 3000))
 
+# Responses to drops with an Idempotency-Key are replayed to retries for IDEMPOTENCY_TTL seconds. The last
+# IDEMPOTENCY_CACHE_SIZE are kept in memory, and a key whose request never finished is freed after
+# IDEMPOTENCY_PENDING_TIMEOUT seconds
+IDEMPOTENCY_TTL = float(env.get('MIZU_IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_CACHE_SIZE = int(env.get('MIZU_IDEMPOTENCY_CACHE_SIZE', 1000))
+IDEMPOTENCY_PENDING_TIMEOUT = float(env.get('MIZU_IDEMPOTENCY_PENDING_TIMEOUT', 120))
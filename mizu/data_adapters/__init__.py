@@ -1,5 +1,5 @@
 from .data_adapter_abc import DataAdapterABC
-from .sqlalchemy_adapter import SqlAlchemyAdapter
+from .sqlalchemy_adapter import SqlAlchemyAdapter, catalog_cache
 from .mock_adapter import MockAdapter
 from .get_adapter import get_adapter
 
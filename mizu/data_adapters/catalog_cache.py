@@ -0,0 +1,164 @@
+""" Mizu - data_adapters/catalog_cache.py
+
+A versioned, in-process copy of the catalog (machines, slots, and items) for the SQL Alchemy adapter
+"""
+
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from mizu import db
+
+from mizu.models import CatalogVersion
+from mizu.models import Item
+from mizu.models import Machine
+from mizu.models import Slot
+
+
+class CatalogSnapshot:
+    """ An immutable view of the whole catalog at one version, with every row already serialized """
+
+    def __init__(self, version, machines, items, slots):
+        self.version = version
+        self.machines = [CatalogSnapshot._serialize_machine(machine) for machine in machines]
+        self.items = [CatalogSnapshot._serialize_item(item) for item in items]
+
+        self.machines_by_name = {machine['name']: machine for machine in self.machines}
+        self.items_by_id = {item['id']: item for item in self.items}
+
+        # Slots whose item has gone missing are left out, as they always have been
+        names = {machine['id']: machine['name'] for machine in self.machines}
+        self.slots_by_machine = {machine['name']: [] for machine in self.machines}
+        for slot in sorted(slots, key=lambda slot: slot.number):
+            if slot.item in self.items_by_id and slot.machine in names:
+                serialized = CatalogSnapshot._serialize_slot(slot)
+                serialized['item'] = self.items_by_id[slot.item]
+                self.slots_by_machine[names[slot.machine]].append(serialized)
+
+    @staticmethod
+    def _serialize_item(item):
+        return {
+            'id': item.id,
+            'name': item.name,
+            'price': item.price
+        }
+
+    @staticmethod
+    def _serialize_machine(machine):
+        return {
+            'id': machine.id,
+            'name': machine.name,
+            'display_name': machine.display_name
+        }
+
+    @staticmethod
+    def _serialize_slot(slot):
+        return {
+            'machine': slot.machine,
+            'number': slot.number,
+            'item': slot.item,
+            'active': slot.active,
+            'count': slot.count
+        }
+
+
+class CatalogCache:
+    """ Serves the catalog from memory, reloading it only when it has changed
+
+    Every write to the catalog calls ``mark_changed`` in the same transaction, which bumps the single row in the
+    ``catalog_version`` table. Each worker compares its snapshot's version against that row at most once every
+    ``check_interval`` seconds, so a change made by one gunicorn worker is picked up by the others within that interval.
+    The worker that made the change drops its snapshot as soon as the transaction commits.
+
+    Args:
+        check_interval (float): the longest a worker will serve a snapshot without checking the version
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+
+        self._snapshot = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.reloads = 0
+        self.version_checks = 0
+
+    def snapshot(self):
+        """ The current catalog, reloaded from the database if it has changed
+
+        Returns:
+            CatalogSnapshot: this must be treated as read only, copy anything that will be modified
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            fresh = snapshot is not None and time.time() - self._checked_at < self.check_interval
+
+        if fresh:
+            self.hits += 1
+            return snapshot
+
+        version = self._current_version()
+        self.version_checks += 1
+
+        if snapshot is None or snapshot.version != version:
+            snapshot = CatalogSnapshot(version,
+                                       db.session.query(Machine).all(),
+                                       db.session.query(Item).all(),
+                                       db.session.query(Slot).all())
+            self.reloads += 1
+
+        with self._lock:
+            self._snapshot = snapshot
+            self._checked_at = time.time()
+
+        return snapshot
+
+    def mark_changed(self):
+        """ Record that the catalog has changed. This must be called in the transaction making the change, before it
+        is committed.
+        """
+        updated = db.session.query(CatalogVersion).filter(CatalogVersion.id == 1).\
+            update({CatalogVersion.version: CatalogVersion.version + 1}, synchronize_session=False)
+        if updated < 1:
+            db.session.add(CatalogVersion(1, 1))
+
+        db.session.info.setdefault('catalog_caches', set()).add(self)
+
+    def invalidate(self):
+        """ Drop this worker's snapshot, so the next read reloads it """
+        with self._lock:
+            self._snapshot = None
+
+    def stats(self):
+        with self._lock:
+            snapshot = self._snapshot
+
+        return {
+            'version': snapshot.version if snapshot is not None else None,
+            'hits': self.hits,
+            'version_checks': self.version_checks,
+            'reloads': self.reloads,
+        }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    @staticmethod
+    def _current_version():
+        version = db.session.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar()
+        return version if version is not None else 0
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_on_commit(session):
+    for cache in session.info.pop('catalog_caches', ()):
+        cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    session.info.pop('catalog_caches', None)
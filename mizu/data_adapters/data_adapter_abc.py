@@ -44,6 +44,18 @@ class DataAdapterABC(ABC):
         """ Update the name and/or price of the item with the provided ID """
         pass
 
+    @staticmethod
+    @abstractmethod
+    def find_items(item_ids):
+        """ Get the items with the provided IDs, keyed by ID, leaving out those that don't exist """
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def apply_item_batch(creates, updates, deletes):
+        """ Create, update, and delete many items at once, returning the created items """
+        pass
+
     @staticmethod
     @abstractmethod
     def get_slots_in_machine(machine_name):
@@ -1,6 +1,7 @@
 from functools import wraps
 from flask import request
 
+from mizu import tracing
 from mizu.data_adapters import SqlAlchemyAdapter
 from mizu.data_adapters import MockAdapter
 
@@ -12,8 +13,10 @@ def get_adapter(func):
             mock = mock.lower().startswith('t')
 
         if mock:
-            return func(MockAdapter, *args, **kwargs)
+            with tracing.span('get_adapter', adapter='mock'):
+                return func(MockAdapter, *args, **kwargs)
         else:
-            return func(SqlAlchemyAdapter, *args, **kwargs)
+            with tracing.span('get_adapter', adapter='sqlalchemy'):
+                return func(SqlAlchemyAdapter, *args, **kwargs)
     return wrapped_function
 
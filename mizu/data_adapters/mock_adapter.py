@@ -93,6 +93,23 @@ class MockAdapter(DataAdapterABC):
 
         return mock_db['Items'][update_idx]
 
+    @staticmethod
+    @check_dataset
+    def find_items(item_ids):
+        item_ids = set(item_ids)
+        return {item['id']: item for item in mock_db['Items'] if item['id'] in item_ids}
+
+    @staticmethod
+    @check_dataset
+    def apply_item_batch(creates, updates, deletes):
+        created = [MockAdapter.create_item(create['name'], create['price']) for create in creates]
+        for update in updates:
+            MockAdapter.update_item(update['id'], update.get('name'), update.get('price'))
+        for item_id in deletes:
+            MockAdapter.delete_item(item_id)
+
+        return created
+
     @staticmethod
     @check_dataset
     def get_slots_in_machine(machine_name):
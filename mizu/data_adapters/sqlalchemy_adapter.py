@@ -1,6 +1,10 @@
 from . import DataAdapterABC
+from .catalog_cache import CatalogCache
 
+from mizu import app
 from mizu import db
+from mizu import stats
+from mizu import event_bus
 
 from mizu.models import Item
 from mizu.models import Machine
@@ -8,7 +12,12 @@ from mizu.models import Slot
 
 from sqlalchemy import orm
 
+catalog_cache = CatalogCache(app.config['CATALOG_CHECK_INTERVAL'])
+stats.register('catalog_cache', catalog_cache.stats)
+
 class SqlAlchemyAdapter(DataAdapterABC):
+    """ Reads are served from the in-process ``catalog_cache``, writes go to the database and mark the catalog changed
+    """
 
     @staticmethod
     def get_machine(machine_name):
@@ -18,11 +27,11 @@ class SqlAlchemyAdapter(DataAdapterABC):
             dict: a ``mizu.models.Machine`` object serialized as a python dict/json, or ``None`` if no
                 such machine can be found
         """
-        machine = SqlAlchemyAdapter._get_machine(machine_name)
+        machine = catalog_cache.snapshot().machines_by_name.get(machine_name)
         if machine is None:
             return machine
         else:
-            return SqlAlchemyAdapter._serialize_machine(machine)
+            return dict(machine)
 
     @staticmethod
     def get_machines():
@@ -31,12 +40,7 @@ class SqlAlchemyAdapter(DataAdapterABC):
         Returns:
             list: a list of ``Machine`` objects serialized as json
         """
-        machines = db.session.query(Machine).all()
-        list_machines = []
-        for machine in machines:
-            list_machines.append(SqlAlchemyAdapter._serialize_machine(machine))
-
-        return list_machines
+        return [dict(machine) for machine in catalog_cache.snapshot().machines]
 
     @staticmethod
     def get_items():
@@ -45,12 +49,7 @@ class SqlAlchemyAdapter(DataAdapterABC):
         Returns:
             list: a list of ``Item`` objects serialized as json
         """
-        db_items = db.session.query(Item).all()
-        list_items = []
-        for item in db_items:
-            list_items.append(SqlAlchemyAdapter._serialize_item(item))
-
-        return list_items
+        return [dict(item) for item in catalog_cache.snapshot().items]
 
     @staticmethod
     def get_item(item_id):
@@ -59,11 +58,11 @@ class SqlAlchemyAdapter(DataAdapterABC):
         Returns:
             dict: the ``item`` serialized to json, ``None`` if no item was found
         """
-        item = SqlAlchemyAdapter._get_item(item_id)
+        item = catalog_cache.snapshot().items_by_id.get(item_id)
         if item is None:
             return item
         else:
-            return SqlAlchemyAdapter._serialize_item(item)
+            return dict(item)
 
     @staticmethod
     def create_item(item_name, item_price):
@@ -74,9 +73,14 @@ class SqlAlchemyAdapter(DataAdapterABC):
         """
         new_item = Item(name=item_name, price=item_price)
         db.session.add(new_item)
+        db.session.flush()
+
+        serialized = SqlAlchemyAdapter._serialize_item(new_item)
+        catalog_cache.mark_changed()
+        event_bus.publish_on_commit(db.session, 'item', {'action': 'created', 'item': serialized})
         db.session.commit()
 
-        return SqlAlchemyAdapter._serialize_item(new_item)
+        return serialized
 
     @staticmethod
     def delete_item(item_id):
@@ -89,6 +93,8 @@ class SqlAlchemyAdapter(DataAdapterABC):
         if item is None:
             return False
         db.session.delete(item)
+        catalog_cache.mark_changed()
+        event_bus.publish_on_commit(db.session, 'item', {'action': 'deleted', 'item': {'id': item_id}})
         db.session.commit()
         return True
 
@@ -115,9 +121,60 @@ class SqlAlchemyAdapter(DataAdapterABC):
 
         item = db.session.query(Item).filter(Item.id == item_id).\
                   update(updates, synchronize_session=False)
+        catalog_cache.mark_changed()
         db.session.commit()
 
-        return SqlAlchemyAdapter.get_item(item_id)
+        item = SqlAlchemyAdapter.get_item(item_id)
+        event_bus.publish('item', {'action': 'updated', 'item': item})
+        return item
+
+    @staticmethod
+    def find_items(item_ids):
+        """ Query for the items with the provided IDs in one query, bypassing the catalog cache
+
+        Returns:
+            dict: item ID -> the ``Item`` serialized as json, for each ID that belongs to an item
+        """
+        if not item_ids:
+            return {}
+
+        items = db.session.query(Item).filter(Item.id.in_(set(item_ids))).all()
+        return {item.id: SqlAlchemyAdapter._serialize_item(item) for item in items}
+
+    @staticmethod
+    def apply_item_batch(creates, updates, deletes):
+        """ Create, update, and delete many items in a single transaction
+
+        Args:
+            creates (list): ``{'name', 'price'}`` dicts for new items
+            updates (list): ``{'id', 'name', 'price'}`` dicts, where either of name and price may be left out
+            deletes (list): the IDs of items to delete
+
+        Returns:
+            list: the created items serialized as json, in the order they were provided
+        """
+        new_items = [Item(name=create['name'], price=create['price']) for create in creates]
+        db.session.add_all(new_items)
+
+        if updates:
+            db.session.bulk_update_mappings(Item, updates)
+        if deletes:
+            db.session.query(Item).filter(Item.id.in_(deletes)).delete(synchronize_session=False)
+
+        db.session.flush()
+        created = [SqlAlchemyAdapter._serialize_item(item) for item in new_items]
+
+        for item in created:
+            event_bus.publish_on_commit(db.session, 'item', {'action': 'created', 'item': item})
+        for update in updates:
+            event_bus.publish_on_commit(db.session, 'item', {'action': 'updated', 'item': dict(update)})
+        for item_id in deletes:
+            event_bus.publish_on_commit(db.session, 'item', {'action': 'deleted', 'item': {'id': item_id}})
+
+        catalog_cache.mark_changed()
+        db.session.commit()
+
+        return created
 
     @staticmethod
     def get_slots_in_machine(machine_name):
@@ -133,21 +190,8 @@ class SqlAlchemyAdapter(DataAdapterABC):
             ValueError: If the machine name provided does not correspond to any kown machine
         """
 
-        results = db.session.query(Machine, Slot, Item).\
-            filter(Machine.name == machine_name).\
-            filter(Slot.machine == Machine.id).\
-            filter(Slot.item == Item.id).\
-            order_by(Slot.number.asc()).\
-            all()
-
-        slots = [SqlAlchemyAdapter._serialize_slot(s) for _, s, _ in results]
-        items = [SqlAlchemyAdapter._serialize_item(i) for _, _, i in results]
-
-        # This is side effecting - despite iterating over a zip the zip's values are references
-        for slot, item in zip(slots, items):
-            slot['item'] = item
-
-        return slots
+        slots = catalog_cache.snapshot().slots_by_machine.get(machine_name, [])
+        return [dict(slot, item=dict(slot['item'])) for slot in slots]
 
     @staticmethod
     def update_slot_status(machine_id, slot_num):
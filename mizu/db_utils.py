@@ -0,0 +1,81 @@
+""" Mizu - db_utils.py
+
+SQL helpers for the few places that need to differ between PostgreSQL (production) and SQLite (development)
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
+
+from mizu import db
+
+_SQLITE_FORMATS = {
+    'minute': '%Y-%m-%d %H:%M:00',
+    'hour': '%Y-%m-%d %H:00:00',
+}
+
+
+def truncate_time(column, unit):
+    """ Truncate a ``DateTime`` column to the start of its ``minute`` or ``hour``, for grouping
+
+    The result should be passed through ``as_datetime``, as SQLite returns it as a string.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc(unit, column)
+    return func.strftime(_SQLITE_FORMATS[unit], column)
+
+
+def as_datetime(value):
+    """ Convert a value returned by ``truncate_time`` to a ``datetime`` """
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def parse_time(value, name):
+    """ Parse an ISO 8601 timestamp (from a query parameter or request body) into the naive UTC datetimes stored
+
+    Args:
+        value (str): the timestamp, or ``None``
+        name (str): what the value is called, for the error message
+
+    Returns:
+        datetime: the parsed time, or ``None`` if ``value`` is ``None``
+
+    Raises:
+        ValueError: if ``value`` is not an ISO 8601 timestamp string
+    """
+    if value is None:
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise ValueError('The {} value must be an ISO 8601 timestamp'.format(name))
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def insert_ignoring_duplicates(table):
+    """ An ``INSERT`` into ``table`` that skips rows whose primary key already exists """
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return sqlite.insert(table).on_conflict_do_nothing()
+
+
+def try_lock(key):
+    """ Take the lock numbered ``key``, shared by every worker, for the rest of the session's transaction if it is free
+
+    This is a PostgreSQL advisory lock. SQLite only lets one transaction write at a time anyway, so there it is always
+    taken.
+
+    Returns:
+        bool: whether the lock was taken
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(select(func.pg_try_advisory_xact_lock(key))).scalar()
+    return True
@@ -0,0 +1,259 @@
+""" Mizu - directory.py
+
+An in-process copy of the member directory (uid, cn, drinkBalance, and iButtons), kept fresh from LDAP in the background
+"""
+
+import logging
+import os
+import time
+import threading
+
+import ldap
+
+from ldap.controls import SimplePagedResultsControl
+
+from mizu import metrics
+from mizu import tracing
+
+logger = logging.getLogger(__name__)
+
+USERS_BASE = 'cn=users,cn=accounts,dc=csh,dc=rit,dc=edu'
+MEMBER_FILTER = '(objectClass=cshMember)'
+ATTRIBUTES = ['uid', 'cn', 'drinkBalance', 'ibutton', 'modifyTimestamp']
+
+
+class UserDirectory:
+    """ Caches every member's uid, cn and drinkBalance, keyed by uid
+
+    The directory is filled by a paged search of every member, then kept fresh every ``interval`` seconds by searching
+    only for members whose ``modifyTimestamp`` has moved since the last refresh. As incremental refreshes can't see
+    members that were removed, a full reload is done every ``full_interval`` seconds. Balance changes made by this
+    server are written through with ``update_balance`` so they are visible immediately.
+
+    An index of iButton -> uid is kept alongside, so a tap at a machine is answered without searching LDAP. An iButton
+    missing from the index is looked up in LDAP and added, in case it was registered since the last refresh.
+
+    Args:
+        pool (LDAPPool): the pool of connections to search with
+        interval (float): seconds between incremental refreshes
+        full_interval (float): seconds between full reloads
+        page_size (int): the number of entries requested per page of a full reload
+    """
+
+    def __init__(self, pool, interval, full_interval, page_size):
+        self.pool = pool
+        self.interval = interval
+        self.full_interval = full_interval
+        self.page_size = page_size
+
+        self._users = {}
+        self._ibuttons = {}
+        self._ibuttons_by_uid = {}
+        self._sorted = None
+        self._high_water = None
+        self._loaded_at = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.RLock()
+        self._thread = None
+        self._pid = None
+
+        self.full_loads = 0
+        self.incremental_refreshes = 0
+        self.entries_updated = 0
+        self.ibutton_hits = 0
+        self.ibutton_misses = 0
+
+    def list(self):
+        """ Every member, sorted by uid
+
+        Returns:
+            list: ``{'uid', 'cn', 'drinkBalance'}`` dicts. These are shared, and must not be modified by the caller.
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = [self._users[uid] for uid in sorted(self._users)]
+            return self._sorted
+
+    def get(self, uid):
+        """ The cached entry for a member, or ``None`` if they aren't known """
+        self._ensure_loaded()
+
+        with self._lock:
+            return self._users.get(uid)
+
+    def get_by_ibutton(self, ibutton, lookup):
+        """ The cached entry for the member with the provided iButton
+
+        Args:
+            ibutton (str): the iButton ID
+            lookup (callable): called with the iButton on an index miss, returns the member's uid or raises ``KeyError``
+
+        Raises:
+            KeyError: if no member has the provided iButton
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            uid = self._ibuttons.get(ibutton)
+            user = self._users.get(uid) if uid is not None else None
+            if user is not None:
+                self.ibutton_hits += 1
+                return user
+            self.ibutton_misses += 1
+
+        # Not indexed, or indexed to a member who has since gone - ask LDAP, and index whatever it says
+        uid = lookup(ibutton)
+
+        with self._lock:
+            self._ibuttons[ibutton] = uid
+            self._ibuttons_by_uid.setdefault(uid, set()).add(ibutton)
+            user = self._users.get(uid)
+
+        if user is None:
+            self.refresh()
+            with self._lock:
+                user = self._users.get(uid)
+
+        if user is None:
+            raise KeyError('The requested iButton does not belong to any user')
+
+        return user
+
+    def update_balance(self, uid, balance):
+        """ Write a balance change made by this server through to the directory """
+        with self._lock:
+            user = self._users.get(uid)
+            if user is None:
+                return
+            self._users[uid] = dict(user, drinkBalance=int(balance))
+            self._sorted = None
+
+    def refresh(self, full=False):
+        """ Bring the directory up to date with LDAP now
+
+        Args:
+            full (bool): reload every member rather than only those modified since the last refresh
+        """
+        with self._load_lock:
+            full = full or self._high_water is None or time.time() - self._loaded_at > self.full_interval
+
+            if full:
+                entries = self.pool.call(self._paged_search, MEMBER_FILTER)
+            else:
+                # modifyTimestamp has a resolution of one second, so re-read the second we last saw to miss nothing
+                entries = self.pool.call(self._paged_search, '(&{}(modifyTimestamp>={}))'.format(
+                    MEMBER_FILTER, self._high_water
+                ))
+
+            users = {}
+            ibuttons_by_uid = {}
+            high_water = self._high_water
+            for dn, attrs in entries:
+                if not dn or 'uid' not in attrs:
+                    # Search continuation references and the like
+                    continue
+
+                user = UserDirectory._decode(attrs)
+                users[user['uid']] = user
+                ibuttons_by_uid[user['uid']] = {value.decode('utf-8') for value in attrs.get('ibutton', [])}
+
+                stamp = attrs.get('modifyTimestamp', [b''])[0].decode('utf-8')
+                if stamp and (high_water is None or stamp > high_water):
+                    high_water = stamp
+
+            with self._lock:
+                if full:
+                    self._users = users
+                    self._ibuttons_by_uid = ibuttons_by_uid
+                    self._ibuttons = {ibutton: uid for uid, values in ibuttons_by_uid.items() for ibutton in values}
+                    self._loaded_at = time.time()
+                    self.full_loads += 1
+                else:
+                    self._users.update(users)
+                    for uid, values in ibuttons_by_uid.items():
+                        for ibutton in self._ibuttons_by_uid.get(uid, set()) - values:
+                            self._ibuttons.pop(ibutton, None)
+                        for ibutton in values:
+                            self._ibuttons[ibutton] = uid
+                        self._ibuttons_by_uid[uid] = values
+                    self.incremental_refreshes += 1
+                self._sorted = None
+                self._high_water = high_water
+                self._refreshed_at = time.time()
+                self.entries_updated += len(users)
+
+        logger.debug('Refreshed %s directory entries (%s)', len(users), 'full' if full else 'incremental')
+
+    def stats(self):
+        with self._lock:
+            ibutton_lookups = self.ibutton_hits + self.ibutton_misses
+            return {
+                'users': len(self._users),
+                'ibuttons': len(self._ibuttons),
+                'ibutton_hits': self.ibutton_hits,
+                'ibutton_misses': self.ibutton_misses,
+                'ibutton_hit_rate': self.ibutton_hits / ibutton_lookups if ibutton_lookups else None,
+                'full_loads': self.full_loads,
+                'incremental_refreshes': self.incremental_refreshes,
+                'entries_updated': self.entries_updated,
+                'age': time.time() - self._refreshed_at if self._refreshed_at else None,
+                'high_water': self._high_water,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self.refresh(full=True)
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='mizu-directory-refresher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Background directory refresh failed')
+
+    @tracing.traced('ldap.directory_search')
+    @metrics.LDAP_SECONDS.time('directory_search')
+    def _paged_search(self, lib, search_filter):
+        """ Search members a page at a time, so large directories don't hit server side size limits """
+        con = lib.get_con()
+        control = SimplePagedResultsControl(True, size=self.page_size, cookie=b'')
+
+        entries = []
+        while True:
+            msgid = con.search_ext(USERS_BASE, ldap.SCOPE_SUBTREE, search_filter, ATTRIBUTES, serverctrls=[control])
+            _, page, _, response_controls = con.result3(msgid)
+            entries.extend(page)
+
+            cookie = None
+            for response_control in response_controls:
+                if response_control.controlType == SimplePagedResultsControl.controlType:
+                    cookie = response_control.cookie
+            if not cookie:
+                return entries
+
+            control.cookie = cookie
+
+    @staticmethod
+    def _decode(attrs):
+        return {
+            'cn': attrs['cn'][0].decode('utf-8'),
+            'uid': attrs['uid'][0].decode('utf-8'),
+            'drinkBalance': int(attrs.get('drinkBalance', [b'0'])[0].decode('utf-8'))
+        }
@@ -6,54 +6,85 @@
 Routes for retrieving information on the contents of the machines, and dropping drinks
 """
 
+import logging
+
 from flask import Blueprint, jsonify, request
 
+from sqlalchemy import and_, or_, literal, update
+
 from mizu import db
 
 from mizu.models import Machine
 from mizu.models import Item
 from mizu.models import Slot
 
-from mizu.users import _manage_credits, _get_credits
+from mizu.users import _debit_credits, _get_credits
+from mizu.balances import BalanceConflict
+from mizu.ldap_pool import LDAPPoolTimeout
 from mizu.auth import check_token
 from mizu.errors import bad_params, bad_headers_content_type
 from mizu.data_adapters import get_adapter
+from mizu.data_adapters import catalog_cache
+from mizu.data_adapters import SqlAlchemyAdapter
+from mizu.conditional import conditional, make_etag
+from mizu.idempotency import idempotent, side_effects_started
 
 from mizu import app
-from mizu import logger
+from mizu import machine_status
+from mizu import machines
+from mizu import drop_log
+from mizu import event_bus
+from mizu import drop_keys
+from mizu import tracing
 
+from datetime import datetime, timezone
+
+import ldap
 import requests
 
-from multiprocessing import Pool
+logger = logging.getLogger(__name__)
 
 drinks_bp = Blueprint('drinks_bp', __name__)
 
-def query_machine(machine):
-    logger.debug('Querying machine details for {}'.format(machine['name']))
+@tracing.traced()
+def query_machine(adapter, machine, status):
+    """ Assemble the contents of a machine from its slots and its cached status
+
+    Args:
+        adapter: the data adapter to read the machine's slots with
+        machine (dict): the serialized machine
+        status (dict): the ``StatusCache`` entry for this machine
+    """
+    logger.debug('Querying machine details for %s', machine['name'])
     machine_slots = adapter.get_slots_in_machine(machine['name'])
 
-    is_online = True
+    is_online = status['is_online']
+    slot_status = status['slots']
 
-    try:
-        slot_status = _get_machine_status(machine['name'])
-    except requests.exceptions.ConnectionError:
+    error = status['error']
+    if isinstance(error, requests.exceptions.ConnectionError):
         # We couldn't connect to the machine
-        logger.debug('Machine {} is unreachable, reporting as offline'.format(machine['name']))
-        slot_status = [{'empty': True} for n in range(len(machine_slots))]
-        is_online = False  # seems a useful feature
-    except requests.exceptions.Timeout:
+        logger.debug('Machine %s is unreachable, reporting as offline', machine['name'])
+    elif isinstance(error, (requests.exceptions.Timeout, TimeoutError)):
         # We hit a timeout waiting for the machine to respond
-        logger.debug('Machine {} was reachable, but did not respond within a reasonable amount of time'.format(
-            machine['name']
-        ))
+        logger.debug('Machine %s was reachable, but did not respond within a reasonable amount of time',
+                     machine['name'])
+    elif error is not None:
+        logger.error('Machine %s returned an unusable status: %s', machine['name'], error)
+
+    if not is_online:
         slot_status = [{'empty': True} for n in range(len(machine_slots))]
-        is_online = False
+
+    last_seen = None
+    if status['last_seen'] is not None:
+        last_seen = datetime.fromtimestamp(status['last_seen'], timezone.utc).isoformat()
 
     machine_contents = {
         'id': machine['id'],
         'name': machine['name'],
         'display_name': machine['display_name'],
         'is_online': is_online,
+        'last_seen': last_seen,
         'slots': []
     }
 
@@ -61,12 +92,38 @@ def query_machine(machine):
         slot['empty'] = slot_status[slot['number']-1]['empty']
         machine_contents['slots'].append(slot)
 
-    logger.debug('Fetched all available details for {}'.format(machine['name']))
+    logger.debug('Fetched all available details for %s', machine['name'])
     return machine_contents
 
+def _drinks_etag(adapter):
+    """ Machine contents change with the catalog version, and with the cached status of each machine shown
+
+    ``last_seen`` is left out - it moves on every background refresh, and would make the tag change every few seconds
+    while nothing a client shows has. The tag is sent weak for that reason.
+    """
+    if adapter is not SqlAlchemyAdapter:
+        return None
+
+    snapshot = catalog_cache.snapshot()
+    machine_name = request.args.get('machine', None)
+    if machine_name is None:
+        names = [machine['name'] for machine in snapshot.machines]
+    elif machine_name in snapshot.machines_by_name:
+        names = [machine_name]
+    else:
+        # Let the route report the bad machine name
+        return None
+
+    statuses = machine_status.get_many(names)
+    return make_etag('drinks', snapshot.version, [
+        (name, statuses[name]['is_online'], [slot['empty'] for slot in statuses[name]['slots'] or []])
+        for name in names
+    ])
+
 @drinks_bp.route('/drinks', methods=['GET'])
 @get_adapter
 @check_token()
+@conditional(_drinks_etag, app.config['DRINKS_CACHE_CONTROL'], weak=True)
 def current_drinks(adapter):
     # optional request paremeter, the name of the machine to get stock information
     machine_name = request.args.get('machine', None)
@@ -74,7 +131,7 @@ def current_drinks(adapter):
     # assemble an array of (id, name) tuples
     if machine_name is None:
         machines = adapter.get_machines()
-        logger.debug('Fetching contents for machines {}'.format(', '.join([m['name'] for m in machines])))
+        logger.debug('Fetching contents for machines %s', ', '.join([m['name'] for m in machines]))
     else:
         # We're given a machine name
         machine = adapter.get_machine(machine_name)
@@ -84,16 +141,17 @@ def current_drinks(adapter):
             logger.error(err)
             return bad_params(err)
 
-        logger.debug('Fetching contents for machine {}'.format(machine_name))
+        logger.debug('Fetching contents for machine %s', machine_name)
         machines = []
         machines.append(machine)
 
     response = {}
 
 
-    with Pool(5) as p:
-        contents = p.map(query_machine, machines)
-        response['machines'] = contents
+    # Answered from the status cache - only machines that have never been polled are contacted, all at once
+    with tracing.span('machine_status'):
+        statuses = machine_status.get_many([machine['name'] for machine in machines])
+    response['machines'] = [query_machine(adapter, machine, statuses[machine['name']]) for machine in machines]
 
     response['message'] = 'Successfully retrieved machine contents for {}'.format(
         ', '.join([machine['name'] for machine in machines])
@@ -105,7 +163,13 @@ def current_drinks(adapter):
 @drinks_bp.route('/drinks/drop', methods=['POST'])
 @get_adapter
 @check_token(return_user_obj=True)
+@idempotent(drop_keys)
 def drop_drink(adapter, user = None):
+    """ Drop a drink, debiting the user
+
+    A client can send an ``Idempotency-Key`` header to retry a drop safely - a retry with the same key gets the
+    original response, without contacting the machine or LDAP again.
+    """
     if request.headers.get('Content-Type') != 'application/json':
         return bad_headers_content_type()
 
@@ -126,28 +190,44 @@ def drop_drink(adapter, user = None):
             ', '.join(unprovided)
         ))
 
-    machine = db.session.query(Machine).filter(Machine.name == body['machine']).first()
-    if machine is None:
-        return bad_params('The machine name \'{}\' is not a valid machine'.format(body['machine']))
+    target = _get_drop_target(body['machine'], body['slot'])
+    if target is None:
+        if db.session.query(Machine.id).filter(Machine.name == body['machine']).first() is None:
+            return bad_params('The machine name \'{}\' is not a valid machine'.format(body['machine']))
 
-    slot = db.session.query(Slot).filter(Slot.number == body['slot'], Slot.machine == machine.id).first()
-    if slot is None:
         return bad_params('The machine \'{}\' does not have a slot with id \'{}\''.format(
             body['machine'],
             body['slot']
         ))
 
+    machine, slot, item = target
+
+    # Keep what was read usable after the stock reservation commits, without selecting it all again
+    db.session.expunge_all()
+
+    if item is None:
+        return bad_params('The machine \'{}\' does not have an item in slot \'{}\''.format(
+            body['machine'],
+            body['slot']
+        ))
+
     logger.debug('Drop request is valid')
 
-    slot_status = _get_machine_status(body['machine'])
-    if (body['machine'] == 'snack' and slot.count < 1) or slot_status[body['slot']-1]['empty']:  # slots are 1 indexed
+    with tracing.span('machine_status', machine=machine.name):
+        status = machine_status.get_fresh(machine.name, app.config['MACHINE_STATUS_DROP_MAX_AGE'])
+    if not status['is_online']:
+        return jsonify({
+            "error": "Could not contact drink machine for drop!",
+            "errorCode": 500
+        }), 500
+
+    slot_status = status['slots']
+    if slot_status[body['slot']-1]['empty']:  # slots are 1 indexed
         return jsonify({
             "error": "The requested slot is empty!",
             "errorCode": 400
         }), 400
 
-    item = db.session.query(Item).filter(Item.id == slot.item).first()
-
     if bal_before < item.price:
         response = {
             "error": "The user \'{}\' does not have a sufficient drinkBalance",
@@ -157,90 +237,132 @@ def drop_drink(adapter, user = None):
 
     logger.debug('User has sufficient balance')
 
-    machine_hostname = '{}.csh.rit.edu'.format(machine.name)
-    request_endpoint = 'https://{}/drop'.format(machine_hostname)
-
-    body = {
-        "slot": slot.number
-    }
-
-    headers = {
-        'X-Auth-Token': app.config['MACHINE_API_TOKEN'],
-        'Content-Type': 'application/json'
-    }
+    # The snack machine tracks its stock - take one out of the slot first, so two users can't both buy the last one
+    reservation = None
+    if machine.name == 'snack':
+        reservation = _reserve_stock(machine, slot)
+        if reservation is None:
+            return jsonify({
+                "error": "The requested slot is empty!",
+                "errorCode": 400
+            }), 400
 
     # Do the thing
     try:
-        response = requests.post(request_endpoint, json=body, headers=headers, timeout=5)
+        response = machines.drop(machine.name, slot.number)
     except requests.exceptions.ConnectionError:
+        _release_stock(machine, slot, reservation)
         return jsonify({
             "error": "Could not contact drink machine for drop!",
             "errorCode": 500
         }), 500
     except requests.exceptions.Timeout:
+        # The machine may still have dropped it, so a retry must not drop again, and the reserved item stays taken out
+        # of stock - a restock or admin count corrects it if it wasn't
+        side_effects_started()
         return jsonify({
             "error": "Connection to the drink machine timed out!",
             "errorCode": 500
         }), 500
 
+    side_effects_started()
+
     try:
         response.raise_for_status()
     except requests.exceptions.HTTPError:
+        _release_stock(machine, slot, reservation)
         return jsonify({"error": "Could not access slot for drop!",
                         "message": response.json()['error'],
                         "errorCode": response.status_code}),\
                        response.status_code
 
     logger.debug('Dropped drink - adjusting user credits')
-    new_balance = bal_before - item.price
-    _manage_credits(user['preferred_username'], new_balance, adapter)
-    logger.debug('Credits for {} updated'.format(user['preferred_username']))
+    try:
+        new_balance = _debit_credits(user['preferred_username'], item.price, bal_before, adapter)
+    except (BalanceConflict, ldap.LDAPError, LDAPPoolTimeout):
+        # The drink is already out of the machine, so this is answered (and recorded for the Idempotency-Key) rather
+        # than raised
+        logger.exception('Dropped a drink for %s, but could not debit %s credits', user['preferred_username'],
+                         item.price)
+        return jsonify({
+            "error": "The drink was dropped, but your balance could not be updated. Contact a drink admin",
+            "errorCode": 500
+        }), 500
+    logger.debug('Credits for %s updated', user['preferred_username'])
 
-    if machine.name == 'snack':
-        slot.count = Slot.count - 1 # Decrement stock count, set inactive if empty
-        if slot.count == 0:
-            slot.active = False
-        db.session.commit()
+    drop_log.record(machine.id, item.id, user['preferred_username'], item.price, new_balance + item.price, new_balance)
 
     return jsonify({"message": "Drop successful!", "drinkBalance": new_balance}), response.status_code
 
-def _get_machine_status(machine_name):
-    """ helper function to query a machine given it's name (should be the actual hostname, will be dropped into a
-        {}.csh.rit.edu template), and return slot status information in a more programmatically useful way.
-
-        Realistically, the data should look like this coming back from the mahcine -- this is low hanging fruit for someone
-        to fix.
-
-        Warning::
-
-            This doesn't actually validate the machine name. That should be done in what ever route needs to call this function.
+@tracing.traced()
+def _get_drop_target(machine_name, slot_num):
+    """ Resolve a machine name and slot number to the machine, slot, and item in a single query
 
-        Raises:
-            requests.exceptions.HTTPError: in the event the machine responds with a non-2XX
-            requests.exceptions.Timeout: if the machine does not respond with any bytes within 5 seconds
-            requests.exceptions.ConnectionError: if the machine is not online
+    Returns:
+        tuple: ``(Machine, Slot, Item)``, where the item is ``None`` if the slot is unassigned, or ``None`` if the
+            machine or slot does not exist
     """
+    query = db.session.query(Machine, Slot, Item).\
+        join(Slot, Slot.machine == Machine.id).\
+        outerjoin(Item, Item.id == Slot.item).\
+        filter(Machine.name == machine_name, Slot.number == slot_num)
 
-    headers = {
-        'X-Auth-Token': app.config['MACHINE_API_TOKEN'],
-        'Content-Type': 'application/json'
-    }
-
-    endpoint = 'https://{}.csh.rit.edu/health'.format(machine_name)
-    health_status = requests.get(endpoint, headers=headers, timeout=5)
-    health_status.raise_for_status()
-
-    health_results = health_status.json()
+    return query.first()
 
-    logger.debug('Reached machine {} succesfully'.format(machine_name))
+@tracing.traced()
+def _reserve_stock(machine, slot):
+    """ Take one item out of a slot's stock, deactivating the slot if that empties it, in a single statement
 
-    slots = []
+    The count is checked and decremented by the database in one conditional ``UPDATE``, so concurrent drops never
+    sell the same item twice, and the row is only locked for that statement rather than for the whole drop.
 
-    for idx, slot in enumerate(health_results['slots'], 1):
-        slots.append({
-            'number': idx,
-            'w1id': slot.split('(')[1].split(')')[0],
-            'empty': 'empty' in slot
-        })
-
-    return slots
+    Returns:
+        int: the slot's remaining count, or ``None`` if it was already out of stock
+    """
+    remaining = db.session.execute(
+        update(Slot.__table__).
+        where(Slot.machine == machine.id, Slot.number == slot.number, Slot.count > 0).
+        values(count=Slot.count - 1, active=and_(Slot.active, Slot.count > 1)).
+        returning(Slot.count)
+    ).scalar()
+
+    if remaining is None:
+        db.session.rollback()
+        return None
+
+    _publish_stock(machine, slot, remaining, slot.active and remaining > 0)
+    catalog_cache.mark_changed()
+    db.session.commit()
+
+    return remaining
+
+@tracing.traced()
+def _release_stock(machine, slot, reservation):
+    """ Put back the item reserved by ``_reserve_stock`` after a failed drop, reactivating the slot if the reservation
+    deactivated it
+    """
+    if reservation is None:
+        return
+
+    restored = db.session.execute(
+        update(Slot.__table__).
+        where(Slot.machine == machine.id, Slot.number == slot.number).
+        values(count=Slot.count + 1, active=or_(Slot.active, literal(slot.active))).
+        returning(Slot.count, Slot.active)
+    ).first()
+
+    if restored is not None:
+        _publish_stock(machine, slot, restored[0], restored[1])
+    catalog_cache.mark_changed()
+    db.session.commit()
+
+    logger.debug('Released the stock reserved in slot %s of %s', slot.number, machine.name)
+
+def _publish_stock(machine, slot, count, active):
+    event_bus.publish_on_commit(db.session, 'slot', {
+        'machine': machine.name,
+        'number': slot.number,
+        'active': active,
+        'item_id': slot.item,
+        'count': count,
+    })
@@ -0,0 +1,228 @@
+""" Mizu - drop_log.py
+
+Records drops in the ``logs`` table from a background writer, so a drop never waits on a log commit
+"""
+
+import logging
+import os
+import time
+import queue
+import atexit
+import threading
+
+from datetime import datetime
+
+from sqlalchemy import exc
+
+from mizu import app
+from mizu import db
+
+from mizu.models import Log
+
+logger = logging.getLogger(__name__)
+
+
+class DropLogWriter:
+    """ Queues drop records and writes them to the ``logs`` table in bulk inserts
+
+    A background thread writes whatever has been queued once ``batch_size`` records are waiting, or ``flush_interval``
+    seconds after the oldest was queued, whichever comes first. A batch that fails to insert is retried with the next
+    one, unless the database rejected it as invalid - then its records are written one at a time, and any that are still
+    rejected are logged and skipped so they can't hold up the rest. Anything still queued when the process exits is
+    written by an ``atexit`` hook.
+
+    Callers never wait on the database. When the queue is full records overflow into the batches waiting to be retried,
+    and past ``max_queue`` of those (the database has been down for a while) new records are logged and dropped.
+
+    Args:
+        batch_size (int): the most records written in one insert
+        flush_interval (float): the longest a record waits before being written, in seconds
+        max_queue (int): the most records waiting to be written, and the most held for retrying on top of those
+        shutdown_timeout (float): the longest spent writing queued records when the process exits, in seconds
+    """
+
+    def __init__(self, batch_size, flush_interval, max_queue, shutdown_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_queue
+        self.shutdown_timeout = shutdown_timeout
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.largest_batch = 0
+
+        atexit.register(self.close)
+
+    def record(self, machine_id, item_id, user, price, balance_before, balance_after):
+        """ Record a drop, to be written to the ``logs`` table shortly """
+        row = {
+            'machine': machine_id,
+            'item': item_id,
+            'user': user,
+            'time': datetime.utcnow(),
+            'price': price,
+            'balance_before': balance_before,
+            'balance_after': balance_after,
+        }
+
+        self.ensure_started()
+
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                if len(self._pending) < self.max_pending:
+                    self._pending.append(row)
+                    self.overflows += 1
+                    return
+                self.dropped += 1
+            logger.error('Drop log is full, dropped the record of a drop: %s', row)
+            return
+
+        with self._lock:
+            self.queued += 1
+
+    def flush(self, timeout=None):
+        """ Write everything queued so far, returning ``False`` if it could not all be written within ``timeout`` """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._write_lock:
+                batch = self._take(self.batch_size)
+                if not batch:
+                    return True
+                failed = self._write(batch)
+                if failed:
+                    self._requeue(failed)
+                    return False
+
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+
+    def close(self):
+        """ Write everything still queued, giving up after ``shutdown_timeout`` seconds """
+        if not self.flush(self.shutdown_timeout):
+            logger.error('Exited with %s drops not written to the log', self._queue.qsize() + len(self._pending))
+
+    def ensure_started(self):
+        """ Start the background writer for this process if it isn't already running """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='mizu-drop-log-writer', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize() + len(self._pending),
+                'queue_size': self._queue.maxsize,
+                'queued': self.queued,
+                'written': self.written,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+                'failures': self.failures,
+                'overflows': self.overflows,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _run(self):
+        while True:
+            # Wait for the first record of a batch, then give the rest until flush_interval after it to arrive
+            first = self._queue.get() if not self._pending else None
+
+            with self._write_lock:
+                batch = [first] if first is not None else []
+                batch += self._take(self.batch_size - len(batch), block_until=time.monotonic() + self.flush_interval)
+                failed = self._write(batch) if batch else []
+                if failed:
+                    self._requeue(failed)
+
+            if failed:
+                # Don't spin against a database that is down
+                time.sleep(self.flush_interval)
+
+    def _take(self, count, block_until=None):
+        """ Take up to ``count`` records, starting with any from failed batches """
+        with self._lock:
+            batch = self._pending[:count]
+            del self._pending[:count]
+
+        while len(batch) < count:
+            try:
+                if block_until is None:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=max(block_until - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _requeue(self, batch):
+        """ Put records back to be retried first, dropping the newest past ``max_pending`` """
+        with self._lock:
+            self._pending[:0] = batch
+            excess = len(self._pending) - self.max_pending
+            if excess > 0:
+                dropped = self._pending[-excess:]
+                del self._pending[-excess:]
+                self.dropped += excess
+            else:
+                dropped = []
+
+        for row in dropped:
+            logger.error('Drop log is full, dropped the record of a drop: %s', row)
+
+    def _write(self, rows):
+        """ Insert ``rows`` into the ``logs`` table in one statement
+
+        If the database rejects the statement the rows are inserted one at a time instead, skipping the ones it rejects.
+
+        Returns:
+            list: the rows that could not be written, and should be retried
+        """
+        try:
+            with app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(Log.__table__.insert(), rows)
+        except exc.IntegrityError as e:
+            if len(rows) == 1:
+                logger.error('The log rejected the record of a drop, skipping it: %s (%s)', rows[0], e.orig)
+                with self._lock:
+                    self.rejected += 1
+                return []
+            logger.warning('The log rejected a batch of %s drops, writing them one at a time', len(rows))
+        except Exception:
+            logger.exception('Could not write %s drops to the log', len(rows))
+            with self._lock:
+                self.failures += 1
+            return rows
+        else:
+            with self._lock:
+                self.written += len(rows)
+                self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(rows))
+            return []
+
+        for index, row in enumerate(rows):
+            if self._write([row]):
+                return rows[index:]
+        return []
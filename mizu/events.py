@@ -0,0 +1,197 @@
+""" Mizu - events.py
+
+An in-process publish/subscribe bus for machine, slot, and item changes, streamed to clients by ``/events``
+"""
+
+import json
+import time
+import queue
+import threading
+import collections
+
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+Event = collections.namedtuple('Event', ['seq', 'id', 'type', 'data', 'encoded'])
+
+
+class TooManySubscribers(Exception):
+    """ Raised when the bus already has as many subscribers as it will serve """
+    pass
+
+
+class Subscription:
+    """ One subscriber's view of the bus - the events it missed, then everything published after it subscribed
+
+    A subscriber that falls more than ``queue_size`` events behind is cut off rather than allowed to hold events (and
+    memory) indefinitely; ``overflowed`` is set, the events already queued are still delivered, and the client is
+    expected to reconnect with ``Last-Event-ID`` and catch up from the bus history.
+    """
+
+    def __init__(self, backlog, queue_size, reset):
+        self.reset = reset
+        self.overflowed = False
+        self._backlog = collections.deque(backlog)
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def get(self, timeout):
+        """ The next event, or ``None`` if nothing was published within ``timeout`` seconds (or the subscriber has
+        overflowed and been fully drained)
+        """
+        if self._backlog:
+            return self._backlog.popleft()
+
+        try:
+            if self.overflowed:
+                return self._queue.get_nowait()
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _offer(self, published):
+        if self.overflowed:
+            return False
+
+        try:
+            self._queue.put_nowait(published)
+            return True
+        except queue.Full:
+            self.overflowed = True
+            return False
+
+
+class EventBus:
+    """ Fans published events out to every subscriber, keeping the most recent ``history_size`` for resuming clients
+
+    Event IDs are of the form ``<boot>:<seq>``, where ``boot`` identifies this process. A client resuming with an ID
+    from another process, or one old enough to have fallen out of the history, is told to ``reset`` - refetch
+    ``/drinks`` - before receiving new events. The bus lives in a single worker process, so changes made by another
+    worker are only seen through the machine status refresher.
+
+    Args:
+        history_size (int): the number of recent events kept for ``Last-Event-ID`` resumption
+        queue_size (int): the number of undelivered events a subscriber may fall behind by before it is cut off
+        max_subscribers (int): the most subscribers served at once
+    """
+
+    def __init__(self, history_size, queue_size, max_subscribers):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+
+        self._boot = '{:x}'.format(int(time.time() * 1000))
+        self._seq = 0
+        self._history = collections.deque(maxlen=history_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+        self.published = 0
+        self.overflows = 0
+        self.resumes = 0
+        self.resets = 0
+
+    def publish(self, event_type, data):
+        """ Publish an event to every current subscriber. This never blocks on a slow subscriber. """
+        with self._lock:
+            self._seq += 1
+            event_id = '{}:{}'.format(self._boot, self._seq)
+            published = Event(self._seq, event_id, event_type, data, EventBus._encode(event_id, event_type, data))
+            self._history.append(published)
+            subscribers = list(self._subscribers)
+            self.published += 1
+
+        for subscription in subscribers:
+            if not subscription._offer(published):
+                with self._lock:
+                    if subscription in self._subscribers:
+                        self._subscribers.discard(subscription)
+                        self.overflows += 1
+
+    def publish_on_commit(self, session, event_type, data):
+        """ Publish an event once the provided session's transaction commits, and not at all if it rolls back """
+        session.info.setdefault('pending_events', []).append((self, event_type, data))
+
+    def subscribe(self, last_event_id=None):
+        """ Subscribe to the bus, replaying everything published after ``last_event_id``
+
+        Raises:
+            TooManySubscribers: if ``max_subscribers`` are already subscribed
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers('The event stream is serving the most clients it can')
+
+            backlog = []
+            reset = False
+            if last_event_id:
+                boot, _, seq = last_event_id.partition(':')
+                oldest = self._history[0].seq if self._history else self._seq + 1
+                if boot == self._boot and seq.isdigit() and int(seq) >= oldest - 1:
+                    backlog = [published for published in self._history if published.seq > int(seq)]
+                    self.resumes += 1
+                else:
+                    reset = True
+                    self.resets += 1
+
+            subscription = Subscription(backlog, self.queue_size, reset)
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self.published,
+                'history': len(self._history),
+                'overflows': self.overflows,
+                'resumes': self.resumes,
+                'resets': self.resets,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    @staticmethod
+    def _encode(event_id, event_type, data):
+        """ Encode an event once, as a server-sent event, rather than once per subscriber """
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, event_type, json.dumps(data))
+
+
+def status_change_events(machine_name, previous, entry):
+    """ Describe the difference between two ``StatusCache`` entries for a machine as events
+
+    Returns:
+        list: ``(type, data)`` tuples - a ``machine`` event if it went on or offline, and a ``slot`` event for each
+            slot that became empty or was refilled
+    """
+    events = []
+
+    if previous['is_online'] != entry['is_online']:
+        last_seen = None
+        if entry['last_seen'] is not None:
+            last_seen = datetime.fromtimestamp(entry['last_seen'], timezone.utc).isoformat()
+        events.append(('machine', {'machine': machine_name, 'is_online': entry['is_online'], 'last_seen': last_seen}))
+
+    if entry['is_online'] and previous['slots'] is not None and entry['slots'] is not None:
+        for number, (old, new) in enumerate(zip(previous['slots'], entry['slots']), 1):
+            if old['empty'] != new['empty']:
+                events.append(('slot', {'machine': machine_name, 'number': number, 'empty': new['empty']}))
+
+    return events
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_on_commit(session):
+    for bus, event_type, data in session.info.pop('pending_events', ()):
+        bus.publish(event_type, data)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    session.info.pop('pending_events', None)
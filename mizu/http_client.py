@@ -0,0 +1,96 @@
+""" Mizu - http_client.py
+
+The shared HTTP client used for every outbound call made by the server (drink machines, SSO)
+"""
+
+import os
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """ A keep-alive ``requests.Session`` shared by every thread in the worker
+
+    Connections are pooled per host by the session's adapters, so repeated calls to the same machine or to SSO reuse a
+    warm TLS connection rather than paying for a new handshake. The session is rebuilt if the process has forked since
+    it was created, as sockets must not be shared between workers.
+
+    Args:
+        pool_connections (int): the number of per-host connection pools to keep
+        pool_maxsize (int): the maximum number of idle connections kept open to any single host
+    """
+
+    def __init__(self, pool_connections, pool_maxsize):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._build_session()
+                self._pid = os.getpid()
+            return self._session
+
+    def request(self, method, url, timeout, **kwargs):
+        """ Make a request on the shared session
+
+        Args:
+            timeout (tuple): a ``(connect, read)`` pair of timeouts in seconds - every call must set its own
+
+        Returns:
+            requests.Response: the response, whatever its status
+        """
+        return self.session.request(method, url, timeout=timeout, **kwargs)
+
+    def get(self, url, timeout, **kwargs):
+        return self.request('GET', url, timeout, **kwargs)
+
+    def post(self, url, timeout, **kwargs):
+        return self.request('POST', url, timeout, **kwargs)
+
+    def stats(self):
+        """ Report connection reuse per host
+
+        ``connections`` is the number of connections (and so TCP + TLS handshakes) opened to a host, ``requests`` the
+        number of requests made over them.
+        """
+        with self._lock:
+            session = self._session
+
+        if session is None:
+            return {}
+
+        hosts = {}
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    # Evicted since we listed the keys
+                    continue
+
+                hosts['{}://{}:{}'.format(key.key_scheme, key.key_host, key.key_port)] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'reused': max(pool.num_requests - pool.num_connections, 0),
+                }
+
+        return hosts
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
@@ -0,0 +1,270 @@
+""" Mizu - idempotency.py
+
+``Idempotency-Key`` support - a retried request is answered with the original response instead of being run again
+"""
+
+import logging
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, g, jsonify, make_response, request
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy import exc
+
+from mizu import db
+
+from mizu.models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+# How often expired keys are deleted from the database, in seconds
+PURGE_INTERVAL = 60
+
+
+class KeyInUse(Exception):
+    """ Raised when a request with the same key is still being handled """
+    pass
+
+
+class KeyMismatch(Exception):
+    """ Raised when a key is reused for a request with a different body """
+    pass
+
+
+class IdempotencyStore:
+    """ Remembers the response to each idempotency key for ``ttl`` seconds
+
+    Keys are claimed in the ``idempotency_keys`` table, which every worker shares, so only one request with a given key
+    is ever run. Completed responses are also kept in an in-process LRU of ``max_size`` entries, so most retries are
+    answered without touching the database. A claim whose request never completed (the worker died) can be taken over
+    after ``pending_timeout`` seconds.
+
+    Args:
+        max_size (int): the most responses kept in memory
+        ttl (float): seconds a response is remembered for
+        pending_timeout (float): seconds before an abandoned claim can be taken over
+    """
+
+    def __init__(self, max_size, ttl, pending_timeout):
+        self.max_size = max_size
+        self.ttl = timedelta(seconds=ttl)
+        self.pending_timeout = timedelta(seconds=pending_timeout)
+
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged_at = 0
+
+        self.claims = 0
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.conflicts = 0
+        self.released = 0
+
+    def claim(self, key, fingerprint):
+        """ Claim a key for a request, or get the response already recorded for it
+
+        Returns:
+            tuple: the recorded ``(status, body)``, or ``None`` if the key was claimed and the request should be run
+
+        Raises:
+            KeyInUse: if another request holds the key
+            KeyMismatch: if the key was used for a request with a different ``fingerprint``
+        """
+        now = datetime.utcnow()
+
+        with self._lock:
+            cached = self._responses.get(key)
+            if cached is not None and cached[0] > now:
+                self._responses.move_to_end(key)
+                if cached[1] != fingerprint:
+                    raise KeyMismatch()
+                self.memory_hits += 1
+                return cached[2], cached[3]
+
+        self._purge(now)
+
+        if self._insert(key, fingerprint, now):
+            with self._lock:
+                self.claims += 1
+            return None
+
+        with db.engine.begin() as connection:
+            row = connection.execute(select(IdempotencyKey).where(IdempotencyKey.key == key)).first()
+
+        abandoned = row is not None and row.status is None and row.created_at <= now - self.pending_timeout
+        if row is None or row.expires_at <= now or abandoned:
+            # Expired or abandoned - take it over, unless someone else just did
+            if self._take_over(key, fingerprint, row, now):
+                with self._lock:
+                    self.claims += 1
+                return None
+            raise KeyInUse()
+
+        if row.fingerprint != fingerprint:
+            raise KeyMismatch()
+
+        if row.status is None:
+            with self._lock:
+                self.conflicts += 1
+            raise KeyInUse()
+
+        self._remember(key, fingerprint, row.expires_at, row.status, row.response)
+        with self._lock:
+            self.database_hits += 1
+        return row.status, row.response
+
+    def complete(self, key, fingerprint, status, body):
+        """ Record the response to a claimed key """
+        expires_at = datetime.utcnow() + self.ttl
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(IdempotencyKey).
+                where(IdempotencyKey.key == key).
+                values(status=status, response=body, expires_at=expires_at)
+            )
+        self._remember(key, fingerprint, expires_at, status, body)
+
+    def release(self, key):
+        """ Give up a claimed key without recording a response, so the request can be retried """
+        with db.engine.begin() as connection:
+            connection.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status.is_(None)))
+        with self._lock:
+            self.released += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._responses),
+                'claims': self.claims,
+                'memory_hits': self.memory_hits,
+                'database_hits': self.database_hits,
+                'conflicts': self.conflicts,
+                'released': self.released,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _insert(self, key, fingerprint, now):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(IdempotencyKey).values(
+                    key=key, fingerprint=fingerprint, created_at=now, expires_at=now + self.ttl
+                ))
+            return True
+        except exc.IntegrityError:
+            return False
+
+    def _take_over(self, key, fingerprint, row, now):
+        if row is None:
+            return self._insert(key, fingerprint, now)
+
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                update(IdempotencyKey).
+                where(IdempotencyKey.key == key, IdempotencyKey.created_at == row.created_at).
+                values(fingerprint=fingerprint, status=None, response=None, created_at=now,
+                       expires_at=now + self.ttl)
+            )
+        return result.rowcount == 1
+
+    def _remember(self, key, fingerprint, expires_at, status, body):
+        with self._lock:
+            self._responses[key] = (expires_at, fingerprint, status, body)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+    def _purge(self, now):
+        """ Delete expired keys, at most once every ``PURGE_INTERVAL`` seconds """
+        with self._lock:
+            if time.monotonic() - self._purged_at < PURGE_INTERVAL:
+                return
+            self._purged_at = time.monotonic()
+
+        with db.engine.begin() as connection:
+            connection.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= now))
+
+
+def side_effects_started():
+    """ Mark that the current request has started changing things outside of its transaction (say, dropping a drink)
+
+    Its response is then recorded even if it is an error, so that a retry can't repeat those changes.
+    """
+    g.idempotent_side_effects = True
+
+
+def idempotent(store):
+    """ Answer requests carrying an ``Idempotency-Key`` header that has been seen before with the original response
+
+    Keys are scoped to the authenticated user, so this must sit below ``check_token(return_user_obj=True)``. A
+    response with a status of 500 or above is not recorded unless the route called ``side_effects_started``, so that
+    failures which changed nothing can be retried. If the route raises after that, a 500 is recorded in its place.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key', None)
+            if key is None:
+                return func(*args, **kwargs)
+
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({
+                    'error': 'The Idempotency-Key header must be between 1 and {} characters'.format(MAX_KEY_LENGTH),
+                    'errorCode': 400
+                }), 400
+
+            user = kwargs.get('user', None)
+            scoped_key = '{}:{}:{}'.format(request.path, user['preferred_username'] if user else '', key)
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+            try:
+                recorded = store.claim(scoped_key, fingerprint)
+            except KeyInUse:
+                return jsonify({
+                    'error': 'A request with this Idempotency-Key is still being handled',
+                    'errorCode': 409
+                }), 409
+            except KeyMismatch:
+                return jsonify({
+                    'error': 'This Idempotency-Key was already used for a different request',
+                    'errorCode': 422
+                }), 422
+
+            if recorded is not None:
+                logger.debug('Replaying the recorded response for Idempotency-Key %s', key)
+                status, body = recorded
+                return Response(body, status=status, mimetype='application/json',
+                                headers={'Idempotent-Replayed': 'true'})
+
+            try:
+                response = make_response(func(*args, **kwargs))
+            except BaseException:
+                if not g.get('idempotent_side_effects', False):
+                    store.release(scoped_key)
+                else:
+                    # Record the failure, or a retry would run the side effects again once the claim is taken over
+                    body = jsonify({
+                        'error': 'The request failed after it had started, and can\'t be safely retried',
+                        'errorCode': 500
+                    }).get_data(as_text=True)
+                    store.complete(scoped_key, fingerprint, 500, body)
+                raise
+
+            if response.status_code >= 500 and not g.get('idempotent_side_effects', False):
+                store.release(scoped_key)
+            else:
+                store.complete(scoped_key, fingerprint, response.status_code, response.get_data(as_text=True))
+
+            return response
+        return wrapped_function
+    return decorator
@@ -7,6 +7,8 @@
 CRUD for Items
 """
 
+import logging
+
 from flask import Blueprint, jsonify, request
 
 from mizu.models import Machine
@@ -14,23 +16,39 @@ from mizu.models import Slot
 from mizu.models import Item
 
 from sqlalchemy import orm
+from sqlalchemy import exc
 
+from mizu import app
 from mizu import db
-from mizu import logger
 from mizu.data_adapters import SqlAlchemyAdapter
 from mizu.data_adapters import MockAdapter
+from mizu.data_adapters import catalog_cache
 
 from mizu.auth import check_token
 from mizu.data_adapters import get_adapter
 
 from mizu.errors import bad_params, bad_headers_content_type
+from mizu.conditional import conditional, make_etag
+
+logger = logging.getLogger(__name__)
 
 items_bp = Blueprint('items_bp', __name__)
 
+BATCH_OPERATIONS = ('create', 'update', 'delete')
+MAX_BATCH_SIZE = 500
+
+
+def _items_etag(adapter):
+    """ The item list only changes with the catalog version """
+    if adapter is not SqlAlchemyAdapter:
+        return None
+    return make_etag('items', catalog_cache.snapshot().version)
+
 
 @items_bp.route('/items', methods=['GET'])
 @get_adapter
 @check_token()
+@conditional(_items_etag, app.config['ITEMS_CACHE_CONTROL'])
 def get_items(adapter):
     """ Query for all items """
 
@@ -53,7 +71,7 @@ def get_items(adapter):
 
 @items_bp.route('/items', methods=['POST', 'PUT', 'DELETE'])
 @get_adapter
-@check_token(admin_only=True)
+@check_token(admin_only=True, allow_mock=True)
 def manage_items(adapter):
     """ Route for retrieving, creating, and deleting items."""
     if request.method == 'POST':
@@ -182,3 +200,136 @@ def manage_items(adapter):
         }
         return jsonify(success), 200
 
+
+
+@items_bp.route('/items/batch', methods=['POST'])
+@get_adapter
+@check_token(admin_only=True, allow_mock=True)
+def batch_items(adapter):
+    """ Create, update, and delete many items at once
+
+    The body is of the form
+    ``{"create": [{"name", "price"}], "update": [{"id", "name", "price"}], "delete": [{"id"}]}``, where any of the lists
+    may be left out. Every entry is validated before anything is changed, and then all of them are applied in a single
+    transaction - if any entry is invalid, nothing is changed and the response reports the problem with each entry.
+    """
+    if request.headers.get('Content-Type') != 'application/json':
+        return bad_headers_content_type()
+
+    body = request.json
+    if not isinstance(body, dict):
+        return bad_params('The body must be an object of the items to create, update, and delete')
+
+    logger.debug('Handling batch item changes')
+
+    entries = {op: body.get(op, []) for op in BATCH_OPERATIONS}
+    if not all(isinstance(op_entries, list) for op_entries in entries.values()):
+        return bad_params('Each of {} must be a list of items'.format(', '.join(BATCH_OPERATIONS)))
+
+    total = sum(len(op_entries) for op_entries in entries.values())
+    if total == 0:
+        return bad_params('At least one item must be provided to create, update, or delete')
+    if total > MAX_BATCH_SIZE:
+        return bad_params('At most {} items can be changed at once'.format(MAX_BATCH_SIZE))
+
+    results = {op: [] for op in BATCH_OPERATIONS}
+    creates, updates, deletes = [], [], []
+
+    for entry in entries['create']:
+        try:
+            creates.append(_parse_item(entry, require=('name', 'price')))
+            results['create'].append({'status': 'ok'})
+        except ValueError as e:
+            results['create'].append({'status': 'error', 'error': str(e)})
+
+    for op, require, parsed in [('update', ('id',), updates), ('delete', ('id',), deletes)]:
+        for entry in entries[op]:
+            try:
+                fields = _parse_item(entry, require=require)
+                if op == 'update' and 'name' not in fields and 'price' not in fields:
+                    raise ValueError('The name, price, or both values of an item must be provided to update')
+                parsed.append(fields)
+                results[op].append({'status': 'ok'})
+            except ValueError as e:
+                parsed.append(None)
+                results[op].append({'status': 'error', 'error': str(e)})
+
+    # Check every referenced item exists with one query
+    existing = adapter.find_items([fields['id'] for fields in updates + deletes if fields is not None])
+    for op, parsed in [('update', updates), ('delete', deletes)]:
+        for fields, result in zip(parsed, results[op]):
+            if fields is not None and fields['id'] not in existing:
+                result.update(status='error', error='No item with ID {} is present in the system'.format(fields['id']))
+
+    failed = sum(1 for op_results in results.values() for result in op_results if result['status'] == 'error')
+    if failed:
+        return jsonify({
+            'error': 'Nothing was changed, as {} of the {} items were invalid'.format(failed, total),
+            'errorCode': 400,
+            'results': results,
+        }), 400
+
+    logger.debug('Batch item changes validated')
+
+    try:
+        created = adapter.apply_item_batch(creates, updates, [fields['id'] for fields in deletes])
+    except exc.IntegrityError:
+        db.session.rollback()
+        return jsonify({
+            'error': 'Nothing was changed, as items being deleted are still assigned to slots or have been dropped',
+            'errorCode': 409,
+        }), 409
+
+    for item, result in zip(created, results['create']):
+        result['item'] = item
+    for fields, result in zip(updates, results['update']):
+        result['item'] = dict(existing[fields['id']], **fields)
+    for fields, result in zip(deletes, results['delete']):
+        result['item'] = existing[fields['id']]
+
+    success = {
+        'message': 'Created {}, updated {}, and deleted {} items'.format(len(creates), len(updates), len(deletes)),
+        'results': results,
+    }
+    return jsonify(success), 200
+
+
+###############################################################################
+# Private / Helper functions
+
+def _parse_item(entry, require=()):
+    """ Validate the ``id``, ``name``, and ``price`` of an item in a batch, keeping only those provided
+
+    Raises:
+        ValueError: with a message for the client, if a field is missing or invalid
+    """
+    if not isinstance(entry, dict):
+        raise ValueError('Each item must be an object')
+
+    unprovided = [field for field in require if field not in entry]
+    if unprovided:
+        raise ValueError('The following required parameters were not provided: {}'.format(', '.join(unprovided)))
+
+    fields = {}
+    if 'id' in entry:
+        try:
+            fields['id'] = int(entry['id'])
+            if fields['id'] < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise ValueError('Item ID value provided was invalid')
+
+    if 'name' in entry:
+        if not isinstance(entry['name'], str) or entry['name'] == '':
+            raise ValueError('An item cannot have an empty name')
+        fields['name'] = entry['name']
+
+    if 'price' in entry:
+        try:
+            fields['price'] = int(entry['price'])
+            if fields['price'] < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise ValueError('You cannot create a worthless item')
+
+    return fields
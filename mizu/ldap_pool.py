@@ -0,0 +1,189 @@
+""" Mizu - ldap_pool.py
+
+A bounded pool of bound CSH LDAP connections shared by every thread in a worker
+"""
+
+import logging
+import time
+import queue
+import threading
+
+from contextlib import contextmanager
+
+import ldap
+
+from mizu import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPPoolTimeout(Exception):
+    """ Raised when no LDAP connection could be checked out of the pool in time """
+    pass
+
+
+class LDAPPool:
+    """ Hands out ``CSHLDAP`` connections to one thread at a time
+
+    Connections are created (and so bound) lazily, the first time the pool has no idle connection to hand out and is
+    below ``max_size``. A connection that has sat idle for longer than ``idle_check`` seconds is checked with a
+    ``whoami`` before being handed out, and replaced if the bind has gone stale. Connections that fail with
+    ``SERVER_DOWN`` while checked out are discarded rather than returned to the pool.
+
+    Args:
+        factory (callable): creates a new, bound ``CSHLDAP`` instance
+        max_size (int): the maximum number of connections open at once
+        idle_check (float): seconds a connection can sit idle before it is health checked on checkout
+        checkout_timeout (float): seconds to wait for a connection when the pool is exhausted
+    """
+
+    def __init__(self, factory, max_size, idle_check, checkout_timeout):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_check = idle_check
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._created = 0
+        self._discarded = 0
+        self._in_use = 0
+
+    @contextmanager
+    def connection(self):
+        """ Check a ``CSHLDAP`` connection out of the pool for the duration of the ``with`` block
+
+        Raises:
+            LDAPPoolTimeout: if the pool is exhausted and no connection was returned within ``checkout_timeout``
+        """
+        lib = self._checkout()
+        try:
+            yield lib
+        except ldap.SERVER_DOWN:
+            self._discard(lib)
+            raise
+        except BaseException:
+            self._checkin(lib)
+            raise
+        else:
+            self._checkin(lib)
+
+    def call(self, func, *args, **kwargs):
+        """ Call ``func(lib, *args, **kwargs)`` with a pooled connection, retrying once on a fresh connection if the
+        server went away underneath the first
+        """
+        try:
+            with self.connection() as lib:
+                return func(lib, *args, **kwargs)
+        except ldap.SERVER_DOWN:
+            logger.info('LDAP connection was lost, retrying on a new connection')
+
+        with self.connection() as lib:
+            return func(lib, *args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': self._idle.qsize(),
+                'in_use': self._in_use,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'wait_time_max': self._max_wait_time,
+                'created': self._created,
+                'discarded': self._discarded,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _checkout(self):
+        start = time.monotonic()
+        waited = False
+
+        while True:
+            try:
+                lib, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                lib = self._create()
+                idle_since = time.monotonic()
+
+            if lib is None:
+                # At capacity - wait a moment for another thread to give a connection back, or for one to be discarded
+                waited = True
+                remaining = self.checkout_timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise LDAPPoolTimeout('No LDAP connection became available within {}s'.format(
+                        self.checkout_timeout
+                    ))
+                try:
+                    lib, idle_since = self._idle.get(timeout=min(remaining, 0.1))
+                except queue.Empty:
+                    continue
+
+            if time.monotonic() - idle_since > self.idle_check and not self._healthy(lib):
+                self._discard(lib, checked_out=False)
+                continue
+
+            break
+
+        wait_time = time.monotonic() - start
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            if waited:
+                self._waits += 1
+            self._wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+
+        return lib
+
+    def _checkin(self, lib):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put((lib, time.monotonic()))
+
+    def _discard(self, lib, checked_out=True):
+        with self._lock:
+            if checked_out:
+                self._in_use -= 1
+            self._size -= 1
+            self._discarded += 1
+        logger.info('Discarded an LDAP connection')
+
+    def _create(self):
+        """ Create and bind a new connection if the pool is below capacity, returning ``None`` otherwise """
+        with self._lock:
+            if self._size >= self.max_size:
+                return None
+            self._size += 1
+
+        try:
+            with metrics.LDAP_SECONDS.time('bind'):
+                lib = self.factory()
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+            raise
+
+        with self._lock:
+            self._created += 1
+        logger.debug('Bound a new LDAP connection, pool size is now %s', self._size)
+        return lib
+
+    @staticmethod
+    @metrics.LDAP_SECONDS.time('whoami')
+    def _healthy(lib):
+        try:
+            lib.get_con().whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
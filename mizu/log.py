@@ -0,0 +1,176 @@
+""" Mizu - log.py
+
+Log output, as text or as one JSON object per line, written by a background thread so that logging never blocks a
+request. Every line carries the ID of the request it was logged for.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_app_context
+
+# Attributes every LogRecord has - anything else was passed in ``extra`` and is written out as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+
+class RequestIdFilter(logging.Filter):
+    """ Stamps each record with the ID of the request being handled on the thread that logged it, or ``-`` """
+
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_app_context() else '-'
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a single line JSON object, including any fields passed in ``extra`` """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ Formats a record as a line of text, followed by any fields passed in ``extra`` as JSON """
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        extra = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if extra:
+            line += ' ' + json.dumps(extra, default=str)
+        return line
+
+
+class LogPipeline:
+    """ Routes log records through a bounded queue to a background thread that formats and writes them
+
+    Records are only built for enabled levels, and the thread that logs one only resolves its message (and any
+    traceback) before handing it off, so a disabled ``logger.debug('...', arg)`` costs a level check and an enabled one
+    a string interpolation. If the writer falls ``queue_size`` records behind, new records are dropped and counted
+    rather than blocking the caller.
+
+    Args:
+        stream: where log lines are written
+        log_format (str): ``text`` or ``json``
+        queue_size (int): the most records waiting to be written
+    """
+
+    def __init__(self, stream, log_format, queue_size):
+        self.handler = logging.StreamHandler(stream)
+        self.handler.setFormatter(JSONFormatter() if log_format == 'json' else TextFormatter())
+
+        self.queue = queue.Queue(queue_size)
+        self.queue_handler = _NonBlockingQueueHandler(self)
+        self.queue_handler.addFilter(RequestIdFilter())
+
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.dropped = 0
+
+    def install(self, logger, level, levels):
+        """ Send everything ``logger`` and its children log through the pipeline
+
+        Args:
+            logger (logging.Logger): the logger to attach to
+            level (str): the level for ``logger``
+            levels (dict): logger name -> level, for loggers that should be more or less verbose than ``logger``
+        """
+        logger.setLevel(level)
+        for name, module_level in levels.items():
+            logging.getLogger(name).setLevel(module_level.upper())
+
+        logger.addHandler(self.queue_handler)
+        logger.propagate = False
+
+        self.ensure_started()
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        """ Start the writer thread for this process if it isn't already running """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """ Write out everything still queued, and stop the writer thread """
+        with self._lock:
+            listener, self._listener = self._listener, None
+            self._pid = None
+
+        if listener is not None:
+            listener.stop()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped,
+        }
+
+
+###############################################################################
+# Private / Helper functions
+
+class _NonBlockingQueueHandler(QueueHandler):
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self._exception_formatter = logging.Formatter()
+
+    def enqueue(self, record):
+        self.pipeline.ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.pipeline._lock:
+                self.pipeline.dropped += 1
+
+    def prepare(self, record):
+        """ Resolve the message and traceback while the arguments are still valid, leaving the formatting to the writer
+        thread
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
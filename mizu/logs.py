@@ -0,0 +1,289 @@
+""" Mizu - logs.py
+
+/logs
+/logs/top-items
+/logs/hourly
+/logs/revenue
+
+Routes for browsing the drop history, and aggregates over it
+"""
+
+import json
+import base64
+
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, jsonify, request
+
+from sqlalchemy import func, tuple_
+
+from mizu import db
+from mizu.models import Log
+from mizu.db_utils import truncate_time, as_datetime, parse_time
+
+from mizu.auth import check_token
+from mizu.errors import bad_params
+from mizu.data_adapters import catalog_cache
+
+logs_bp = Blueprint('logs_bp', __name__)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# Aggregates cover the last AGGREGATE_DEFAULT_DAYS unless a range is given
+AGGREGATE_DEFAULT_DAYS = 30
+
+
+@logs_bp.route('/logs', methods=['GET'])
+@check_token(return_user_obj=True)
+def get_logs(user=None):
+    """ List drops, newest first, a page at a time
+
+    Members can only see their own drops; drink admins and trusted clients can see everyone's.
+
+    Query parameters:
+        user: only drops by this uid
+        machine: only drops from the machine with this name
+        item: only drops of the item with this ID
+        since, until: only drops in this range, as ISO 8601 timestamps
+        limit: the maximum number of drops to return, up to 500
+        cursor: continue from the ``next`` value of the previous page
+    """
+    uid = request.args.get('user', None)
+    if user is not None and 'drink' not in user['groups']:
+        if uid is not None and uid != user['preferred_username']:
+            return jsonify({
+                'error': 'User does not have the correct permissions',
+                'errorCode': 401
+            }), 401
+        uid = user['preferred_username']
+
+    snapshot = catalog_cache.snapshot()
+    try:
+        limit = _parse_limit(request.args.get('limit', None))
+        filters = _parse_filters(snapshot, uid=uid)
+        cursor = _decode_cursor(request.args.get('cursor', None))
+    except ValueError as e:
+        return bad_params(str(e))
+
+    query = db.session.query(Log).filter(*filters)
+    if cursor is not None:
+        # Keyset pagination - seek straight to the end of the previous page in the (user|machine, time) index, or the
+        # (time, id) index when neither is filtered on
+        query = query.filter(tuple_(Log.time, Log.id) < cursor)
+
+    logs = query.order_by(Log.time.desc(), Log.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = _encode_cursor(logs[-1])
+
+    machine_names = {machine['id']: machine['name'] for machine in snapshot.machines}
+    success = {
+        'message': 'Retrieved {} drops'.format(len(logs)),
+        'logs': [_serialize_log(log, machine_names, snapshot.items_by_id) for log in logs],
+        'next': next_cursor,
+    }
+    return jsonify(success), 200
+
+
+@logs_bp.route('/logs/top-items', methods=['GET'])
+@check_token(admin_only=True)
+def get_top_items():
+    """ The most dropped items, by number of drops, over a range (the last 30 days by default)
+
+    Query parameters:
+        machine, since, until: as for ``/logs``
+        limit: the number of items to return, 10 by default
+    """
+    snapshot = catalog_cache.snapshot()
+    try:
+        limit = _parse_limit(request.args.get('limit', None), default=10)
+        filters = _parse_filters(snapshot, aggregate=True)
+    except ValueError as e:
+        return bad_params(str(e))
+
+    drops = func.count(Log.id).label('drops')
+    rows = db.session.query(Log.item, drops, func.sum(Log.price)).\
+        filter(*filters).\
+        group_by(Log.item).\
+        order_by(drops.desc()).\
+        limit(limit).all()
+
+    items = []
+    for item_id, count, revenue in rows:
+        item = snapshot.items_by_id.get(item_id)
+        items.append({
+            'item_id': item_id,
+            'name': item['name'] if item is not None else None,
+            'drops': count,
+            'revenue': revenue or 0,
+        })
+
+    success = {
+        'message': 'Retrieved the top {} items'.format(len(items)),
+        'items': items,
+    }
+    return jsonify(success), 200
+
+
+@logs_bp.route('/logs/hourly', methods=['GET'])
+@check_token(admin_only=True)
+def get_hourly_drops():
+    """ The number of drops in each hour of a range (the last 30 days by default). Hours without drops are left out.
+
+    Query parameters:
+        machine, item, since, until: as for ``/logs``
+    """
+    snapshot = catalog_cache.snapshot()
+    try:
+        filters = _parse_filters(snapshot, aggregate=True)
+    except ValueError as e:
+        return bad_params(str(e))
+
+    hour = truncate_time(Log.time, 'hour').label('hour')
+
+    rows = db.session.query(hour, func.count(Log.id)).\
+        filter(*filters).\
+        group_by(hour).\
+        order_by(hour).all()
+
+    hours = [{'hour': _isoformat(hour), 'drops': count} for hour, count in rows]
+
+    success = {
+        'message': 'Retrieved drops for {} hours'.format(len(hours)),
+        'hours': hours,
+    }
+    return jsonify(success), 200
+
+
+@logs_bp.route('/logs/revenue', methods=['GET'])
+@check_token(admin_only=True)
+def get_revenue():
+    """ The number of drops and credits spent at each machine over a range (the last 30 days by default)
+
+    Query parameters:
+        since, until: as for ``/logs``
+    """
+    snapshot = catalog_cache.snapshot()
+    try:
+        filters = _parse_filters(snapshot, aggregate=True)
+    except ValueError as e:
+        return bad_params(str(e))
+
+    rows = db.session.query(Log.machine, func.count(Log.id), func.sum(Log.price)).\
+        filter(*filters).\
+        group_by(Log.machine).all()
+
+    machine_names = {machine['id']: machine['name'] for machine in snapshot.machines}
+    machines = [{
+        'machine': machine_names.get(machine_id),
+        'drops': count,
+        'revenue': revenue or 0,
+    } for machine_id, count, revenue in rows]
+
+    success = {
+        'message': 'Retrieved revenue for {} machines'.format(len(machines)),
+        'machines': machines,
+    }
+    return jsonify(success), 200
+
+
+###############################################################################
+# Private / Helper functions
+
+def _parse_filters(snapshot, uid=None, aggregate=False):
+    """ Build the filters on ``Log`` from the ``machine``, ``item``, ``since`` and ``until`` query parameters
+
+    Args:
+        uid (str): only include drops by this user
+        aggregate (bool): default to the last ``AGGREGATE_DEFAULT_DAYS`` days, and always filter by machine so the
+            ``(machine, time)`` index can be used for the range
+
+    Raises:
+        ValueError: with a message for the client, if a parameter is invalid
+    """
+    filters = []
+
+    if uid is not None:
+        filters.append(Log.user == uid)
+
+    machine_name = request.args.get('machine', None)
+    if machine_name is not None:
+        machine = snapshot.machines_by_name.get(machine_name)
+        if machine is None:
+            raise ValueError('The provided machine name \'{}\' is not a valid machine'.format(machine_name))
+        filters.append(Log.machine == machine['id'])
+    elif aggregate:
+        filters.append(Log.machine.in_([machine['id'] for machine in snapshot.machines]))
+
+    item_id = request.args.get('item', None)
+    if item_id is not None:
+        try:
+            filters.append(Log.item == int(item_id))
+        except ValueError:
+            raise ValueError('The item ID value must be an integer')
+
+    since = parse_time(request.args.get('since', None), 'since')
+    until = parse_time(request.args.get('until', None), 'until')
+    if since is None and aggregate:
+        since = datetime.utcnow() - timedelta(days=AGGREGATE_DEFAULT_DAYS)
+
+    if since is not None:
+        filters.append(Log.time >= since)
+    if until is not None:
+        filters.append(Log.time < until)
+
+    return filters
+
+
+def _parse_limit(value, default=DEFAULT_LIMIT):
+    if value is None:
+        return default
+
+    try:
+        limit = int(value)
+        if limit <= 0:
+            raise ValueError()
+    except ValueError:
+        raise ValueError('The limit must be a positive integer')
+
+    return min(limit, MAX_LIMIT)
+
+
+def _encode_cursor(log):
+    """ An opaque cursor for the page after ``log`` """
+    raw = json.dumps([log.time.isoformat(), log.id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    if cursor is None:
+        return None
+
+    try:
+        time, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return datetime.fromisoformat(time), int(log_id)
+    except (ValueError, TypeError):
+        raise ValueError('The provided cursor is invalid')
+
+
+def _isoformat(value):
+    """ Format a naive UTC datetime as ISO 8601 """
+    return as_datetime(value).replace(tzinfo=timezone.utc).isoformat()
+
+
+def _serialize_log(log, machine_names, items_by_id):
+    item = items_by_id.get(log.item)
+    return {
+        'id': log.id,
+        'machine': machine_names.get(log.machine),
+        'item_id': log.item,
+        'item_name': item['name'] if item is not None else None,
+        'user': log.user,
+        'time': _isoformat(log.time),
+        'price': log.price,
+        'balance_before': log.balance_before,
+        'balance_after': log.balance_after,
+    }
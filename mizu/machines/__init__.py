@@ -0,0 +1,4 @@
+from .poller import MachinePoller
+from .status_cache import StatusCache
+from .breaker import CircuitBreaker, CircuitOpenError
+from .client import get_machine_status, drop
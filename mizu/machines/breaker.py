@@ -0,0 +1,161 @@
+""" Mizu - machines/breaker.py
+
+Per-machine circuit breakers, so an unreachable machine fails fast instead of costing every caller a full timeout
+"""
+
+import logging
+import time
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised in place of contacting a machine whose circuit is open
+
+    This is a ``ConnectionError`` so that callers already handling unreachable machines need no special casing.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """ A closed / open / half-open circuit breaker guarding the calls made to a single machine
+
+    After ``failure_threshold`` consecutive connection failures or timeouts the circuit opens, and calls fail
+    immediately with ``CircuitOpenError``. Once the backoff has elapsed the circuit is half-open, and a single probe
+    call is let through: success closes the circuit, failure opens it again with the backoff doubled (up to
+    ``max_backoff``).
+
+    Args:
+        name (str): the name of the machine this breaker guards
+        failure_threshold (int): consecutive failures that open the circuit
+        base_backoff (float): seconds the circuit stays open after first opening
+        max_backoff (float): the upper bound on the open duration
+    """
+
+    def __init__(self, name, failure_threshold, base_backoff, max_backoff):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.state = CLOSED
+        self.failures = 0
+        self.backoff = base_backoff
+        self.opened_at = None
+        self.transitions = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        self.rejected = 0
+
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """ Call ``func`` through the breaker
+
+        Raises:
+            CircuitOpenError: if the circuit is open, or half-open with a probe already in flight
+        """
+        self._before_call()
+
+        try:
+            result = func(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self._record(success=False)
+            raise
+        except BaseException:
+            # The machine answered, just not happily - that says nothing about whether it's reachable
+            self._record(success=True)
+            raise
+
+        self._record(success=True)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'consecutive_failures': self.failures,
+                'backoff': self.backoff,
+                'rejected': self.rejected,
+                'transitions': dict(self.transitions),
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _current_state(self):
+        """ The state of the circuit, moving an open circuit to half-open if its backoff has elapsed """
+        if self.state == OPEN and time.time() - self.opened_at >= self.backoff:
+            self._transition(HALF_OPEN)
+        return self.state
+
+    def _before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+
+            self.rejected += 1
+
+        raise CircuitOpenError('The circuit for machine {} is {}, not contacting it'.format(self.name, state))
+
+    def _record(self, success):
+        with self._lock:
+            was_probe = self._probing
+            self._probing = False
+
+            if success:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.backoff = self.base_backoff
+                    self._transition(CLOSED)
+                return
+
+            self.failures += 1
+            if was_probe:
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self._open()
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.opened_at = time.time()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        logger.info('Circuit for machine %s is now %s', self.name, state)
+        self.state = state
+        self.transitions[state] += 1
+
+
+class BreakerRegistry:
+    """ Lazily creates and holds one ``CircuitBreaker`` per machine """
+
+    def __init__(self, failure_threshold, base_backoff, max_backoff):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, machine_name):
+        with self._lock:
+            breaker = self._breakers.get(machine_name)
+            if breaker is None:
+                breaker = CircuitBreaker(machine_name, self.failure_threshold, self.base_backoff, self.max_backoff)
+                self._breakers[machine_name] = breaker
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.stats() for name, breaker in breakers.items()}
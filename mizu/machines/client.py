@@ -0,0 +1,121 @@
+""" Mizu - machines/client.py
+
+HTTP calls made to the drink machines themselves
+"""
+
+import logging
+import time
+
+import requests
+
+from mizu import app
+from mizu import metrics
+from mizu import tracing
+from mizu import stats
+from mizu import http_client
+
+from .breaker import BreakerRegistry, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+breakers = BreakerRegistry(app.config['MACHINE_BREAKER_FAILURES'],
+                           app.config['MACHINE_BREAKER_BACKOFF'],
+                           app.config['MACHINE_BREAKER_MAX_BACKOFF'])
+stats.register('machine_breakers', breakers.stats)
+
+
+def get_machine_status(machine_name):
+    """ helper function to query a machine given it's name (should be the actual hostname, will be dropped into the
+        ``MACHINE_URL`` template), and return slot status information in a more programmatically useful way.
+
+        Realistically, the data should look like this coming back from the mahcine -- this is low hanging fruit for someone
+        to fix.
+
+        Warning::
+
+            This doesn't actually validate the machine name. That should be done in what ever route needs to call this function.
+
+        Raises:
+            requests.exceptions.HTTPError: in the event the machine responds with a non-2XX
+            requests.exceptions.Timeout: if the machine does not respond with any bytes within
+                ``MACHINE_READ_TIMEOUT`` seconds
+            requests.exceptions.ConnectionError: if the machine is not online
+            mizu.machines.CircuitOpenError: if the machine has been failing, and was not contacted at all
+    """
+
+    headers = {
+        'X-Auth-Token': app.config['MACHINE_API_TOKEN'],
+        'Content-Type': 'application/json'
+    }
+
+    endpoint = '{}/health'.format(_url(machine_name))
+    health_status = _call(machine_name, 'health', http_client.get, endpoint, headers=headers, timeout=_timeout())
+    health_status.raise_for_status()
+
+    health_results = health_status.json()
+
+    logger.debug('Reached machine %s succesfully', machine_name)
+
+    slots = []
+
+    for idx, slot in enumerate(health_results['slots'], 1):
+        slots.append({
+            'number': idx,
+            'w1id': slot.split('(')[1].split(')')[0],
+            'empty': 'empty' in slot
+        })
+
+    return slots
+
+
+def drop(machine_name, slot_number):
+    """ Ask a machine to drop the contents of one of its slots
+
+    Returns:
+        requests.Response: the machine's response, which may be a non-2XX
+
+    Raises:
+        requests.exceptions.Timeout: if the machine does not respond within ``MACHINE_READ_TIMEOUT`` seconds
+        requests.exceptions.ConnectionError: if the machine is not online
+        mizu.machines.CircuitOpenError: if the machine has been failing, and was not contacted at all
+    """
+    headers = {
+        'X-Auth-Token': app.config['MACHINE_API_TOKEN'],
+        'Content-Type': 'application/json'
+    }
+
+    body = {
+        "slot": slot_number
+    }
+
+    endpoint = '{}/drop'.format(_url(machine_name))
+    return _call(machine_name, 'drop', http_client.post, endpoint, json=body, headers=headers, timeout=_timeout())
+
+
+def _call(machine_name, endpoint_name, method, *args, **kwargs):
+    """ Make a call to a machine through its circuit breaker, timing it by outcome """
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        with tracing.span('machine.' + endpoint_name, machine=machine_name):
+            response = breakers.get(machine_name).call(method, *args, **kwargs)
+        outcome = 'ok' if response.status_code < 400 else 'http_error'
+        return response
+    except CircuitOpenError:
+        outcome = 'circuit_open'
+        raise
+    except requests.exceptions.Timeout:
+        outcome = 'timeout'
+        raise
+    finally:
+        metrics.MACHINE_SECONDS.observe(time.perf_counter() - start, machine_name, endpoint_name, outcome)
+
+
+def _url(machine_name):
+    """ The base URL of a machine """
+    return app.config['MACHINE_URL'].format(machine_name).rstrip('/')
+
+
+def _timeout():
+    """ The ``(connect, read)`` timeouts used for calls to machines """
+    return (app.config['MACHINE_CONNECT_TIMEOUT'], app.config['MACHINE_READ_TIMEOUT'])
@@ -0,0 +1,76 @@
+""" Mizu - machines/poller.py
+
+A long lived, bounded pool of threads used to talk to the drink machines concurrently
+"""
+
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class MachinePoller:
+    """ Fans calls out to several machines at once, bounding the total wait by a single per-machine budget
+
+    The underlying thread pool is created on first use and shared by every request handled by the worker. It is
+    recreated if the process has forked since it was created, so the poller is safe to build at import time.
+
+    Args:
+        max_workers (int): the maximum number of machines that will be contacted at once
+        budget (float): the number of seconds to wait for all machines to answer before giving up on the stragglers
+    """
+
+    def __init__(self, max_workers, budget):
+        self.max_workers = max_workers
+        self.budget = budget
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """ The shared ``ThreadPoolExecutor``, created for the current process if need be """
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='mizu-machine')
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        """ Run a single call on the shared pool, returning its ``Future`` """
+        return self.executor.submit(func, *args, **kwargs)
+
+    def poll(self, func, machine_names, budget=None):
+        """ Call ``func(machine_name)`` for every machine concurrently
+
+        Args:
+            func (callable): called once per machine with the machine's name
+            machine_names (list): the names of the machines to poll
+            budget (float): overrides the poller's default budget for this call
+
+        Returns:
+            dict: machine name -> ``(result, error)``, where exactly one of the two is ``None``. Machines that did not
+                answer within the budget have a ``TimeoutError`` as their error.
+        """
+        if budget is None:
+            budget = self.budget
+
+        futures = {name: self.submit(func, name) for name in machine_names}
+        wait(futures.values(), timeout=budget)
+
+        results = {}
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                logger.debug('Machine %s did not answer within the %ss budget', name, budget)
+                results[name] = (None, TimeoutError('Machine did not answer within {}s'.format(budget)))
+            elif future.exception() is not None:
+                results[name] = (None, future.exception())
+            else:
+                results[name] = (future.result(), None)
+
+        return results
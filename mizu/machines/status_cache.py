@@ -0,0 +1,205 @@
+""" Mizu - machines/status_cache.py
+
+An in-process cache of the last known slot status of every machine, kept fresh by a background refresher
+"""
+
+import logging
+import os
+import time
+import threading
+
+from mizu import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StatusCache:
+    """ Caches the parsed health status of each machine with stale-while-revalidate semantics
+
+    Every ``interval`` seconds a background thread polls all known machines through the shared ``MachinePoller``.
+    Readers are answered from the cache immediately; an entry older than ``interval`` wakes the refresher early but is
+    still returned. Only a machine that has never been polled is fetched in the foreground.
+
+    Each entry is a dict of the form::
+
+        {
+            'slots': [...],        # the parsed slot status, last known good if the machine is offline
+            'is_online': bool,     # whether the last poll succeeded
+            'last_seen': float,    # epoch seconds of the last successful poll, or None
+            'checked_at': float,   # epoch seconds of the last poll, successful or not
+            'error': Exception,    # the error raised by the last poll, or None
+        }
+
+    Args:
+        poller (MachinePoller): the shared pool polls are run on
+        fetch (callable): called with a machine name, returns its parsed slot status or raises
+        list_machines (callable): returns the names of every machine that should be refreshed in the background
+        interval (float): seconds between background refreshes
+        on_change (callable): called with the machine name, previous entry, and new entry whenever a machine goes on or
+            offline or its slots change
+    """
+
+    def __init__(self, poller, fetch, list_machines, interval, on_change=None):
+        self.poller = poller
+        self.fetch = fetch
+        self.list_machines = list_machines
+        self.interval = interval
+        self.on_change = on_change
+
+        self._entries = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def get(self, machine_name):
+        """ Get the cached status of a machine, fetching it only if it has never been polled
+
+        Returns:
+            dict: the cache entry for the machine
+        """
+        return self.get_many([machine_name])[machine_name]
+
+    def get_many(self, machine_names):
+        """ Get the cached status of several machines, polling the ones never seen before concurrently
+
+        Returns:
+            dict: machine name -> cache entry
+        """
+        self.ensure_started()
+
+        now = time.time()
+        with self._lock:
+            entries = {name: self._entries.get(name) for name in machine_names}
+
+        missing = [name for name, entry in entries.items() if entry is None]
+        if missing:
+            entries.update(self.refresh(missing))
+
+        if any(now - entry['checked_at'] > self.interval for entry in entries.values()):
+            self._wake.set()
+
+        return entries
+
+    def get_fresh(self, machine_name, max_age):
+        """ Get the status of a machine, polling it in the foreground if the cached entry is older than ``max_age``
+
+        If another thread is already polling the machine, its result is waited for instead of returning the stale entry.
+        """
+        with self._lock:
+            entry = self._entries.get(machine_name)
+
+        if entry is None or time.time() - entry['checked_at'] > max_age:
+            entry = self.refresh([machine_name])[machine_name]
+
+        return entry
+
+    def refresh(self, machine_names):
+        """ Poll the provided machines now and store the results
+
+        Machines that are already being refreshed by another thread are waited on (for up to the poller's budget)
+        rather than polled twice.
+
+        Returns:
+            dict: machine name -> the new cache entry
+        """
+        to_poll = []
+        in_flight = []
+        with self._lock:
+            for name in machine_names:
+                done = self._refreshing.get(name)
+                if done is None:
+                    self._refreshing[name] = threading.Event()
+                    to_poll.append(name)
+                else:
+                    in_flight.append(done)
+
+        changes = []
+        try:
+            results = self.poller.poll(self.fetch, to_poll) if to_poll else {}
+            now = time.time()
+
+            with self._lock:
+                for name, (slots, error) in results.items():
+                    previous = self._entries.get(name)
+                    if error is None:
+                        entry = {'slots': slots, 'is_online': True, 'last_seen': now, 'checked_at': now,
+                                 'error': None}
+                    else:
+                        entry = {
+                            'slots': previous['slots'] if previous else None,
+                            'is_online': False,
+                            'last_seen': previous['last_seen'] if previous else None,
+                            'checked_at': now,
+                            'error': error,
+                        }
+
+                    if previous is not None and previous['is_online'] != entry['is_online']:
+                        logger.info('Machine %s is now %s', name, 'online' if entry['is_online'] else 'offline')
+
+                    if previous is not None and (previous['is_online'] != entry['is_online'] or
+                                                 previous['slots'] != entry['slots']):
+                        changes.append((name, previous, entry))
+
+                    self._entries[name] = entry
+                    metrics.MACHINE_POLLS.inc(name, 'online' if entry['is_online'] else 'offline')
+        finally:
+            with self._lock:
+                for name in to_poll:
+                    self._refreshing.pop(name).set()
+
+        if self.on_change is not None:
+            for name, previous, entry in changes:
+                try:
+                    self.on_change(name, previous, entry)
+                except Exception:
+                    logger.exception('Could not report a status change for machine %s', name)
+
+        # Wait out any refresh of the remaining machines another thread started before us
+        deadline = time.time() + self.poller.budget
+        for done in in_flight:
+            done.wait(max(0, deadline - time.time()))
+
+        with self._lock:
+            return {name: self._entries.get(name) or StatusCache._unknown() for name in machine_names}
+
+    def ensure_started(self):
+        """ Start the background refresher for this process if it isn't already running """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='mizu-status-refresher', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                name: {
+                    'is_online': entry['is_online'],
+                    'age': now - entry['checked_at'],
+                    'last_seen': entry['last_seen'],
+                }
+                for name, entry in self._entries.items()
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh(self.list_machines())
+            except Exception:
+                logger.exception('Background machine status refresh failed')
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    @staticmethod
+    def _unknown():
+        return {'slots': None, 'is_online': False, 'last_seen': None, 'checked_at': 0,
+                'error': TimeoutError('Machine status is not yet known')}
@@ -0,0 +1,224 @@
+""" Mizu - metrics.py
+
+Latency histograms and counters for requests and everything they wait on (SSO, LDAP, the database, and the machines),
+exposed in the Prometheus text format by the ``/metrics`` route
+
+Observations only take a lock and bump a counter, and label sets are bounded (routes, machines, and operation names
+rather than users or URLs), so collection is cheap enough to leave on.
+"""
+
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from mizu import tracing
+
+# Upper bounds, in seconds, of the latency buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_lock = threading.Lock()
+
+
+class Histogram:
+    """ Counts observations (usually durations) into buckets, per set of label values
+
+    Args:
+        name (str): the metric name
+        documentation (str): the help text
+        labelnames (tuple): the names of the labels every observation is given values for
+        buckets (tuple): the upper bounds of the buckets, in increasing order
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """ Record one observation with the provided label values """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """ Observe how long the ``with`` block (or decorated function) takes, whether or not it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+
+        lines = _header(self.name, self.documentation, 'histogram')
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket_labels = _labels(self.labelnames + ('le',), labels + (_format(bound),))
+                lines.append('{}_bucket{} {}'.format(self.name, bucket_labels, cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), _format(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Counter:
+    """ A count that only goes up, per set of label values """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+
+        lines = _header(self.name, self.documentation, 'counter')
+        for labels, value in series:
+            lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, labels), _format(value)))
+        return lines
+
+
+class Gauge:
+    """ A value read when the metrics are scraped, from a callable returning label values -> value """
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = _header(self.name, self.documentation, 'gauge')
+        if self.collect is not None:
+            for labels, value in sorted(self.collect().items()):
+                lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, labels), _format(value)))
+        return lines
+
+
+def register(metric):
+    """ Add a metric to those reported by ``render`` """
+    with _lock:
+        _metrics.append(metric)
+    return metric
+
+
+def render():
+    """ Render every registered metric in the Prometheus text exposition format """
+    with _lock:
+        metrics = list(_metrics)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_sqlalchemy():
+    """ Time every query run by any SQLAlchemy engine, by statement type """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+
+
+REQUEST_SECONDS = register(Histogram(
+    'mizu_request_duration_seconds', 'Time taken to handle requests, by route', ('method', 'route', 'status')
+))
+SSO_VERIFY_SECONDS = register(Histogram(
+    'mizu_sso_verify_duration_seconds', 'Time taken to verify bearer tokens', ('outcome',)
+))
+LDAP_SECONDS = register(Histogram(
+    'mizu_ldap_duration_seconds', 'Time taken by LDAP operations', ('operation',)
+))
+DB_QUERY_SECONDS = register(Histogram(
+    'mizu_db_query_duration_seconds', 'Time taken by database queries, by statement type', ('statement',)
+))
+MACHINE_SECONDS = register(Histogram(
+    'mizu_machine_request_duration_seconds', 'Time taken by calls to the drink machines',
+    ('machine', 'endpoint', 'outcome')
+))
+MACHINE_POLLS = register(Counter(
+    'mizu_machine_polls_total', 'Machine status polls, by the state they found the machine in', ('machine', 'state')
+))
+MACHINE_ONLINE = register(Gauge(
+    'mizu_machine_online', 'Whether a machine was online when last polled', ('machine',)
+))
+
+
+###############################################################################
+# Private / Helper functions
+
+_STATEMENTS = ('select', 'insert', 'update', 'delete')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('mizu_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('mizu_query_start')
+    if starts:
+        start = starts.pop()
+        end = time.perf_counter()
+        statement_type = _statement_type(statement)
+        DB_QUERY_SECONDS.observe(end - start, statement_type)
+        tracing.add_span('db.' + statement_type, start, end)
+
+
+def _handle_error(context):
+    connection = context.connection
+    starts = connection.info.get('mizu_query_start') if connection is not None else None
+    if starts:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - starts.pop(), 'error')
+
+
+def _statement_type(statement):
+    verb = statement.lstrip()[:6].lower()
+    return verb if verb in _STATEMENTS else 'other'
+
+
+def _header(name, documentation, kind):
+    return ['# HELP {} {}'.format(name, documentation), '# TYPE {} {}'.format(name, kind)]
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
@@ -6,6 +6,7 @@ from sqlalchemy import DateTime
 from sqlalchemy import Float
 from sqlalchemy import Text
 from sqlalchemy import Boolean
+from sqlalchemy import Index
 
 from mizu import db
 
@@ -49,18 +50,29 @@ class Slot(db.Model):
 
 class Log(db.Model):
     __tablename__ = 'logs'
+    __table_args__ = (
+        Index('ix_logs_user_time', 'user', 'time'),
+        Index('ix_logs_machine_time', 'machine', 'time'),
+        Index('ix_logs_time_id', 'time', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     machine = Column(ForeignKey('machines.id'), nullable=False)
     item = Column(ForeignKey('items.id'), nullable=False)
     user = Column(Text, nullable=False)
     time = Column(DateTime, nullable=False)
+    price = Column(Integer, nullable=True)
+    balance_before = Column(Integer, nullable=True)
+    balance_after = Column(Integer, nullable=True)
 
-    def __init__(self, machine, item, user, time):
+    def __init__(self, machine, item, user, time, price=None, balance_before=None, balance_after=None):
         self.machine = machine
         self.item = item
         self.user = user
         self.time = time
+        self.price = price
+        self.balance_before = balance_before
+        self.balance_after = balance_after
 
 class Temp(db.Model):
     __tablename__ = 'temps'
@@ -74,3 +86,78 @@ class Temp(db.Model):
         self.time = time
         self.temp = temp
 
+
+class TempRollup(db.Model):
+    __tablename__ = 'temp_rollups'
+
+    machine = Column(ForeignKey('machines.id'), primary_key=True)
+    resolution = Column(Text, primary_key=True)
+    time = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    minimum = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+
+    def __init__(self, machine, resolution, time, count, total, minimum, maximum):
+        self.machine = machine
+        self.resolution = resolution
+        self.time = time
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+class TempBackfill(db.Model):
+    __tablename__ = 'temp_backfills'
+
+    id = Column(Integer, primary_key=True)
+    since = Column(DateTime, nullable=False)
+
+    def __init__(self, since):
+        self.since = since
+
+
+class RestockManifest(db.Model):
+    __tablename__ = 'restock_manifests'
+
+    id = Column(Text, primary_key=True)
+    machine = Column(ForeignKey('machines.id'), nullable=False)
+    slots = Column(Integer, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+    def __init__(self, id, machine, slots, applied_at):
+        self.id = id
+        self.machine = machine
+        self.slots = slots
+        self.applied_at = applied_at
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(Text, primary_key=True)
+    fingerprint = Column(Text, nullable=False)
+    status = Column(Integer, nullable=True)
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, key, fingerprint, created_at, expires_at, status=None, response=None):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.status = status
+        self.response = response
+
+
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, server_default="0", nullable=False)
+
+    def __init__(self, id, version):
+        self.id = id
+        self.version = version
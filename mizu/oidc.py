@@ -0,0 +1,271 @@
+""" Mizu - oidc.py
+
+Verification of SSO issued bearer tokens.
+
+Tokens are verified locally against the signing keys published by the issuer (discovered from ``OIDC_ISSUER``), and the
+verified claims are cached until the token expires. Only access tokens are accepted, and only those issued to or for
+``OIDC_AUDIENCE``. Verifying against the provider's ``userinfo`` endpoint on every
+request is still available by setting ``OIDC_VERIFY_MODE`` to ``userinfo``.
+"""
+
+import logging
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+import jwt
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class TokenError(Exception):
+    """ Raised when a bearer token can not be verified """
+    pass
+
+
+class ClaimsCache:
+    """ A thread safe LRU cache of verified token claims, where each entry expires at the token's ``exp``
+
+    Tokens are never stored, entries are keyed on a SHA-256 digest of the raw token.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """ Get the cached claims for a token, or ``None`` if the token is not cached or has expired """
+        key = ClaimsCache.key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, claims = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def put(self, token, claims, expires_at):
+        if self.max_size <= 0:
+            return
+
+        key = ClaimsCache.key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+class TokenVerifier:
+    """ Verifies bearer tokens issued by the configured OIDC provider
+
+    Args:
+        config (dict): the application config, see the ``OIDC_*`` values in ``mizu.config``
+        http (HTTPClient): the shared client used to reach the provider
+    """
+
+    def __init__(self, config, http):
+        self.issuer = config['OIDC_ISSUER'].rstrip('/')
+        self.mode = config['OIDC_VERIFY_MODE']
+        self.audience = config['OIDC_AUDIENCE'] or None
+        self.leeway = config['OIDC_LEEWAY']
+        self.jwks_ttl = config['OIDC_JWKS_TTL']
+        self.timeout = (config['OIDC_CONNECT_TIMEOUT'], config['OIDC_READ_TIMEOUT'])
+        self.http = http
+
+        self.cache = ClaimsCache(config['OIDC_TOKEN_CACHE_SIZE'])
+
+        self._jwks_uri = None
+        self._userinfo_uri = '{}/protocol/openid-connect/userinfo'.format(self.issuer)
+        self._keys = {}
+        self._keys_fetched_at = 0
+        self._keys_lock = threading.Lock()
+        self._keys_refreshing = None
+
+    def verify(self, token):
+        """ Verify a bearer token, returning its claims
+
+        Args:
+            token (str): the raw token, without the ``Bearer`` prefix
+
+        Returns:
+            dict: the verified claims, including at least ``preferred_username``
+
+        Raises:
+            TokenError: if the token is invalid, expired, or could not be verified
+        """
+        if self.mode == 'userinfo':
+            return self._userinfo(token)
+
+        claims = self.cache.get(token)
+        if claims is not None:
+            return claims
+
+        claims = self._decode(token)
+
+        # Group membership is only present in access tokens when the realm maps it in, fall back to asking the provider
+        if 'groups' not in claims:
+            claims = dict(claims, groups=self._userinfo(token).get('groups', []))
+
+        self.cache.put(token, claims, claims['exp'])
+        return claims
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['mode'] = self.mode
+        stats['signing_keys'] = len(self._keys)
+        return stats
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _decode(self, token):
+        """ Verify the signature and standard claims of a token against the issuer's published keys """
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as e:
+            raise TokenError('Malformed bearer token: {}'.format(e))
+
+        key = self._get_key(header.get('kid'))
+
+        try:
+            claims = jwt.decode(
+                token,
+                key=key.key,
+                algorithms=[key.algorithm_name],
+                issuer=self.issuer,
+                leeway=self.leeway,
+                options={
+                    'require': ['exp', 'iss'],
+                    'verify_aud': False,
+                },
+            )
+        except jwt.InvalidTokenError as e:
+            raise TokenError('Bearer token failed verification: {}'.format(e))
+
+        # ID and refresh tokens are signed with the same keys, but aren't credentials for calling an API
+        if claims.get('typ', 'Bearer') != 'Bearer':
+            raise TokenError('Bearer token is a {} token, not an access token'.format(claims['typ']))
+
+        if self.audience is not None:
+            audience = claims.get('aud', [])
+            if isinstance(audience, str):
+                audience = [audience]
+            if self.audience not in audience and claims.get('azp') != self.audience:
+                raise TokenError('Bearer token was not issued to or for \'{}\''.format(self.audience))
+
+        return claims
+
+    def _get_key(self, kid):
+        """ Get the signing key with the provided ID, refreshing the cached key set if it is stale or the ID unknown
+
+        Only one thread fetches the key set at a time, without holding ``_keys_lock``. Others keep using the keys they
+        have, or wait for the fetch if they need a key that isn't known yet.
+        """
+        with self._keys_lock:
+            age = time.time() - self._keys_fetched_at
+            stale = age > self.jwks_ttl or (kid not in self._keys and age > 60)
+            refreshing = self._keys_refreshing
+            fetch = stale and refreshing is None
+            if fetch:
+                refreshing = self._keys_refreshing = threading.Event()
+
+            key = self._keys.get(kid)
+
+        if fetch:
+            try:
+                self._refresh_keys()
+            finally:
+                with self._keys_lock:
+                    self._keys_refreshing = None
+                refreshing.set()
+        elif key is None and refreshing is not None:
+            refreshing.wait(sum(self.timeout) * 2)
+
+        if fetch or refreshing is not None:
+            with self._keys_lock:
+                key = self._keys.get(kid)
+
+        if key is None:
+            raise TokenError('Bearer token was signed with an unknown key \'{}\''.format(kid))
+
+        return key
+
+    def _refresh_keys(self):
+        """ Fetch the issuer's JSON Web Key Set, and swap it in for the cached one """
+        try:
+            jwks_uri = self._jwks_uri
+            if jwks_uri is None:
+                discovery = self.http.get('{}/.well-known/openid-configuration'.format(self.issuer),
+                                          timeout=self.timeout)
+                discovery.raise_for_status()
+                jwks_uri = discovery.json()['jwks_uri']
+
+            response = self.http.get(jwks_uri, timeout=self.timeout)
+            response.raise_for_status()
+            jwks = jwt.PyJWKSet.from_dict(response.json())
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, AttributeError,
+                jwt.PyJWKSetError) as e:
+            # Keep serving the keys we already have, and don't hammer the provider while it's unhappy
+            logger.error('Unable to refresh signing keys from %s: %s', self.issuer, e)
+            with self._keys_lock:
+                self._keys_fetched_at = time.time() - self.jwks_ttl + 60
+            return
+
+        keys = {key.key_id: key for key in jwks.keys}
+        with self._keys_lock:
+            self._jwks_uri = jwks_uri
+            self._keys = keys
+            self._keys_fetched_at = time.time()
+        logger.debug('Refreshed %s signing keys from %s', len(keys), self.issuer)
+
+    def _userinfo(self, token):
+        """ Verify a token by presenting it to the provider's userinfo endpoint """
+        headers = {
+            'Authorization': 'Bearer {}'.format(token)
+        }
+
+        try:
+            response = self.http.get(self._userinfo_uri, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+            claims = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise TokenError('Unable to verify Bearer token against provider: {}'.format(e))
+
+        if not isinstance(claims, dict):
+            raise TokenError('The provider\'s userinfo response was not an object')
+
+        return claims
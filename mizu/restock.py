@@ -0,0 +1,182 @@
+""" Mizu - restock.py
+
+Applying restock manifests - the new counts (and optionally items) for many slots in a machine - in one statement
+"""
+
+import csv
+import io
+import logging
+
+from datetime import datetime
+
+from sqlalchemy import Boolean, Integer
+from sqlalchemy import column, update, values
+from sqlalchemy import exc
+
+from mizu import db
+from mizu import event_bus
+
+from mizu.models import Item
+from mizu.models import Machine
+from mizu.models import RestockManifest
+from mizu.models import Slot
+from mizu.data_adapters import catalog_cache
+
+logger = logging.getLogger(__name__)
+
+MAX_MANIFEST_SIZE = 500
+
+
+class ManifestError(ValueError):
+    """ Raised when a manifest is invalid. The message is suitable for the client. """
+    pass
+
+
+def parse_csv(text):
+    """ Parse the entries of a CSV manifest, with a header row of ``slot,count`` and optionally ``item_id`` and
+    ``active``
+
+    Raises:
+        ManifestError: if the header is missing required columns
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames is None or not {'slot', 'count'} <= set(reader.fieldnames):
+        raise ManifestError('A CSV manifest must have a header row with at least the columns slot and count')
+
+    entries = []
+    for row in reader:
+        entry = {field: value.strip() for field, value in row.items() if field and value is not None and value.strip()}
+        if 'active' in entry:
+            entry['active'] = entry['active'].lower() in ('1', 'true', 'yes', 'y')
+        entries.append(entry)
+    return entries
+
+
+def apply_manifest(manifest_id, machine_name, entries):
+    """ Apply a restock manifest to a machine, unless a manifest with the same ID has already been applied
+
+    Each entry sets a slot's ``count``, and optionally its ``item_id`` and ``active`` state. Slots are activated when
+    restocked with a positive count unless ``active`` says otherwise. A slot with no item can't be stocked or activated
+    unless the entry assigns one. Every slot is updated by one
+    ``UPDATE ... FROM (VALUES ...)`` statement, and the manifest ID is recorded in the same transaction.
+
+    Returns:
+        tuple: ``(applied, slots)`` - whether the manifest was applied now (rather than before), and the number of slots
+            it updates
+
+    Raises:
+        ManifestError: if the manifest is invalid, in which case nothing is changed
+    """
+    if not manifest_id or not isinstance(manifest_id, str):
+        raise ManifestError('A manifest must have an ID')
+
+    rows = _validate(machine_name, entries)
+    machine_id = rows[0]['machine']
+
+    previous = db.session.query(RestockManifest).filter(RestockManifest.id == manifest_id).first()
+    if previous is not None:
+        if previous.machine != machine_id:
+            raise ManifestError('The manifest \'{}\' was already applied to another machine'.format(manifest_id))
+        return False, previous.slots
+
+    db.session.add(RestockManifest(manifest_id, machine_id, len(rows), datetime.utcnow()))
+
+    if db.engine.dialect.name == 'postgresql':
+        restock = values(column('number', Integer), column('count', Integer), column('item', Integer),
+                         column('active', Boolean), name='restock').\
+            data([(row['number'], row['count'], row['item'], row['active']) for row in rows])
+        db.session.execute(
+            update(Slot).
+            where(Slot.machine == machine_id, Slot.number == restock.c.number).
+            values(count=restock.c.count, item=restock.c.item, active=restock.c.active).
+            execution_options(synchronize_session=False)
+        )
+    else:
+        # SQLite can't name the columns of a VALUES list, so fall back to one executemany UPDATE
+        db.session.bulk_update_mappings(Slot, rows)
+
+    for row in rows:
+        event_bus.publish_on_commit(db.session, 'slot', {
+            'machine': machine_name,
+            'number': row['number'],
+            'active': row['active'],
+            'item_id': row['item'],
+            'count': row['count'],
+        })
+
+    catalog_cache.mark_changed()
+    try:
+        db.session.commit()
+    except exc.IntegrityError:
+        # Another request applied the same manifest first
+        db.session.rollback()
+        return False, len(rows)
+
+    logger.info('Applied restock manifest %s to %s slots in %s', manifest_id, len(rows), machine_name)
+    return True, len(rows)
+
+
+###############################################################################
+# Private / Helper functions
+
+def _validate(machine_name, entries):
+    """ Validate every entry of a manifest, with one query for the machine's slots and one for the items
+
+    Returns:
+        list: a complete ``Slot`` row (``machine``, ``number``, ``count``, ``item``, ``active``) for each entry
+    """
+    if not isinstance(entries, list) or not entries:
+        raise ManifestError('A manifest must list at least one slot')
+    if len(entries) > MAX_MANIFEST_SIZE:
+        raise ManifestError('A manifest can list at most {} slots'.format(MAX_MANIFEST_SIZE))
+
+    slots = db.session.query(Machine, Slot).\
+        outerjoin(Slot, Slot.machine == Machine.id).\
+        filter(Machine.name == machine_name).all()
+    if not slots:
+        raise ManifestError('The machine \'{}\' is not a valid machine'.format(machine_name))
+
+    machine = slots[0][0]
+    slots = {slot.number: slot for _, slot in slots if slot is not None}
+
+    rows = {}
+    for index, entry in enumerate(entries):
+        try:
+            number = int(entry['slot'])
+            count = int(entry['count'])
+            item_id = int(entry['item_id']) if entry.get('item_id') is not None else None
+        except (KeyError, TypeError, ValueError):
+            raise ManifestError('Entry {} must have an integer slot and count'.format(index))
+
+        if count < 0:
+            raise ManifestError('Entry {} has a negative count'.format(index))
+        if number not in slots:
+            raise ManifestError('The machine \'{}\' does not have a slot number {}'.format(machine_name, number))
+        if number in rows:
+            raise ManifestError('Slot {} is listed more than once'.format(number))
+
+        active = entry.get('active', None)
+        if active is not None and not isinstance(active, bool):
+            raise ManifestError('Entry {} has an active value that is not a boolean'.format(index))
+
+        item_id = item_id if item_id is not None else slots[number].item
+        if item_id is None and (count > 0 or active):
+            raise ManifestError('Slot {} has no item, so it can only be restocked with an item_id'.format(number))
+
+        rows[number] = {
+            'machine': machine.id,
+            'number': number,
+            'count': count,
+            'item': item_id,
+            'active': active if active is not None else count > 0,
+        }
+
+    item_ids = {row['item'] for row in rows.values() if row['item'] is not None}
+    existing = {item_id for item_id, in db.session.query(Item.id).filter(Item.id.in_(item_ids)).all()}
+    missing = item_ids - existing
+    if missing:
+        raise ManifestError('No items with IDs {} are present in the system'.format(
+            ', '.join(str(item_id) for item_id in sorted(missing))
+        ))
+
+    return list(rows.values())
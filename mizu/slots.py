@@ -5,8 +5,12 @@
 Routes for managing slots
 """
 
+import logging
+
 from flask import Blueprint, jsonify, request
 
+from sqlalchemy import and_, exists
+
 from mizu import db
 
 from mizu.models import Machine
@@ -14,13 +18,19 @@ from mizu.models import Slot
 from mizu.models import Item
 
 from mizu.auth import check_token
-from mizu.errors import bad_params, bad_headers_content_type
+from mizu.errors import bad_params, bad_headers, bad_headers_content_type
+from mizu.data_adapters import catalog_cache
+from mizu.restock import apply_manifest, parse_csv, ManifestError
 
-from mizu import logger
 from mizu import app
+from mizu import event_bus
+
+logger = logging.getLogger(__name__)
 
 slots_bp = Blueprint('slots_bp', __name__)
 
+MAX_BATCH_SIZE = 500
+
 @slots_bp.route('/slots', methods=['PUT'])
 @check_token(admin_only=True)
 def update_slot_status():
@@ -31,6 +41,215 @@ def update_slot_status():
 
     logger.debug('Handling slot update')
 
+    try:
+        slot_num, updates = _parse_slot_update(body)
+    except ValueError as e:
+        return bad_params(str(e))
+
+    item_id = updates.get('item', None)
+
+    # Resolve the machine, the slot, and whether the new item exists all at once
+    query = db.session.query(Machine, Slot).\
+        outerjoin(Slot, and_(Slot.machine == Machine.id, Slot.number == slot_num)).\
+        filter(Machine.name == body['machine'])
+    if item_id is not None:
+        query = query.add_columns(exists().where(Item.id == item_id))
+
+    result = query.first()
+    if result is None:
+        return bad_params('The machine \'{}\' is not a valid machine'.format(body['machine']))
+
+    if item_id is not None and not result[2]:
+        return bad_params('No item with ID {} is present in the system'.format(item_id))
+
+    machine, slot = result[0], result[1]
+    if slot is None:
+        return bad_params('The machine \'{}\' does not have a slot number {}'.format(
+            body['machine'],
+            body['slot'],
+        ))
+
+    logger.debug('Slot update details validated')
+
+    for column, value in updates.items():
+        setattr(slot, column, value)
+
+    # Serialize before committing, reading attributes after a commit would select the slot again
+    success = {
+        'message': 'Successfully updated slot {} in {}'.format(slot.number, body['machine']),
+        'slot': {
+            'machine': body['machine'],
+            'number': slot.number,
+            'active': slot.active,
+            'item_id': slot.item,
+            'count': slot.count
+        },
+    }
+
+    catalog_cache.mark_changed()
+    event_bus.publish_on_commit(db.session, 'slot', success['slot'])
+    db.session.commit()
+
+    return jsonify(success), 200
+
+
+@slots_bp.route('/slots/batch', methods=['PUT'])
+@check_token(admin_only=True)
+def batch_update_slots():
+    """ Update many slots at once
+
+    The body is of the form ``{"slots": [...]}``, where each entry takes the same parameters as ``PUT /slots``. Every
+    entry is validated before anything is changed - with one query for all of the slots and one for all of the items -
+    and then all of them are applied in a single transaction. If any entry is invalid nothing is changed, and the
+    response reports the problem with each entry.
+    """
+    if request.headers.get('Content-Type') != 'application/json':
+        return bad_headers_content_type()
+
+    body = request.json
+    entries = body.get('slots', None) if isinstance(body, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return bad_params('A non-empty list of slots must be provided')
+    if len(entries) > MAX_BATCH_SIZE:
+        return bad_params('At most {} slots can be updated at once'.format(MAX_BATCH_SIZE))
+
+    logger.debug('Handling batch slot update')
+
+    results = []
+    parsed = []
+    for entry in entries:
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError('Each slot must be an object')
+            slot_num, updates = _parse_slot_update(entry)
+            parsed.append((entry['machine'], slot_num, updates))
+            results.append({'status': 'ok'})
+        except ValueError as e:
+            parsed.append(None)
+            results.append({'status': 'error', 'error': str(e)})
+
+    valid = [update for update in parsed if update is not None]
+    machine_names = {machine_name for machine_name, _, _ in valid}
+    item_ids = {updates['item'] for _, _, updates in valid if 'item' in updates}
+
+    slots = {}
+    machine_ids = {}
+    if machine_names:
+        rows = db.session.query(Machine, Slot).\
+            outerjoin(Slot, Slot.machine == Machine.id).\
+            filter(Machine.name.in_(machine_names)).all()
+        for machine, slot in rows:
+            machine_ids[machine.name] = machine.id
+            if slot is not None:
+                slots[(machine.name, slot.number)] = slot
+
+    existing_items = set()
+    if item_ids:
+        existing_items = {item_id for item_id, in db.session.query(Item.id).filter(Item.id.in_(item_ids)).all()}
+
+    for update, result in zip(parsed, results):
+        if update is None:
+            continue
+
+        machine_name, slot_num, updates = update
+        if machine_name not in machine_ids:
+            error = 'The machine \'{}\' is not a valid machine'.format(machine_name)
+        elif 'item' in updates and updates['item'] not in existing_items:
+            error = 'No item with ID {} is present in the system'.format(updates['item'])
+        elif (machine_name, slot_num) not in slots:
+            error = 'The machine \'{}\' does not have a slot number {}'.format(machine_name, slot_num)
+        else:
+            continue
+
+        result.update(status='error', error=error)
+
+    failed = sum(1 for result in results if result['status'] == 'error')
+    if failed:
+        return jsonify({
+            'error': 'Nothing was changed, as {} of the {} slots were invalid'.format(failed, len(entries)),
+            'errorCode': 400,
+            'results': results,
+        }), 400
+
+    logger.debug('Batch slot update validated')
+
+    mappings = []
+    for (machine_name, slot_num, updates), result in zip(parsed, results):
+        slot = slots[(machine_name, slot_num)]
+        mappings.append(dict(updates, machine=slot.machine, number=slot_num))
+
+        result['slot'] = {
+            'machine': machine_name,
+            'number': slot_num,
+            'active': updates.get('active', slot.active),
+            'item_id': updates.get('item', slot.item),
+            'count': updates.get('count', slot.count),
+        }
+        event_bus.publish_on_commit(db.session, 'slot', result['slot'])
+
+    db.session.bulk_update_mappings(Slot, mappings)
+    catalog_cache.mark_changed()
+    db.session.commit()
+
+    success = {
+        'message': 'Successfully updated {} slots'.format(len(mappings)),
+        'results': results,
+    }
+    return jsonify(success), 200
+
+
+@slots_bp.route('/slots/restock', methods=['POST'])
+@check_token(admin_only=True)
+def restock_machine():
+    """ Apply a restock manifest, setting the count (and optionally the item) of many slots in a machine at once
+
+    A JSON manifest is of the form ``{"id": "<manifest id>", "machine": "<name>", "slots": [{"slot", "count",
+    "item_id", "active"}]}``. A CSV manifest (``Content-Type: text/csv``) has a header row of ``slot,count`` and
+    optionally ``item_id`` and ``active``, with the manifest ID and machine passed as the ``id`` and ``machine`` query
+    parameters. Applying a manifest with an ID that has already been applied changes nothing.
+    """
+    content_type = request.headers.get('Content-Type', '')
+    try:
+        if content_type == 'application/json':
+            body = request.json
+            if not isinstance(body, dict):
+                raise ManifestError('A JSON manifest must be an object')
+            manifest_id, machine_name, entries = body.get('id'), body.get('machine'), body.get('slots')
+        elif content_type.startswith('text/csv'):
+            manifest_id, machine_name = request.args.get('id'), request.args.get('machine')
+            entries = parse_csv(request.get_data(as_text=True))
+        else:
+            return bad_headers('Invalid Content-Type - A restock manifest should be \'application/json\' or '
+                               '\'text/csv\'')
+
+        applied, count = apply_manifest(manifest_id, machine_name, entries)
+    except ManifestError as e:
+        return bad_params(str(e))
+
+    if not applied:
+        return jsonify({
+            'message': 'Restock manifest \'{}\' was already applied to {} slots'.format(manifest_id, count),
+            'applied': False,
+        }), 200
+
+    return jsonify({
+        'message': 'Restocked {} slots in {} from manifest \'{}\''.format(count, machine_name, manifest_id),
+        'applied': True,
+    }), 200
+
+
+###############################################################################
+# Private / Helper functions
+
+def _parse_slot_update(body):
+    """ Validate the parameters of a slot update
+
+    Returns:
+        tuple: the slot number, and a dict of the ``Slot`` columns to update
+
+    Raises:
+        ValueError: with a message for the client, if a parameter is missing or invalid
+    """
     unprovided = []
     if 'machine' not in body:
         unprovided.append('machine')
@@ -38,18 +257,21 @@ def update_slot_status():
         unprovided.append('slot')
 
     if len(unprovided) > 0:
-        return bad_params('The following required parameters were not provided: {}'.format(
+        raise ValueError('The following required parameters were not provided: {}'.format(
             ', '.join(unprovided)
         ))
 
+    if not isinstance(body['machine'], str):
+        raise ValueError('The machine name must be a string')
+
     if 'active' not in body and 'item_id' not in body:
-        return bad_params('Either the state or item within a slot must be provided for an update.')
+        raise ValueError('Either the state or item within a slot must be provided for an update.')
 
     updates = {}
 
     if 'active' in body:
         if not isinstance(body['active'], bool):
-            return bad_params('The active parameter must be a boolean value')
+            raise ValueError('The active parameter must be a boolean value')
 
         updates['active'] = body['active']
 
@@ -58,16 +280,11 @@ def update_slot_status():
             item_id = int(body['item_id'])
             if item_id <= 0:
                 raise ValueError()
-        except ValueError:
-            return bad_params('The item ID value must be a positive integer')
+        except (TypeError, ValueError):
+            raise ValueError('The item ID value must be a positive integer')
 
         updates['item'] = item_id
 
-        item = db.session.query(Item).filter(Item.id == item_id).first()
-
-        if item is None:
-            return bad_params('No item with ID {} is present in the system'.format(item_id))
-
     if 'count' in body:
         count = None
         if body['count'] is not None:
@@ -75,8 +292,8 @@ def update_slot_status():
                 count = int(body['count'])
                 if count < 0:
                     raise ValueError()
-            except ValueError:
-                return bad_params('The count value must be a positive integer')
+            except (TypeError, ValueError):
+                raise ValueError('The count value must be a positive integer')
 
         updates['count'] = count
 
@@ -85,41 +302,7 @@ def update_slot_status():
 
         if slot_num <= 0:
             raise ValueError()
-    except ValueError:
-        return bad_params('The slot number must be a positive integer')
-
-    machine = db.session.query(Machine).filter(Machine.name == body['machine']).first()
-    if machine is None:
-        return bad_params('The machine \'{}\' is not a valid machine'.format(body['machine']))
+    except (TypeError, ValueError):
+        raise ValueError('The slot number must be a positive integer')
 
-    slot = db.session.query(Slot).filter(Slot.number == slot_num, Slot.machine == machine.id).first()
-    if slot is None:
-        return bad_params('The machine \'{}\' does not have a slot number {}'.format(
-            body['machine'],
-            body['slot'],
-        ))
-
-    logger.debug('Slot update details validated')
-
-    slot = db.session.query(Slot).filter(Slot.number == body['slot'], Slot.machine == machine.id).\
-            update(updates, synchronize_session=False)
-
-    if slot < 1:
-        return jsonify({'error': 'Could not update slot', 'errorCode': 500, 'message': 'Contact a drink admin'}), 500
-
-    db.session.commit()
-
-    slot = db.session.query(Slot).filter(Slot.number == slot_num, Slot.machine == machine.id).first()
-
-    success = {
-        'message': 'Successfully updated slot {} in {}'.format(slot.number, body['machine']),
-        'slot': {
-            'machine': body['machine'],
-            'number': slot.number,
-            'active': slot.active,
-            'item_id': slot.item,
-            'count': slot.count
-        },
-    }
-
-    return jsonify(success), 200
+    return slot_num, updates
@@ -0,0 +1,28 @@
+""" Mizu - stats.py
+
+A tiny registry of runtime statistics providers. Subsystems that keep counters (caches, pools, breakers) register a
+zero-argument callable here, and the results are reported to operators by the ``/status`` route.
+"""
+
+import threading
+
+_providers = {}
+_lock = threading.Lock()
+
+
+def register(name, provider):
+    """ Register a callable returning a JSON serializable dict of statistics under the provided name """
+    with _lock:
+        _providers[name] = provider
+
+
+def collect():
+    """ Collect the current statistics from every registered provider
+
+    Returns:
+        dict: provider name -> the dict that provider returned
+    """
+    with _lock:
+        providers = dict(_providers)
+
+    return {name: provider() for name, provider in providers.items()}
@@ -0,0 +1,57 @@
+""" Mizu - status.py
+
+/status
+/status/traces
+/metrics
+
+Operator facing runtime statistics for caches and other internal subsystems, and metrics for Prometheus to scrape
+"""
+
+import hmac
+
+from flask import Blueprint, Response, jsonify, request
+
+from mizu import app
+from mizu import metrics
+from mizu import stats
+from mizu import tracer
+from mizu.auth import check_token
+
+status_bp = Blueprint('status_bp', __name__)
+
+
+@status_bp.route('/status', methods=['GET'])
+@check_token(admin_only=True)
+def get_status():
+    """ Report the statistics of every registered subsystem """
+    success = {
+        'message': 'Retrieved server status',
+        'status': stats.collect(),
+    }
+    return jsonify(success), 200
+
+
+@status_bp.route('/status/traces', methods=['GET'])
+@check_token(admin_only=True)
+def get_traces():
+    """ Report the span breakdowns of the slowest recent requests, slowest first """
+    success = {
+        'message': 'Retrieved the slowest recent requests',
+        'traces': tracer.slowest(),
+    }
+    return jsonify(success), 200
+
+
+@status_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ Report request, SSO, LDAP, database, and machine latencies, and machine states, in the Prometheus text format
+
+    Protected by ``METRICS_TOKEN`` when it is set, rather than by SSO, so that a scraper can read it.
+    """
+    token = app.config['METRICS_TOKEN']
+    if token:
+        scheme, _, bearer = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(bearer.encode('utf-8'), token.encode('utf-8')):
+            return jsonify({'error': 'Could not authenticate metrics scraper', 'errorCode': 401}), 401
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
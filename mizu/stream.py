@@ -0,0 +1,79 @@
+""" Mizu - stream.py
+
+/events
+
+A server-sent event stream of machine, slot, and item changes, so clients don't have to poll /drinks
+"""
+
+import logging
+import time
+
+from flask import Blueprint, Response, jsonify, request
+
+from mizu import app
+from mizu import event_bus
+from mizu import machine_status
+from mizu.auth import check_token
+from mizu.events import TooManySubscribers
+
+logger = logging.getLogger(__name__)
+
+# How often an idle stream checks whether its client went away, when the server says so (see mizu.asgi)
+DISCONNECT_CHECK_INTERVAL = 1
+
+stream_bp = Blueprint('stream_bp', __name__)
+
+
+@stream_bp.route('/events', methods=['GET'])
+@check_token()
+def stream_events():
+    """ Stream changes as they happen
+
+    Events are ``machine`` (went on or offline), ``slot`` (became empty or was refilled, or was updated by an admin),
+    and ``item`` (created, updated, or deleted). A client reconnecting with ``Last-Event-ID`` is sent what it missed; if
+    that can't be done it is sent a ``reset`` event, and should refetch ``/drinks``.
+    """
+    try:
+        subscription = event_bus.subscribe(request.headers.get('Last-Event-ID'))
+    except TooManySubscribers as e:
+        return jsonify({'error': str(e), 'errorCode': 503}), 503
+
+    # Every subscriber is fed by the one background refresher, rather than polling the machines themselves
+    machine_status.ensure_started()
+
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['EVENTS_MAX_DURATION']
+
+    # Under the ASGI bridge a client going away is signalled, so the stream can end without waiting to fail a write.
+    # Other servers only find out at the next write, the keepalive at the latest
+    disconnected = request.environ.get('mizu.disconnected')
+    wait = min(keepalive, DISCONNECT_CHECK_INTERVAL) if disconnected is not None else keepalive
+
+    def generate():
+        try:
+            yield 'retry: {}\n\n'.format(app.config['EVENTS_RETRY'])
+            if subscription.reset:
+                yield 'event: reset\ndata: {}\n\n'
+
+            last_sent = time.monotonic()
+            while time.monotonic() < deadline:
+                if disconnected is not None and disconnected.is_set():
+                    return
+
+                published = subscription.get(timeout=wait)
+                if published is not None:
+                    yield published.encoded
+                    last_sent = time.monotonic()
+                elif subscription.overflowed:
+                    logger.info('Disconnecting an event stream subscriber that fell too far behind')
+                    return
+                elif time.monotonic() - last_sent >= keepalive:
+                    yield ': keepalive\n\n'
+                    last_sent = time.monotonic()
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
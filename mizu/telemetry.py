@@ -0,0 +1,242 @@
+""" Mizu - telemetry.py
+
+Downsampling of machine temperature samples into per-minute and per-hour rollups, with retention for the finer data
+"""
+
+import logging
+import os
+import time
+import threading
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from mizu import app
+from mizu import db
+
+from mizu.models import Temp
+from mizu.models import TempRollup
+from mizu.models import TempBackfill
+from mizu.db_utils import truncate_time, as_datetime, try_lock
+
+logger = logging.getLogger(__name__)
+
+# The seconds covered by each point at each resolution
+RESOLUTION_SECONDS = {
+    'minute': 60,
+    'hour': 3600,
+}
+
+# The advisory lock held by whichever worker is running the rollup job
+ROLLUP_LOCK = 0x6d697a75
+
+
+class TempRollupJob:
+    """ Periodically aggregates raw samples into minute rollups, and minute rollups into hour rollups
+
+    Each run re-aggregates everything from ``lag`` seconds before the newest rollup up to the start of the current
+    minute (or hour), replacing the rollups in that window, so samples that a machine uploads late are still counted.
+    Uploads that reach further back (a machine catching up after being offline) are noted in the ``temp_backfills``
+    table by ``add_samples``, and the next run starts from the earliest of them instead - as far back as the finer data
+    is still retained. Raw samples older than ``raw_retention`` days and minute rollups older than ``minute_retention``
+    days are deleted; hour rollups are kept forever.
+
+    Every worker runs the job, but a run only goes ahead while holding the ``ROLLUP_LOCK`` advisory lock, so the
+    workers never replace the same rollups at once.
+
+    Args:
+        interval (float): seconds between runs
+        lag (float): seconds of already rolled up data to re-aggregate on each run
+        raw_retention (float): days raw samples are kept
+        minute_retention (float): days minute rollups are kept
+    """
+
+    def __init__(self, interval, lag, raw_retention, minute_retention):
+        self.interval = interval
+        self.lag = timedelta(seconds=lag)
+        self.raw_retention = timedelta(days=raw_retention)
+        self.minute_retention = timedelta(days=minute_retention)
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.rollups_written = 0
+        self.samples_expired = 0
+        self.last_run = None
+        self.last_duration = None
+
+    def add_samples(self, earliest):
+        """ Note, in the session's transaction, that samples as old as ``earliest`` are being stored
+
+        Nothing is noted for samples recent enough that the next run re-aggregates them anyway.
+        """
+        if earliest < datetime.utcnow() - self.lag + timedelta(seconds=self.interval):
+            db.session.add(TempBackfill(earliest))
+
+    def run(self, now=None):
+        """ Bring the rollups up to date and apply retention now, unless another worker is already doing so
+
+        Returns:
+            bool: whether the rollups were brought up to date by this call
+        """
+        start = time.monotonic()
+        now = now or datetime.utcnow()
+
+        with app.app_context():
+            if not try_lock(ROLLUP_LOCK):
+                db.session.rollback()
+                with self._lock:
+                    self.skipped += 1
+                return False
+
+            unrolled_since, last_backfill = db.session.query(func.min(TempBackfill.since),
+                                                             func.max(TempBackfill.id)).one()
+
+            minute_end = now.replace(second=0, microsecond=0)
+            minute_start = self._window_start('minute', db.session.query(func.min(Temp.time)).scalar(),
+                                              unrolled_since, now - self.raw_retention)
+            written = self._rollup('minute', minute_start, minute_end, self._minute_rows)
+
+            hour_end = now.replace(minute=0, second=0, microsecond=0)
+            first_minute = db.session.query(func.min(TempRollup.time)).\
+                filter(TempRollup.resolution == 'minute').scalar()
+            hour_start = self._window_start('hour', first_minute, unrolled_since, now - self.minute_retention)
+            written += self._rollup('hour', hour_start, hour_end, self._hour_rows)
+
+            # Backfills noted since the query above are left for the next run
+            if last_backfill is not None:
+                db.session.query(TempBackfill).\
+                    filter(TempBackfill.id <= last_backfill).\
+                    delete(synchronize_session=False)
+
+            expired = db.session.query(Temp).\
+                filter(Temp.time < now - self.raw_retention).\
+                delete(synchronize_session=False)
+            db.session.query(TempRollup).\
+                filter(TempRollup.resolution == 'minute', TempRollup.time < now - self.minute_retention).\
+                delete(synchronize_session=False)
+
+            db.session.commit()
+
+        with self._lock:
+            self.runs += 1
+            self.rollups_written += written
+            self.samples_expired += expired
+            self.last_run = time.time()
+            self.last_duration = time.monotonic() - start
+
+        logger.debug('Wrote %s temperature rollups, expired %s samples', written, expired)
+        return True
+
+    def ensure_started(self):
+        """ Start the background rollup job for this process if it isn't already running """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='mizu-temp-rollup', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'skipped': self.skipped,
+                'failures': self.failures,
+                'rollups_written': self.rollups_written,
+                'samples_expired': self.samples_expired,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+            }
+
+    ###########################################################################
+    # Private / Helper functions
+
+    def _run(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.exception('Temperature rollup failed')
+                with app.app_context():
+                    db.session.rollback()
+                with self._lock:
+                    self.failures += 1
+
+            time.sleep(self.interval)
+
+    def _window_start(self, resolution, earliest_source, unrolled_since, retained_since):
+        """ Where re-aggregation starts - ``lag`` before the newest rollup, or the earliest data if there are none, or
+        earlier to take in late samples
+
+        Never before the first whole bucket of source data still retained (``retained_since``), as rollups before that
+        could no longer be rebuilt in full.
+        """
+        newest = db.session.query(func.max(TempRollup.time)).\
+            filter(TempRollup.resolution == resolution).scalar()
+        start = newest - self.lag if newest is not None else earliest_source
+        if unrolled_since is not None and (start is None or unrolled_since < start):
+            start = max(unrolled_since, _truncate(retained_since, resolution) + _bucket(resolution))
+        if start is None:
+            return None
+
+        return _truncate(start, resolution)
+
+    def _rollup(self, resolution, start, end, source):
+        """ Replace the rollups in ``[start, end)`` with ones aggregated from ``source`` """
+        if start is None or start >= end:
+            return 0
+
+        rows = [{
+            'machine': machine,
+            'resolution': resolution,
+            'time': as_datetime(bucket),
+            'count': count,
+            'total': total,
+            'minimum': minimum,
+            'maximum': maximum,
+        } for machine, bucket, count, total, minimum, maximum in source(start, end)]
+
+        db.session.query(TempRollup).\
+            filter(TempRollup.resolution == resolution, TempRollup.time >= start, TempRollup.time < end).\
+            delete(synchronize_session=False)
+        if rows:
+            db.session.execute(TempRollup.__table__.insert(), rows)
+
+        return len(rows)
+
+    @staticmethod
+    def _minute_rows(start, end):
+        bucket = truncate_time(Temp.time, 'minute').label('bucket')
+        return db.session.query(Temp.machine, bucket, func.count(), func.sum(Temp.temp),
+                                func.min(Temp.temp), func.max(Temp.temp)).\
+            filter(Temp.time >= start, Temp.time < end).\
+            group_by(Temp.machine, bucket).all()
+
+    @staticmethod
+    def _hour_rows(start, end):
+        bucket = truncate_time(TempRollup.time, 'hour').label('bucket')
+        return db.session.query(TempRollup.machine, bucket, func.sum(TempRollup.count), func.sum(TempRollup.total),
+                                func.min(TempRollup.minimum), func.max(TempRollup.maximum)).\
+            filter(TempRollup.resolution == 'minute', TempRollup.time >= start, TempRollup.time < end).\
+            group_by(TempRollup.machine, bucket).all()
+
+
+###############################################################################
+# Private / Helper functions
+
+def _truncate(value, resolution):
+    value = value.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        value = value.replace(minute=0)
+    return value
+
+
+def _bucket(resolution):
+    return timedelta(seconds=RESOLUTION_SECONDS[resolution])
@@ -0,0 +1,172 @@
+""" Mizu - temps.py
+
+/temps
+
+Routes for machines to report their temperatures, and for charting them
+"""
+
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, jsonify, request
+
+from mizu import app
+from mizu import db
+from mizu import temp_rollup
+
+from mizu.models import Temp
+from mizu.models import TempRollup
+
+from mizu.auth import check_token
+from mizu.errors import bad_params, bad_headers_content_type
+from mizu.data_adapters import catalog_cache
+from mizu.db_utils import insert_ignoring_duplicates, parse_time
+from mizu.telemetry import RESOLUTION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+temps_bp = Blueprint('temps_bp', __name__)
+
+
+@temps_bp.route('/temps', methods=['POST'])
+@check_token(trusted_only=True)
+def record_temps():
+    """ Record a batch of temperature samples from a machine
+
+    The body is of the form ``{"machine": "<name>", "samples": [{"time": "<ISO 8601>", "temp": <float>}, ...]}``.
+    Samples already recorded for the same time are ignored, so a machine can safely retry an upload.
+    """
+    if request.headers.get('Content-Type') != 'application/json':
+        return bad_headers_content_type()
+
+    body = request.json
+
+    unprovided = []
+    if 'machine' not in body:
+        unprovided.append('machine')
+    if 'samples' not in body:
+        unprovided.append('samples')
+
+    if len(unprovided) > 0:
+        return bad_params('The following required parameters were not provided: {}'.format(', '.join(unprovided)))
+
+    machine = catalog_cache.snapshot().machines_by_name.get(body['machine'])
+    if machine is None:
+        return bad_params('The machine name \'{}\' is not a valid machine'.format(body['machine']))
+
+    samples = body['samples']
+    if not isinstance(samples, list) or not samples:
+        return bad_params('The samples must be a non-empty list')
+    if len(samples) > app.config['TEMP_MAX_BATCH']:
+        return bad_params('At most {} samples can be recorded at once'.format(app.config['TEMP_MAX_BATCH']))
+
+    rows = {}
+    for index, sample in enumerate(samples):
+        try:
+            sample_time = parse_time(sample['time'], 'time')
+            temp = float(sample['temp'])
+        except (KeyError, TypeError, ValueError):
+            return bad_params('Sample {} must have an ISO 8601 time and a numeric temp'.format(index))
+
+        # Duplicate times within a batch would fail the insert, keep the last
+        rows[sample_time] = {'machine': machine['id'], 'time': sample_time, 'temp': temp}
+
+    db.session.execute(insert_ignoring_duplicates(Temp.__table__), list(rows.values()))
+    temp_rollup.add_samples(min(rows))
+    db.session.commit()
+
+    temp_rollup.ensure_started()
+
+    logger.debug('Recorded %s temperature samples for %s', len(rows), machine['name'])
+    return jsonify({'message': 'Recorded {} samples for {}'.format(len(rows), machine['name'])}), 201
+
+
+@temps_bp.route('/temps', methods=['GET'])
+@check_token()
+def get_temps():
+    """ Get the temperatures of a machine over a range, at a resolution suited to its length
+
+    The finest resolution that keeps the data for the whole range, and covers it in at most ``TEMP_MAX_POINTS``
+    points, is used - raw samples for short ranges, then minute and hour averages.
+
+    Query parameters:
+        machine: the name of the machine
+        since, until: the range, as ISO 8601 timestamps. Defaults to the last day.
+        resolution: ``raw``, ``minute`` or ``hour``, to override the choice
+    """
+    temp_rollup.ensure_started()
+
+    machine_name = request.args.get('machine', None)
+    if machine_name is None:
+        return bad_params('A machine name must be provided')
+
+    machine = catalog_cache.snapshot().machines_by_name.get(machine_name)
+    if machine is None:
+        return bad_params('The provided machine name \'{}\' is not a valid machine'.format(machine_name))
+
+    now = datetime.utcnow()
+    try:
+        until = parse_time(request.args.get('until', None), 'until') or now
+        since = parse_time(request.args.get('since', None), 'since') or until - timedelta(days=1)
+    except ValueError as e:
+        return bad_params(str(e))
+
+    if since >= until:
+        return bad_params('The since value must be before the until value')
+
+    resolution = request.args.get('resolution', None)
+    if resolution is None:
+        resolution = _pick_resolution(since, until, now)
+    elif resolution != 'raw' and resolution not in RESOLUTION_SECONDS:
+        return bad_params('The resolution must be one of raw, {}'.format(', '.join(RESOLUTION_SECONDS)))
+
+    if resolution == 'raw':
+        rows = db.session.query(Temp.time, Temp.temp).\
+            filter(Temp.machine == machine['id'], Temp.time >= since, Temp.time < until).\
+            order_by(Temp.time).all()
+        points = [{'time': _isoformat(sample_time), 'temp': temp} for sample_time, temp in rows]
+    else:
+        rows = db.session.query(TempRollup.time, TempRollup.count, TempRollup.total,
+                                TempRollup.minimum, TempRollup.maximum).\
+            filter(TempRollup.machine == machine['id'],
+                   TempRollup.resolution == resolution,
+                   TempRollup.time >= since,
+                   TempRollup.time < until).\
+            order_by(TempRollup.time).all()
+        points = [{
+            'time': _isoformat(bucket),
+            'temp': total / count,
+            'min': minimum,
+            'max': maximum,
+        } for bucket, count, total, minimum, maximum in rows]
+
+    success = {
+        'message': 'Retrieved {} {} temperatures for {}'.format(len(points), resolution, machine_name),
+        'machine': machine_name,
+        'resolution': resolution,
+        'temps': points,
+    }
+    return jsonify(success), 200
+
+
+###############################################################################
+# Private / Helper functions
+
+def _pick_resolution(since, until, now):
+    max_points = app.config['TEMP_MAX_POINTS']
+    seconds = (until - since).total_seconds()
+
+    candidates = [
+        ('raw', app.config['TEMP_SAMPLE_INTERVAL'], timedelta(days=app.config['TEMP_RAW_RETENTION'])),
+        ('minute', RESOLUTION_SECONDS['minute'], timedelta(days=app.config['TEMP_MINUTE_RETENTION'])),
+    ]
+    for resolution, step, retention in candidates:
+        if since >= now - retention and seconds / step <= max_points:
+            return resolution
+
+    return 'hour'
+
+
+def _isoformat(value):
+    return value.replace(tzinfo=timezone.utc).isoformat()
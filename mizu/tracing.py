@@ -0,0 +1,223 @@
+""" Mizu - tracing.py
+
+Per-request traces - a tree of timed spans (authentication, the adapter, LDAP, the database, the machines) - so a slow
+request can be explained after the fact
+
+Spans are only recorded while a request is being traced, and only on the thread handling it, so outside of one
+``span`` costs a context lookup.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """ One timed operation within a trace, and the operations it was made up of """
+
+    __slots__ = ('name', 'attrs', 'start', 'end', 'children')
+
+    def __init__(self, name, attrs, start, end=None):
+        self.name = name
+        self.attrs = attrs
+        self.start = start
+        self.end = end
+        self.children = []
+
+    def to_dict(self, origin):
+        span = {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(((self.end or time.perf_counter()) - self.start) * 1000, 3),
+        }
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.children:
+            span['children'] = [child.to_dict(origin) for child in self.children]
+        return span
+
+
+class Trace:
+    """ The spans recorded while handling one request, at most ``max_spans`` of them """
+
+    def __init__(self, trace_id, method, path, max_spans):
+        self.id = trace_id
+        self.started_at = time.time()
+        self.root = Span('request', {'method': method, 'path': path}, time.perf_counter())
+        self.status = None
+        self.max_spans = max_spans
+        self.spans = 1
+        self.dropped = 0
+        self._stack = [self.root]
+
+    @property
+    def duration(self):
+        return (self.root.end or time.perf_counter()) - self.root.start
+
+    def push(self, name, attrs):
+        """ Open a span nested in the innermost open span, returning ``None`` if the trace is full """
+        if self.spans >= self.max_spans:
+            self.dropped += 1
+            return None
+
+        span = Span(name, attrs, time.perf_counter())
+        self._stack[-1].children.append(span)
+        self._stack.append(span)
+        self.spans += 1
+        return span
+
+    def pop(self, span):
+        span.end = time.perf_counter()
+        if self._stack[-1] is span:
+            self._stack.pop()
+
+    def add(self, name, start, end, attrs):
+        """ Record an already finished span in the innermost open span """
+        if self.spans >= self.max_spans:
+            self.dropped += 1
+            return
+
+        self._stack[-1].children.append(Span(name, attrs, start, end))
+        self.spans += 1
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'started_at': self.started_at,
+            'method': self.root.attrs['method'],
+            'path': self.root.attrs['path'],
+            'status': self.status,
+            'duration_ms': round(self.duration * 1000, 3),
+            'dropped_spans': self.dropped,
+            'spans': self.root.to_dict(self.root.start),
+        }
+
+
+class Tracer:
+    """ Traces every request, keeping the ``keep`` slowest of those finished in the last ``window`` seconds
+
+    A request taking ``threshold`` seconds or longer is logged with its full breakdown when it finishes.
+
+    Args:
+        keep (int): the number of slow traces kept
+        threshold (float): seconds a request can take before it is logged
+        window (float): seconds a trace is kept for
+        max_spans (int): the most spans recorded for one request
+    """
+
+    def __init__(self, keep, threshold, window, max_spans):
+        self.keep = keep
+        self.threshold = threshold
+        self.window = window
+        self.max_spans = max_spans
+
+        self._slowest = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+        self.traced = 0
+        self.slow = 0
+
+    def start(self, request_id, method, path):
+        """ Start tracing the current request """
+        g.mizu_trace = Trace(request_id, method, path, self.max_spans)
+
+    def finish(self, status):
+        """ Finish tracing the current request, keeping its trace if it was among the slowest """
+        trace = g.pop('mizu_trace', None)
+        if trace is None:
+            return None
+
+        trace.root.end = time.perf_counter()
+        trace.status = status
+        duration = trace.duration
+
+        now = time.time()
+        with self._lock:
+            self.traced += 1
+            if self._slowest and self._slowest[0][2].started_at < now - self.window:
+                self._slowest = [entry for entry in self._slowest if entry[2].started_at >= now - self.window]
+                heapq.heapify(self._slowest)
+
+            entry = (duration, next(self._counter), trace)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+            slow = duration >= self.threshold
+            if slow:
+                self.slow += 1
+
+        if slow:
+            logger.warning('Slow request %s %s took %.1fms', trace.root.attrs['method'], trace.root.attrs['path'],
+                           duration * 1000, extra={'trace': trace.to_dict()})
+
+        return trace
+
+    def slowest(self):
+        """ The kept traces, slowest first """
+        now = time.time()
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)
+        return [trace.to_dict() for _, _, trace in entries if trace.started_at >= now - self.window]
+
+    def stats(self):
+        with self._lock:
+            durations = sorted((entry[0] for entry in self._slowest), reverse=True)
+            return {
+                'traced': self.traced,
+                'slow': self.slow,
+                'threshold': self.threshold,
+                'kept': len(durations),
+                'slowest_ms': [round(duration * 1000, 3) for duration in durations],
+            }
+
+
+def current():
+    """ The trace of the request being handled on this thread, if any """
+    if not has_app_context():
+        return None
+    return g.get('mizu_trace', None)
+
+
+@contextmanager
+def span(name, **attrs):
+    """ Record the ``with`` block as a span of the current request's trace, if it is being traced """
+    trace = current()
+    opened = trace.push(name, attrs) if trace is not None else None
+    try:
+        yield
+    finally:
+        if opened is not None:
+            trace.pop(opened)
+
+
+def traced(name=None):
+    """ Record every call of the decorated function as a span, named after the function unless ``name`` is given """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapped_function
+    return decorator
+
+
+def add_span(name, start, end, **attrs):
+    """ Record an operation timed elsewhere (with ``time.perf_counter``) as a span of the current trace """
+    trace = current()
+    if trace is not None:
+        trace.add(name, start, end, attrs)
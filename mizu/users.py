@@ -8,47 +8,82 @@ Routes for retrieving users and their credits, and updating drink credits for us
 
 from flask import Blueprint, jsonify, request
 
-import ldap
-import ldap.modlist
+import bisect
 
 from mizu import db
 from mizu.data_adapters import SqlAlchemyAdapter
 from mizu.data_adapters import MockAdapter
 from mizu.data_adapters import get_adapter
 
-from mizu import ldap as _ldap
+from mizu import user_directory
+from mizu import balances
+from mizu import tracing
 
 from mizu.auth import check_token
 from mizu.errors import bad_params, bad_headers_content_type
 
 users_bp = Blueprint('users_bp', __name__)
 
+USER_FIELDS = ['uid', 'cn', 'drinkBalance']
+
 @users_bp.route('/users', methods=['GET'])
 @get_adapter
 @check_token()
 def list_users(adapter):
+    """ List users, optionally a page at a time and with only some of their fields
+
+    Query parameters:
+        limit: the maximum number of users to return, all users are returned if not provided
+        after: return users whose uid sorts after this one - pass the ``next`` value of the previous page
+        fields: a comma separated subset of ``uid``, ``cn`` and ``drinkBalance`` to include for each user
+    """
+    limit = request.args.get('limit', None)
+    after = request.args.get('after', None)
+    fields = request.args.get('fields', None)
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError()
+        except ValueError:
+            return bad_params('The limit must be a positive integer')
+
+    if fields is not None:
+        fields = [field for field in fields.split(',') if field]
+        unknown = [field for field in fields if field not in USER_FIELDS]
+        if unknown or not fields:
+            return bad_params('Users can only be filtered to the fields {}'.format(', '.join(USER_FIELDS)))
 
     if adapter == MockAdapter:
-        users = adapter.get_user()
+        users = sorted(adapter.get_user(), key=lambda user: user['uid'])
     else:
-        # Turns out creating objects for each of our 1200+ users is very slow. Querying LDAP directly is much faster
-        ldap_conn = _ldap.get_con()
-        users = ldap_conn.search_s("cn=users,cn=accounts,dc=csh,dc=rit,dc=edu",
-                                   ldap.SCOPE_SUBTREE,
-                                   "(objectClass=cshMember)",
-                                   ["uid", "cn", "drinkBalance"])
-
-        users = [{
-            'cn': user[1]['cn'][0].decode('utf-8'),
-            'uid': user[1]['uid'][0].decode('utf-8'),
-            'drinkBalance': int(user[1].get('drinkBalance',[b'0'])[0].decode('utf-8'))
-        } for user in users]
+        # Creating objects for each of our 1200+ users is very slow, and so is searching for all of them on every call.
+        # The directory keeps them in memory and is refreshed from LDAP in the background
+        users = user_directory.list()
+
+    total = len(users)
+
+    if after is not None:
+        users = users[bisect.bisect_right([user['uid'] for user in users], after):]
+
+    next_uid = None
+    if limit is not None and len(users) > limit:
+        users = users[:limit]
+        next_uid = users[-1]['uid']
+
+    if fields is not None:
+        users = [{field: user[field] for field in fields} for user in users]
 
     success = {
         'message': 'Retrieved {} users'.format(len(users)),
         'users': users
     }
 
+    if limit is not None or after is not None:
+        success['total'] = total
+        success['next'] = next_uid
+
     return jsonify(success), 200
 
 
@@ -56,6 +91,12 @@ def list_users(adapter):
 @get_adapter
 @check_token()
 def get_credits(adapter):
+    """ Look a member up by ``uid`` or ``ibutton``, with their drinkBalance
+
+    A ``uid`` is read live from LDAP. An ``ibutton`` (a tap at a machine) is answered from the in-memory directory, so
+    its balance includes every change made by this worker but may miss changes made elsewhere (another worker, or LDAP
+    directly) for up to ``DIRECTORY_INTERVAL`` seconds. Drops always re-read the balance live before debiting.
+    """
     uid = request.args.get('uid', None)
     ibutton = request.args.get('ibutton', None)
     if uid is None and ibutton is None:
@@ -66,26 +107,15 @@ def get_credits(adapter):
             if adapter == MockAdapter:
                 user_ret = adapter.get_user(uid)
             else:
-                user = _ldap.get_member(uid, uid=True)
-                
-                user_ret = {
-                    'uid': user.uid,
-                    'cn': user.cn,
-                    'drinkBalance': user.drinkBalance
-                }
+                user_ret = balances.get_member(uid)
                 message = 'Retrieved user with uid \'{}\''.format(uid)
         except KeyError:
             return bad_params('The requested uid \'{}\' does not belong to any user.'.format(uid))
         
     elif ibutton:
         try:
-            user = _ldap.get_member_ibutton(ibutton)
-
-            user_ret = {
-                'uid': user.uid,
-                'cn': user.cn,
-                'drinkBalance': user.drinkBalance
-            }
+            # Taps at a machine are latency critical, so these are answered from the directory's iButton index
+            user_ret = user_directory.get_by_ibutton(ibutton, _lookup_ibutton)
             message = 'Retrieved user with iButton \'{}\''.format(ibutton)
         except KeyError:
             return bad_params('The provided iButton value does not belong to any user.')
@@ -99,7 +129,7 @@ def get_credits(adapter):
 
 @users_bp.route('/users/credits', methods=['PUT'])
 @get_adapter
-@check_token(admin_only=True)
+@check_token(admin_only=True, allow_mock=True)
 def manage_credits(adapter):
     if request.headers.get('Content-Type') != 'application/json':
         return bad_headers_content_type()
@@ -121,6 +151,11 @@ def manage_credits(adapter):
         return bad_params('The new drinkBalance must be an integer')
     except KeyError:
         return bad_params('The requested uid \'{}\' does not belong to any user.'.format(body['uid']))
+    except balances.BalanceConflict:
+        return jsonify({
+            'error': 'The drinkBalance was changed by someone else while being updated, please try again',
+            'errorCode': 409
+        }), 409
 
     success = {
         'message': 'Drink balance updated from {} credits to {} credits for user \'{}\''.format(
@@ -132,29 +167,33 @@ def manage_credits(adapter):
 
     return jsonify(success), 200
 
+@tracing.traced()
 def _get_credits(uid):
-    user = _ldap.get_member(uid, uid=True)
-    return int(user.drinkBalance)
+    return balances.get_balance(uid)
 
+@tracing.traced()
 def _manage_credits(uid, drinkBalance, adapter):
     """ Set the drinkBalance of the user corresponding to the provided uid """
     i_balance = int(drinkBalance)
     
     if adapter == MockAdapter:
         return adapter.update_user_balance(uid, drinkBalance)
-    
-    user = _ldap.get_member(uid, uid=True)
 
-    old_drinkBalance = user.drinkBalance
-    dn = 'uid={},cn=users,cn=accounts,dc=csh,dc=rit,dc=edu'.format(uid)
+    return balances.set_balance(uid, i_balance)
 
-    m_old_balance = {'drinkBalance': [user.drinkBalance.encode('utf-8')]}
-    m_new_balance = {'drinkBalance': [str(drinkBalance).encode('utf-8')]}
+@tracing.traced()
+def _lookup_ibutton(ibutton):
+    """ Find the uid of the user with the provided iButton in LDAP, for iButtons missing from the directory index """
+    return balances.get_member_by_ibutton(ibutton)['uid']
 
-    modlist = ldap.modlist.modifyModlist(m_old_balance, m_new_balance)
-    ldap_conn = _ldap.get_con()
-    ldap_conn.modify_s(dn, modlist)
+@tracing.traced()
+def _debit_credits(uid, amount, expected_balance, adapter):
+    """ Take credits from the user corresponding to the provided uid, whose balance was read as ``expected_balance``
 
-    user = _ldap.get_member(uid, uid=True)
-    return int(old_drinkBalance), int(user.drinkBalance)
+    Returns:
+        int: the user's new balance
+    """
+    if adapter == MockAdapter:
+        return adapter.update_user_balance(uid, expected_balance - amount)[1]
 
+    return balances.debit(uid, amount, expected_balance)